@@ -111,6 +111,21 @@ EXPLORER_SQL_BLACKLIST = ('ALTER', 'RENAME', 'DROP', 'TRUNCATE')
 
 DATABASE_ROUTERS = ['ScenarioCreator.router.ScenarioRouter', ]
 
+# Simulation results ingestion
+RESULTS_WRITER_BATCH_ROWS = 200000  # rows the ResultsWriter gathers from its queue before committing one transaction
+RESULTS_QUEUE_MAX_BATCHES = 64  # workers block once this many parsed batches are waiting on the ResultsWriter
+RESULTS_QUEUE_PUT_SECONDS = 5  # how often a process blocked on the results queue checks that the other end is still running
+SIMULATION_FLUSH_DAYS = 30  # stream an iteration's parsed rows to the ResultsWriter every N days, 0 waits for the last day
+SIMULATION_FLUSH_ROWS = 50000  # hard ceiling on parsed rows a worker holds in memory before it flushes
+SIMULATION_WATCHDOG_SECONDS = 600  # an iteration with no engine output for this long is killed, 0 waits forever
+SIMULATION_STDOUT_MAX_LINES = 1000  # engine output lines read ahead of the parser, the engine blocks on its pipe past this
+SIMULATION_LOG_MODE = 'full'  # iteration logs: 'off', 'errors' for failed iterations only, 'full' or 'full-gzip'
+SIMULATION_LOG_BUFFER_BYTES = 1024 * 1024  # iteration log writes are buffered this much
+SIMULATION_AGENT_ADDRESS = None  # e.g. ('0.0.0.0', 6543) to lease iterations to `manage.py simulation_agent` instead of running them here
+SIMULATION_AGENT_AUTHKEY = b''  # shared secret, must be the same on the coordinator and every agent
+SIMULATION_AGENT_LEASE_SECONDS = 900  # an agent holding iterations that is silent for this long loses them to the other agents
+GRAPH_CACHE_MAX_BYTES = 256 * 1024 * 1024  # rendered graphs kept in the Graph Cache of the supplemental folder, least recently viewed are deleted first
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -95,10 +95,14 @@ def prepare_supplemental_output_directory():
     return output_args
 
 
-def adsm_executable_command():
+def adsm_executable():
     executables = {"Windows": 'adsm_simulation.exe', "Linux": 'adsm_simulation', "Darwin": 'adsm_simulation'}
     executables = defaultdict(lambda: 'adsm_simulation', executables)
-    system_executable = os.path.join(settings.BASE_DIR, 'bin', executables[platform.system()])
+    return os.path.join(settings.BASE_DIR, 'bin', executables[platform.system()])
+
+
+def adsm_executable_command():
+    system_executable = adsm_executable()
     output_args = prepare_supplemental_output_directory()
     ret = [system_executable, db_path('scenario_db')] + output_args
     return ret
@@ -1,11 +1,31 @@
 import os
 import re
+import json
 import time
 import shutil
+import queue
 import sqlite3
+import tempfile
+import threading
+import zipfile
 import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pandas as pd
 
 from ADSMSettings.utils import workspace_path, scenario_filename
+from ScenarioCreator.models import OutputSettings
+
+
+COPY_BUFFER_BYTES = 16 * 1024 * 1024
+# (what the CEngine names the supplemental file of each iteration, combined file name)
+COMBINED_FAMILIES = [('daily_exposures', 'combined_daily_exposures.csv'),
+                     ('daily_events', 'combined_daily_events.csv'),
+                     ('states', 'combined_states.csv')]
+COLUMNAR_FOLDER = "Columnar Outputs"
+COLUMNAR_CHUNK_ROWS = 100000  # rows of a supplemental file read at a time for the columnar export
 
 
 class CombineOutputsGenerator(multiprocessing.Process):
@@ -17,23 +37,50 @@ class CombineOutputsGenerator(multiprocessing.Process):
 
     def run(self):
 
-        supplemental_location = workspace_path(scenario_filename() + "\\" "Supplemental Output Files" + '\\')  # Note: scenario_filename uses the database
+        supplemental_location = workspace_path(os.path.join(scenario_filename(), "Supplemental Output Files"))  # Note: scenario_filename uses the database
         scenario_name = scenario_filename()
         db_location = workspace_path(scenario_filename() + ".db")
+        columnar = OutputSettings.objects.get().save_columnar_outputs
+
+        combine_outputs(supplemental_location, db_location, scenario_name, columnar)
+
+
+def iteration_order(file_name):
+    """Sorts states_2.csv before states_10.csv"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', file_name)]
+
+
+def combine_outputs(supplemental_output_folder, db_location, simulation_name, columnar=False):
+
+    all_files = sorted([file for file in os.listdir(supplemental_output_folder) if os.path.isfile(os.path.join(supplemental_output_folder, file))],
+                       key=iteration_order)
+    family_files = [[file for file in all_files if family in file] for family, combined_name in COMBINED_FAMILIES]
+
+    output_dir = os.path.join(supplemental_output_folder, "Combined Outputs")
+
+    make_output_dir(output_dir)
 
-        combine_outputs(supplemental_location, db_location, scenario_name)
+    iterations_run = max(len(files) for files in family_files)
 
+    if iterations_run == 0:
+        iterations_run = "UNKNOWN"
 
-def combine_outputs(supplemental_output_folder, db_location, simulation_name):
+    with ThreadPoolExecutor(len(COMBINED_FAMILIES)) as executor:  # each family is bound by its own disk reads and writes
+        line_counts = list(executor.map(lambda files, family: combine_files(supplemental_output_folder, files, os.path.join(output_dir, family[1])),
+                                        family_files, COMBINED_FAMILIES))
+    exposure_days, events_days, states_days = line_counts
 
-    all_files = os.listdir(supplemental_output_folder)
+    write_metadata(output_dir, simulation_name, iterations_run, exposure_days, events_days, states_days)
 
-    states_files = [file for file in all_files if "states" in file]
-    exposures_files = [file for file in all_files if "daily_exposures" in file]
-    events_files = [file for file in all_files if "daily_events" in file]
+    if columnar:
+        export = ColumnarExport(supplemental_output_folder)
+        for index, files in enumerate(family_files):
+            for file in files:
+                export.add(index, iteration_number(file), file)
+        export.close()
 
-    output_dir = supplemental_output_folder + "Combined Outputs\\"
 
+def make_output_dir(output_dir):
     building_dir = True
     while building_dir:
         try:
@@ -45,36 +92,12 @@ def combine_outputs(supplemental_output_folder, db_location, simulation_name):
         except PermissionError:
             pass
 
-    iterations_run = max([len(exposures_files), len(events_files), len(states_files)])
-
-    if iterations_run == 0:
-        iterations_run = "UNKNOWN"
-
-    if len(exposures_files) > 0:
-        exposure_days = build_exposures(supplemental_output_folder, exposures_files, output_dir)
-    else:
-        exposure_days = 0
-        file = open(supplemental_output_folder + "/Combined Outputs/" + "combined_daily_exposures.csv", "w")
-        file.close()
-
-    if len(events_files) > 0:
-        events_days = build_events(supplemental_output_folder, events_files, output_dir)
-    else:
-        events_days = 0
-        file = open(supplemental_output_folder + "/Combined Outputs/" + "combined_daily_events.csv", "w")
-        file.close()
-
-    if len(states_files) > 0:
-        states_days = build_states(supplemental_output_folder, states_files, output_dir)
-    else:
-        states_days = 0
-        file = open(supplemental_output_folder + "/Combined Outputs/" + "combined_states.csv", "w")
-        file.close()
 
+def write_metadata(output_dir, simulation_name, iterations_run, exposure_days, events_days, states_days):
     # days_per_iteration = get_days_from_database(db_location)
     # total_outbreak_days = sum(days_per_iteration)
 
-    file = open(output_dir + "/" + "combined_metadata.txt", "w")
+    file = open(os.path.join(output_dir, "combined_metadata.txt"), "w")
 
     file.write("Simulation Name: " + simulation_name + "\n")
     file.write("\n")
@@ -94,68 +117,202 @@ def combine_outputs(supplemental_output_folder, db_location, simulation_name):
     file.close()
 
 
-def get_header(file):
-    file = open(file, "r")
-    header = file.readlines()[0]
-    file.close()
-    return header
-
-
-def build_states(in_path, files, out_path):
-    header = get_header(in_path + "/" + files[0])
-
-    data = []
-
-    for file in files:
-        next_file = open(in_path + "/" + file, "r")
-        new_data = [line.replace("\n", "") for line in next_file.readlines()][1:]
-        data += new_data
+def combine_files(in_path, files, out_file_path):
+    """Concatenates the files into out_file_path keeping only the first one's header.  Copies COPY_BUFFER_BYTES blocks
+    instead of reading whole files into memory, per iteration state files can be GBs.  Returns the number of lines
+    written, 0 for an empty file if there is nothing to combine."""
+    lines = 0
+    with open(out_file_path, 'wb') as out:
+        for index, file in enumerate(files):
+            with open(os.path.join(in_path, file), 'rb') as source:
+                lines += append_file(source, out, skip_header=index > 0)
+    return lines
+
+
+def append_file(source, out, skip_header=True):
+    """Copies the open source file to the end of out, both binary, and returns the number of lines copied.  A last
+    line without a line ending gets one so it doesn't run into the next file."""
+    if skip_header:
+        source.readline()
+    lines = 0
+    last = b''
+    for block in iter(lambda: source.read(COPY_BUFFER_BYTES), b''):
+        out.write(block)
+        lines += block.count(b'\n')
+        last = block[-1:]
+    if last and last != b'\n':
+        out.write(b'\n')
+        lines += 1
+    return lines
+
+
+class CombinedOutputsAppender(threading.Thread):
+    """Appends the supplemental files of each iteration to the combined outputs as soon as the iteration finishes, so
+    they are complete the moment the run ends without a second pass over every file.  This thread is the only writer
+    of the combined files: finished iteration numbers are handed to it with add() and close() writes
+    combined_metadata.txt once they are all appended.  Iterations are combined in the order they finished."""
+    def __init__(self, supplemental_output_folder, simulation_name, columnar=False):
+        super(CombinedOutputsAppender, self).__init__(daemon=True)
+        self.folder = supplemental_output_folder
+        self.export = ColumnarExport(supplemental_output_folder) if columnar else None
+        self.simulation_name = simulation_name
+        self.output_dir = os.path.join(supplemental_output_folder, "Combined Outputs")
+        self.finished = queue.Queue()
+        self.iterations_run = 0
+        self.line_counts = [0] * len(COMBINED_FAMILIES)
+
+    def add(self, iteration_number):
+        self.finished.put(iteration_number)
+
+    def close(self):
+        self.finished.put(None)
+        self.join()
+        write_metadata(self.output_dir, self.simulation_name, self.iterations_run or "UNKNOWN", *self.line_counts)
+        if self.export:
+            self.export.close()
 
-    file = open(out_path + "/" + "combined_states.csv", "w")
-    file.write(header)
-    for line in data:
-        file.write(line + "\n")
-    file.close()
-
-    return len(data) + 1
-
-
-def build_exposures(in_path, files, out_path):
-    header = get_header(in_path + "/" + files[0])
-
-    data = []
-
-    for file in files:
-        next_file = open(in_path + "/" + file, "r")
-        new_data = [line.replace("\n", "") for line in next_file.readlines()][1:]
-        data += new_data
-
-    file = open(out_path + "/" + "combined_daily_exposures.csv", "w")
-    file.write(header)
-    for line in data:
-        file.write(line + "\n")
-    file.close()
-
-    return len(data) + 1
-
-
-def build_events(in_path, files, out_path):
-    header = get_header(in_path + "/" + files[0])
-
-    data = []
-
-    for file in files:
-        next_file = open(in_path + "/" + file, "r")
-        new_data = [line.replace("\n", "") for line in next_file.readlines()][1:]
-        data += new_data
-
-    file = open(out_path + "/" + "combined_daily_events.csv", "w")
-    file.write(header)
-    for line in data:
-        file.write(line + "\n")
-    file.close()
-
-    return len(data) + 1
+    def run(self):
+        make_output_dir(self.output_dir)
+        outs = [open(os.path.join(self.output_dir, combined_name), 'wb') for family, combined_name in COMBINED_FAMILIES]
+        try:
+            finished = False
+            while not finished:
+                iterations = [self.finished.get()]  # block until an iteration finishes
+                while True:
+                    try:
+                        iterations.append(self.finished.get_nowait())
+                    except queue.Empty:
+                        break
+                finished = None in iterations
+                self.append([iteration for iteration in iterations if iteration is not None], outs)
+        finally:
+            for out in outs:
+                out.close()
+
+    def append(self, iterations, outs):
+        if not iterations:
+            return
+        files = iteration_files(self.folder)  # one directory listing for everything that finished since the last one
+        for iteration_number in iterations:
+            self.iterations_run += 1
+            for index, out in enumerate(outs):
+                file = files.get((index, iteration_number))
+                if file is not None:
+                    with open(os.path.join(self.folder, file), 'rb') as source:
+                        self.line_counts[index] += append_file(source, out, skip_header=out.tell() > 0)
+                    if self.export:
+                        self.export.add(index, iteration_number, file)
+
+
+def iteration_files(folder):
+    """{(position in COMBINED_FAMILIES, iteration number): file name} of the supplemental files in folder.  The
+    iteration number is the last number in the file name."""
+    files = {}
+    for file in os.listdir(folder):
+        number = iteration_number(file)
+        if number is None:
+            continue
+        for index, (family, combined_name) in enumerate(COMBINED_FAMILIES):
+            if family in file:
+                files[(index, number)] = file
+    return files
+
+
+def iteration_number(file_name):
+    numbers = re.findall(r'\d+', file_name)
+    return int(numbers[-1]) if numbers else None
+
+
+class ColumnarExport(object):
+    """Writes the supplemental files of each iteration to the Columnar Outputs folder as compressed NumPy .npz files,
+    one per family and iteration, with an iteration column added.  Every column is a separately compressed typed array,
+    so one iteration or one column can be loaded without decompressing the rest.  close() writes index.json:
+        {family: {iteration number: {"file": path relative to the folder, "rows": rows, "columns": {name: dtype}}}}
+    read_columnar_iteration() loads an iteration back; R can read them with RcppCNPy or reticulate.
+    Files are read COLUMNAR_CHUNK_ROWS rows at a time, the same as the combined outputs never hold a whole file."""
+    def __init__(self, supplemental_output_folder):
+        self.folder = os.path.join(supplemental_output_folder, COLUMNAR_FOLDER)
+        self.in_path = supplemental_output_folder
+        self.index = {family: {} for family, combined_name in COMBINED_FAMILIES}
+        make_output_dir(self.folder)
+        for family, combined_name in COMBINED_FAMILIES:
+            os.makedirs(os.path.join(self.folder, family))
+
+    def add(self, family_index, iteration_number, file):
+        family = COMBINED_FAMILIES[family_index][0]
+        try:
+            rows, columns = self.spool(os.path.join(self.in_path, file), iteration_number)
+        except ValueError:  # not even a header
+            return
+        relative_path = os.path.join(family, "iteration_%i.npz" % iteration_number)
+        try:
+            with zipfile.ZipFile(os.path.join(self.folder, relative_path), 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as npz:
+                for name, (dtype, spooled) in columns.items():
+                    member_path = self.write_column(rows, dtype, spooled)
+                    try:
+                        npz.write(member_path, name + '.npy')  # the same layout numpy.savez_compressed writes
+                    finally:
+                        os.remove(member_path)
+        finally:
+            for dtype, spooled in columns.values():
+                spooled.close()
+        self.index[family][iteration_number] = {'file': relative_path.replace(os.sep, '/'), 'rows': rows,
+                                                'columns': {name: dtype.str for name, (dtype, spooled) in columns.items()}}
+
+    @staticmethod
+    def write_column(rows, dtype, spooled):
+        """Joins the spooled chunks of a column into one .npy file of its final dtype, a chunk at a time.  Returns the
+        path of the temporary file."""
+        descriptor, member_path = tempfile.mkstemp(suffix='.npy')
+        with os.fdopen(descriptor, 'wb') as member:
+            numpy.lib.format.write_array_header_1_0(member, {'descr': numpy.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows,)})
+            spooled.seek(0)
+            while spooled.tell() < os.fstat(spooled.fileno()).st_size:
+                values = numpy.load(spooled)
+                if dtype.kind == 'U' and values.dtype.kind == 'f':  # a chunk of blanks in a text column
+                    values = numpy.where(numpy.isnan(values), '', values.astype(str))
+                member.write(values.astype(dtype, copy=False).tobytes())
+        return member_path
+
+    @staticmethod
+    def spool(path, iteration_number):
+        """Reads the file a chunk at a time and spools each column to its own temporary file, since the type of a column
+        is only known once every chunk has been read: a column of whole numbers can have a blank or a decimal further
+        down.  Returns (rows, {column name: [dtype, temporary file of .npy chunks]})."""
+        columns = OrderedDict()
+        rows = 0
+        try:
+            for chunk in pd.read_csv(path, chunksize=COLUMNAR_CHUNK_ROWS):
+                arrays = [('iteration', numpy.full(len(chunk), iteration_number, dtype=numpy.int64))]
+                for name in chunk.columns:
+                    values = numpy.asarray(chunk[name])
+                    if values.dtype == object:  # text, stored without pickling
+                        values = numpy.asarray(chunk[name].fillna('')).astype(str)
+                    arrays.append((str(name), values))
+                for name, values in arrays:
+                    if name not in columns:
+                        columns[name] = [values.dtype, tempfile.TemporaryFile()]
+                    else:
+                        columns[name][0] = numpy.promote_types(columns[name][0], values.dtype)
+                    numpy.save(columns[name][1], values)  # text is a fixed width unicode array, never pickled
+                rows += len(chunk)
+        except BaseException:
+            for dtype, spooled in columns.values():
+                spooled.close()
+            raise
+        return rows, columns
+
+    def close(self):
+        with open(os.path.join(self.folder, "index.json"), 'w') as index:
+            json.dump(self.index, index, sort_keys=True)
+
+
+def read_columnar_iteration(columnar_folder, family, iteration_number, columns=None):
+    """{column name: array} of one iteration from the Columnar Outputs, only the named columns are decompressed"""
+    with open(os.path.join(columnar_folder, "index.json")) as index:
+        entry = json.load(index)[family][str(iteration_number)]
+    with numpy.load(os.path.join(columnar_folder, entry['file'])) as arrays:
+        return {name: arrays[name] for name in (columns or entry['columns'])}
 
 
 '''
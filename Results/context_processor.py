@@ -2,7 +2,7 @@ from ADSMSettings.models import SmSession
 from Results.summary import iteration_progress, iterations_complete
 from Results.views import excluded_headers
 from Results.models import outputs_exist, ResultsVersion
-from Results.utils import is_simulation_running, is_simulation_stopped
+from Results.utils import is_simulation_running, is_simulation_stopped, unfinished_iterations
 
 
 def results_context(request):
@@ -18,9 +18,11 @@ def results_context(request):
             version = ResultsVersion.objects.all().first().__str__()  # singleton doesn't always work on this model (legacy)
         except:
             version = "No version available"
+        simulation_stopped = is_simulation_stopped()
         context.update({
                         'is_simulation_running': is_simulation_running(),
-                        'is_simulation_stopped': is_simulation_stopped(),
+                        'is_simulation_stopped': simulation_stopped,
+                        'iterations_unfinished': len(unfinished_iterations()) if simulation_stopped else 0,
                         'iterations_completed': iterations_complete(),
                         'version_number': version
     
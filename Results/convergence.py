@@ -0,0 +1,84 @@
+"""The optional stopping rule of OutputSettings.  Once convergence_min_iterations have finished, the LastDayStatistics of
+each convergence field are checked as iterations finish and no more iterations are started once all of them are within
+convergence_tolerance.  With the 'mean' statistic that is the half width of the 95% confidence interval of the mean
+relative to the mean.  With 'median' it is the change in the median since 20% fewer iterations had finished, relative to
+the median.  The evidence of the check that stopped the run is kept on the SimulationRun."""
+import json
+from math import sqrt
+
+from Results.models import DailyControls, DailyByProductionType
+from Results.online_statistics import LastDayStatistics
+
+
+Z_95 = 1.959963984540054
+MEDIAN_LOOKBACK = 0.8  # compare the median with the one from when 80% as many iterations had finished
+
+
+def parse_convergence_fields(text):
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+
+def convergence_field_model(field_name):
+    """The table a convergence field is summarized from: DailyControls, or the All production types rows of
+    DailyByProductionType.  None if it isn't a numeric last day output."""
+    for model in [DailyControls, DailyByProductionType]:
+        if field_name in [name for position, name in LastDayStatistics.layout(model)[3]]:
+            return model
+    return None
+
+
+def relative(difference, reference):
+    if difference == 0:
+        return 0.0
+    return abs(difference / reference) if reference else None  # None never converges
+
+
+class ConvergenceMonitor(object):
+    def __init__(self, output_settings):
+        field_names = parse_convergence_fields(output_settings.convergence_fields)
+        self.fields = [(convergence_field_model(name), name) for name in field_names if convergence_field_model(name)]
+        self.statistic = output_settings.convergence_statistic
+        self.tolerance = output_settings.convergence_tolerance
+        self.min_iterations = output_settings.convergence_min_iterations
+        self.check_every = max(1, self.min_iterations // 10)
+        self.medians = {name: [] for model, name in self.fields}  # (count, median) of every check
+        self.evidence = []
+        self.converged = False
+
+    def due(self, completed):
+        """Whether to check after this many iterations have finished.  The statistics lag behind the ResultsWriter
+        anyway, so there is no point loading them after every single iteration."""
+        return not self.converged and completed >= self.min_iterations and completed % self.check_every == 0
+
+    def check(self, statistics=None):
+        """Evaluates every field against the stored LastDayStatistics.  True once all of them have converged."""
+        if statistics is None:
+            statistics = LastDayStatistics.load(field_names=[name for model, name in self.fields])
+        self.evidence = [self.field_evidence(statistics.get(model, name), name) for model, name in self.fields]
+        self.converged = bool(self.evidence) and all(entry['converged'] for entry in self.evidence)
+        return self.converged
+
+    def field_evidence(self, field, name):
+        count = field.count if field else 0
+        entry = {'field': name, 'statistic': self.statistic, 'tolerance': self.tolerance, 'iterations': count,
+                 'relative_error': None, 'converged': False}
+        if count < max(2, self.min_iterations):
+            return entry
+        if self.statistic == 'median':
+            median = field.median()
+            history = self.medians[name]
+            if not history or history[-1][0] != count:
+                history.append((count, median))
+            earlier = [m for c, m in history if c <= count * MEDIAN_LOOKBACK]
+            entry['median'] = median
+            if earlier:
+                entry['earlier_median'] = earlier[-1]
+                entry['relative_error'] = relative(median - earlier[-1], median)
+        else:
+            half_width = Z_95 * sqrt(field.sum_of_squares / (count - 1)) / sqrt(count)
+            entry.update(mean=field.mean, half_width=half_width, relative_error=relative(half_width, field.mean))
+        entry['converged'] = entry['relative_error'] is not None and entry['relative_error'] <= self.tolerance
+        return entry
+
+    def json(self):
+        return json.dumps(self.evidence)
@@ -1,20 +1,20 @@
 import multiprocessing
-import math
 import csv
+import warnings
 
+import numpy
 from django.conf import settings
-from django.db import connections, OperationalError
-from django.db.models import Avg, Min, Max
-from math import sqrt
-from numpy import percentile
-from statistics import pstdev
+from django.db import models
 
 from ADSMSettings.utils import workspace_path, scenario_filename
 from Results.models import DailyControls
+from Results.online_statistics import LastDayStatistics
 from Results.output_grammar import explain
+from Results.results_cache import results_fingerprint, store_value
 
 
 SUMMARY_FILE_NAME = 'Summary.csv'
+PERCENTILES = [5, 25, 50, 75, 95]
 
 
 def create_csv_file(location, headers, data):
@@ -26,13 +26,6 @@ def create_csv_file(location, headers, data):
             writer.writerow(x)
 
 
-def django_percentile(field_name, query_set, cutoff_percentile):
-    try:
-        return percentile(query_set.values_list(field_name).order_by(field_name), cutoff_percentile)
-    except:
-        return "N/A"
-
-
 class SummaryCSVGenerator(multiprocessing.Process):
     import django
     django.setup()
@@ -49,9 +42,11 @@ class SummaryCSVGenerator(multiprocessing.Process):
                 settings.DATABASES[database]['NAME'] = settings.DATABASES[database]['TEST']['NAME'] if 'TEST' in settings.DATABASES[database] else settings.DATABASES[database]['TEST_NAME']
 
         location = workspace_path(scenario_filename() + '/' + "Supplemental Output Files" + '/' + SUMMARY_FILE_NAME)  # Note: scenario_filename uses the database
+        fingerprint = results_fingerprint()
         headers, data = self.get_summary_data_table()
 
         create_csv_file(location, headers, data)
+        store_value(SUMMARY_FILE_NAME, location, fingerprint)  # the fingerprint from before it was computed, in case output was written since
 
 
     def get_summary_data_table(self):
@@ -61,73 +56,86 @@ class SummaryCSVGenerator(multiprocessing.Process):
         from Results.models import DailyByProductionType
         headers = ['Field Name', 'Explanation', 'Mean', 'StdDev', 'Low', 'High', 'p5', 'p25', 'p50', 'p75', 'p95']
         data = []  # 2D
+        statistics = LastDayStatistics.load()  # accumulated while the simulation ran, no table scans needed
 
         fields_of_interest = [field for field, val in DailyByProductionType() if 'Cumulative' in explain(field)]  # only cumulative, last day fields in DailyByProductionType for all production types
         grab_pt = 'infcUIni infcAIni infcUAir infcAAir infcUDir infcADir infcUInd infcAInd expcUDir expcADir expcUInd expcAInd detcUClin detcAClin detcUTest detcATest descUIni descAIni descUDet descADet descUDirFwd descADirFwd descUIndFwd descAIndFwd descUDirBack descADirBack descUIndBack descAIndBack descURing descARing vaccUIni vaccAIni vaccURing vaccARing vacwUMax vacwAMax vacwUMaxDay vacwAMaxDay vacwUTimeMax vacwUTimeAvg exmcUDirFwd exmcADirFwd exmcUIndFwd exmcAIndFwd exmcUDirBack exmcADirBack exmcUIndBack exmcAIndBack tstcUDirFwd tstcADirFwd tstcUIndFwd tstcAIndFwd tstcUDirBack tstcADirBack tstcUIndBack tstcAIndBack tstcUTruePos tstcUTrueNeg tstcUFalsePos tstcUFalseNeg firstDetection lastDetection firstVaccination firstDestruction'.split()
         query_set = DailyByProductionType.objects.filter(last_day=True, production_type__isnull=True, )
-        for field_name in set().union(grab_pt, fields_of_interest):
-            data.append(self.summary_row(field_name, query_set, headers))
+        data.extend(self.summary_rows(list(set().union(grab_pt, fields_of_interest)), query_set, headers, statistics))
 
         grab_controls = 'deswUMax deswAMax deswUMaxDay deswAMaxDay deswUTimeMax deswUTimeAvg deswUDaysInQueue deswADaysInQueue detOccurred firstDetUInf firstDetAInf vaccOccurred destrOccurred diseaseDuration outbreakDuration'.split()
         query_set = DailyControls.objects.filter(last_day=True)
-        for field_name in grab_controls:
-            data.append(self.summary_row(field_name, query_set, headers))
+        data.extend(self.summary_rows(grab_controls, query_set, headers, statistics))
 
         # TODO: These are field names mentioned in the original NAADSM file that I have not yet accounted for
         unaccounted_for = 'infcUAll infcAAll expcUAll expcAAll trcUDirFwd trcADirFwd trcUIndFwd trcAIndFwd trcUDirpFwd trcADirpFwd trcUIndpFwd trcAIndpFwd trcUDirBack trcADirBack trcUIndBack trcAIndBack trcUDirpBack trcADirpBack trcUIndpBack trcAIndpBack trcUDirAll trcADirAll trcUIndAll trcAIndAll trcUAll trcAAll tocUDirFwd tocUIndFwd tocUDirBack tocUIndBack tocUDirAll tocUIndAll tocUAll detcUAll detcAAll descUAll descAAll vaccUAll vaccAAll exmcUDirAll exmcADirAll exmcUIndAll exmcAIndAll exmcUAll exmcAAll tstcUDirAll tstcADirAll tstcUIndAll tstcAIndAll tstcUAll tstcAAll tstcATruePos tstcATrueNeg tstcAFalsePos tstcAFalseNeg zoncFoci diseaseEnded outbreakEnded'.split()
 
         return headers, data
 
-    def summary_row(self, field_name, query_set, headers):
-
-        resolvers = {'Field Name': lambda field, query: field_name,
-                     'Explanation': lambda field, query: explain(field_name),
-                     'Mean': lambda field, query: query.aggregate(Avg(field)).popitem()[1],  # grabs value
-                     'StdDev': std_dev,
-                     'Low': lambda field, query: query.aggregate(Min(field)).popitem()[1],  # grabs value
-                     'High': lambda field, query: query.aggregate(Max(field)).popitem()[1],  # grabs value
-                     'p5': lambda field, query:  django_percentile(field, query, 5),
-                     'p25': lambda field, query: django_percentile(field, query, 25),
-                     'p50': lambda field, query: django_percentile(field, query, 50),
-                     'p75': lambda field, query: django_percentile(field, query, 75),
-                     'p95': lambda field, query: django_percentile(field, query, 95),
+    def summary_rows(self, field_names, query_set, headers, statistics=None):
+        """A row per field, in order.  Fields with RunningStatistics in statistics are filled from those, the rest are
+        read from query_set in one scan."""
+        model = query_set.model
+        streamed = {}
+        if statistics is not None:
+            streamed = {field_name: statistics.get(model, field_name) for field_name in field_names if statistics.get(model, field_name) is not None}
+        scanned = [field_name for field_name in field_names if field_name not in streamed]
+        rows = dict(zip(scanned, self.scanned_summary_rows(scanned, query_set, headers))) if scanned else {}
+        return [self.streamed_summary_row(field_name, headers, streamed[field_name]) if field_name in streamed else rows[field_name]
+                for field_name in field_names]
+
+    def streamed_summary_row(self, field_name, headers, statistics):
+        percentile_or_na = lambda p: float(statistics.percentile(p)) if statistics.count else "N/A"
+        resolvers = {'Field Name': lambda: field_name,
+                     'Explanation': lambda: explain(field_name),
+                     'Mean': lambda: statistics.mean if statistics.count else None,
+                     'StdDev': lambda: round(statistics.std_dev(), 2) if statistics.count else "N/A",
+                     'Low': lambda: statistics.low,
+                     'High': lambda: statistics.high,
+                     'p5': lambda: percentile_or_na(5),
+                     'p25': lambda: percentile_or_na(25),
+                     'p50': lambda: percentile_or_na(50),
+                     'p75': lambda: percentile_or_na(75),
+                     'p95': lambda: percentile_or_na(95),
         }
         row = {}
         for column in headers:
             if column in resolvers.keys():
-                row[column] = resolvers[column](field_name, query_set)
+                row[column] = resolvers[column]()
             else:
                 raise NotImplemented("The column name " + column + " does not have a function associated with it.")
 
         return row
 
-
-def std_dev(field, query):
-    """This is the __Population__ Standard Deviation formula translated into RAW SQL statement, specifically SQLite version."""
-
-    #get next table name based on given query
-    table_name = query.model._meta.db_table
-    cursor = connections["scenario_db"].cursor()
-
-    #two statements, one is for tables that have production_type_id and one for tables that dont
-    # try and use the query for tables with production_type_id, if that fails use the other query
-    try:
-        last_day_vals = "SELECT {field} FROM {table} WHERE last_day = 1 and production_type_id is null".format(table=table_name, field=field)
-        cursor.execute(last_day_vals)
-    except OperationalError:
-        try:
-            last_day_vals = "SELECT {field} FROM {table} WHERE last_day = 1".format(table=table_name, field=field)
-            cursor.execute(last_day_vals)
-        except OperationalError:
-            return "N/A"
-
-    row = cursor.fetchall()
-
-    #every value in the query return that is an integer to a list, these are the values used in calculation
-    values = [element[0] for element in row if isinstance(element[0], int)]
-
-    if values:
-        #return the standard deviation
-        return round(pstdev(values), 2)
-    else:
-        return "N/A"
+    def scanned_summary_rows(self, field_names, query_set, headers):
+        """Reads the last day rows of query_set once, as a NumPy array with a column per field, and computes every
+        statistic of every field in one vectorized pass.  Blanks are left out of each field's statistics."""
+        model = query_set.model
+        rows = list(query_set.values_list(*field_names))
+        columns = numpy.array(rows, dtype=float).reshape(len(rows), len(field_names))  # None becomes nan
+        counts = (~numpy.isnan(columns)).sum(axis=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # fields without a single value, they are reported as N/A
+            means = numpy.nanmean(columns, axis=0)
+            std_devs = numpy.nanstd(columns, axis=0)  # population standard deviation
+            lows = numpy.nanmin(columns, axis=0) if len(rows) else means
+            highs = numpy.nanmax(columns, axis=0) if len(rows) else means
+            percentiles = numpy.nanpercentile(columns, PERCENTILES, axis=0) if len(rows) else [means] * len(PERCENTILES)
+
+        data = []
+        for index, field_name in enumerate(field_names):
+            whole = isinstance(model._meta.get_field(field_name), models.IntegerField)
+            exact = lambda value: (int(value) if whole else float(value)) if counts[index] else None
+            row = {'Field Name': field_name,
+                   'Explanation': explain(field_name),
+                   'Mean': float(means[index]) if counts[index] else None,
+                   'StdDev': round(float(std_devs[index]), 2) if counts[index] else "N/A",
+                   'Low': exact(lows[index]),
+                   'High': exact(highs[index])}
+            for p, values in zip(PERCENTILES, percentiles):
+                row['p%i' % p] = float(values[index]) if counts[index] else "N/A"
+            for column in headers:
+                if column not in row:
+                    raise NotImplemented("The column name " + column + " does not have a function associated with it.")
+            data.append(row)
+        return data
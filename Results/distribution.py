@@ -0,0 +1,265 @@
+"""Spreads the iterations of a run over simulation agents: other ADSM installations started with
+`manage.py simulation_agent host:port`, or several of them on one machine.  The coordinator inside Simulation.run leases
+iteration numbers to the agents connected to SIMULATION_AGENT_ADDRESS, ships them a copy of the scenario and forwards
+the rows they parse to its own ResultsWriter.  An agent that drops its connection, or goes silent for
+SIMULATION_AGENT_LEASE_SECONDS, loses its leases: the rows it streamed for them are discarded and the iterations are
+leased to another agent.  The supplemental output files the engine writes stay in each agent's own workspace.
+
+Messages are pickled tuples sent over multiprocessing.connection after the SIMULATION_AGENT_AUTHKEY handshake:
+    agent -> coordinator  ('hello', host name, number of processes)
+    coordinator -> agent  ('scenario', file name, production types, zones) followed by the file in raw byte chunks and b''
+    coordinator -> agent  ('lease', iteration number)
+    agent -> coordinator  ('rows', iteration number, [(table name, row tuple)] or None)  same as on the ResultsWriter queue
+    agent -> coordinator  ('done', iteration number, seconds, failure, engine error text)
+    agent -> coordinator  ('alive',)
+    coordinator -> agent  ('stop',)"""
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from ADSMSettings.utils import adsm_executable, db_path, scenario_filename, workspace_path
+import Results.simulation
+from Results.ingestion import ResultsWriterGone, put_results
+
+
+SCENARIO_CHUNK_BYTES = 1024 * 1024
+
+
+def agent_authkey():
+    if not settings.SIMULATION_AGENT_AUTHKEY:
+        raise ImproperlyConfigured("SIMULATION_AGENT_AUTHKEY has to be set to run simulation agents.")
+    return settings.SIMULATION_AGENT_AUTHKEY
+
+
+class AgentLost(Exception):
+    pass
+
+
+class AgentCoordinator(object):
+    """Leases iterations to the simulation agents that connect to it.  results() yields (iteration_number, seconds,
+    failure, engine error text) as each iteration finishes, the same as simulation_process returns.  Create it before
+    the ResultsWriter starts so the scenario copy it ships has no half written transactions in it."""
+    def __init__(self, iterations, results_queue, production_types, zones, address=None):
+        self.pending = deque(iterations)
+        self.leased = set()  # every iteration that was ever leased, losing an agent puts them back in pending
+        self.iteration_count = len(self.pending)
+        self.unfinished = len(self.pending)
+        self.lock = threading.Lock()
+        self.finished = queue.Queue()
+        self.agents = []
+        self.results_queue = results_queue
+        self.writer = None  # the ResultsWriter draining results_queue, once it is started
+        self.production_types = list(production_types)
+        self.zones = list(zones)
+        self.scenario_name = (scenario_filename() or 'scenario') + '.db'
+        snapshot, self.scenario_path = tempfile.mkstemp(suffix='.db')
+        os.close(snapshot)
+        shutil.copy(db_path('scenario_db'), self.scenario_path)
+        self.listener = Listener(address or settings.SIMULATION_AGENT_ADDRESS, authkey=agent_authkey())
+        self.address = self.listener.address
+
+    def results(self):
+        print("Waiting for simulation agents on", self.address)
+        threading.Thread(target=self.accept_agents, daemon=True).start()
+        try:
+            yielded = 0
+            while yielded < self.iteration_count:  # stop_leasing can lower it
+                try:
+                    result = self.finished.get(timeout=settings.RESULTS_QUEUE_PUT_SECONDS)
+                except queue.Empty:
+                    if self.writer is not None and not self.writer.is_alive():
+                        raise ResultsWriterGone("The results writer stopped before every iteration was written.")
+                    continue
+                yield result
+                yielded += 1
+        finally:
+            self.listener.close()
+            for agent in self.agents:
+                agent.join(5)  # lets idle agents hear 'stop' instead of a dropped connection
+            os.remove(self.scenario_path)
+
+    def stop_leasing(self):
+        """No more iterations are leased, the ones already leased are still finished.  So are the ones a lost agent gave
+        back: they were started, so SimulationRun.stopped_after has to cover them.  Returns the iteration numbers that
+        will not be run, all of them after every iteration that was leased."""
+        with self.lock:
+            dropped = [iteration for iteration in self.pending if iteration not in self.leased]
+            released = [iteration for iteration in self.pending if iteration in self.leased]
+            self.pending.clear()
+            self.pending.extend(released)
+            self.iteration_count -= len(dropped)
+            self.unfinished -= len(dropped)
+        return dropped
+
+    def accept_agents(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError as error:
+                print("Refused a simulation agent:", error)
+                continue
+            except OSError:
+                return  # the listener was closed, every iteration is finished
+            agent = threading.Thread(target=self.serve_agent, args=(connection,), daemon=True)
+            self.agents.append(agent)
+            agent.start()
+
+    def serve_agent(self, connection):
+        host = 'unknown agent'
+        leases = set()
+        last_batches = {}
+        try:
+            message, host, processes = connection.recv()
+            print("Simulation agent %s connected with %i processes" % (host, processes))
+            self.ship_scenario(connection)
+            heard = time.time()
+            while True:
+                self.lease_iterations(connection, leases, processes)
+                if not leases and self.unfinished == 0:
+                    break
+                if connection.poll(1):
+                    heard = time.time()
+                    self.receive(connection.recv(), leases, last_batches)
+                elif leases and time.time() - heard > settings.SIMULATION_AGENT_LEASE_SECONDS:
+                    raise AgentLost("nothing heard for %i seconds" % settings.SIMULATION_AGENT_LEASE_SECONDS)
+            connection.send(('stop',))
+        except (AgentLost, EOFError, OSError) as error:
+            print("Lost simulation agent %s: %s" % (host, str(error) or type(error).__name__))
+            for iteration_number in leases:
+                self.put_results((iteration_number, None))  # throw away what it streamed before leasing it again
+            with self.lock:
+                self.pending.extendleft(sorted(leases, reverse=True))
+        finally:
+            connection.close()
+
+    def put_results(self, message):
+        put_results(self.results_queue, message, self.writer.pid if self.writer else None)
+
+    def ship_scenario(self, connection):
+        connection.send(('scenario', self.scenario_name, self.production_types, self.zones))
+        with open(self.scenario_path, 'rb') as scenario:
+            for chunk in iter(lambda: scenario.read(SCENARIO_CHUNK_BYTES), b''):
+                connection.send_bytes(chunk)
+        connection.send_bytes(b'')
+
+    def lease_iterations(self, connection, leases, processes):
+        while len(leases) < processes:
+            with self.lock:
+                if not self.pending:
+                    return
+                iteration_number = self.pending.popleft()
+                self.leased.add(iteration_number)
+            leases.add(iteration_number)
+            connection.send(('lease', iteration_number))
+
+    def receive(self, message, leases, last_batches):
+        if message[0] == 'rows':
+            kind, iteration_number, rows = message
+            if rows is not None and any(table_name == 'IterationTiming' for table_name, row in rows):
+                # The last batch of an iteration is held until it is done: UnitStats and statistics can't be taken back
+                last_batches[iteration_number] = rows
+            else:
+                self.put_results((iteration_number, rows))
+        elif message[0] == 'done':
+            kind, iteration_number, seconds, failure, error_text = message
+            if iteration_number in last_batches:
+                self.put_results((iteration_number, last_batches.pop(iteration_number)))
+            leases.discard(iteration_number)
+            with self.lock:
+                self.unfinished -= 1
+            self.finished.put((iteration_number, seconds, failure, error_text))
+
+
+def agent_iteration(iteration_number):
+    """Pool task of a SimulationAgent.  'done' follows the iteration's rows through the same queue so the coordinator
+    always has every row before it hears the iteration is done."""
+    results_queue = Results.simulation.worker.results_queue
+    try:
+        result = Results.simulation.simulation_process(iteration_number)
+    except Exception as error:  # the coordinator would wait on this lease forever
+        results_queue.put((iteration_number, None))
+        result = (iteration_number, 0, "%s on %s: %s" % (type(error).__name__, socket.gethostname(), error), None)
+    results_queue.put(('done',) + tuple(result))
+
+
+class SimulationAgent(object):
+    """Runs the iterations an AgentCoordinator leases to it on the processors of this machine"""
+    def __init__(self, address, processes=None):
+        self.address = address
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+            if processes > 2:
+                processes -= 1
+        self.processes = processes
+        self.connection = None
+        self.send_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def send(self, message):
+        with self.send_lock:
+            self.connection.send(message)
+
+    def run(self):
+        self.connection = Client(self.address, authkey=agent_authkey())
+        directory = tempfile.mkdtemp(prefix='adsm_agent_')
+        pool = None
+        try:
+            self.send(('hello', socket.gethostname(), self.processes))
+            scenario_path, production_types, zones = self.receive_scenario(directory)
+            # Kept in this machine's workspace the same as a local run, the temporary directory is deleted when it is done
+            output_dir = workspace_path(os.path.join(os.path.splitext(os.path.basename(scenario_path))[0], "Supplemental Output Files"))
+            os.makedirs(output_dir, exist_ok=True)
+            executable_cmd = [adsm_executable(), scenario_path, '--output-dir', output_dir]
+            log_path = os.path.join(settings.WORKSPACE_PATH, 'settings', 'logs')
+            os.makedirs(log_path, exist_ok=True)
+
+            results_queue = multiprocessing.Queue(settings.RESULTS_QUEUE_MAX_BATCHES)
+            forwarding = threading.Thread(target=self.forward_results, args=(results_queue,), daemon=True)
+            forwarding.start()
+            threading.Thread(target=self.keep_alive, daemon=True).start()
+            pool = multiprocessing.Pool(self.processes, initializer=Results.simulation.initialize_worker,
+                                        initargs=(results_queue, executable_cmd, production_types, zones, log_path, False, False))
+            for message in iter(self.connection.recv, ('stop',)):
+                kind, iteration_number = message
+                pool.apply_async(func=agent_iteration, args=(iteration_number,))
+            pool.close()
+            pool.join()
+            results_queue.put(None)
+            forwarding.join()
+        except (EOFError, OSError) as error:
+            print("Lost the coordinator:", str(error) or type(error).__name__)
+            if pool is not None:
+                pool.terminate()
+        finally:
+            self.stopped.set()
+            self.connection.close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def receive_scenario(self, directory):
+        kind, scenario_name, production_types, zones = self.connection.recv()
+        scenario_path = os.path.join(directory, scenario_name)
+        with open(scenario_path, 'wb') as scenario:
+            for chunk in iter(self.connection.recv_bytes, b''):
+                scenario.write(chunk)
+        return scenario_path, production_types, zones
+
+    def forward_results(self, results_queue):
+        for message in iter(results_queue.get, None):
+            self.send(message if message[0] == 'done' else ('rows',) + tuple(message))
+
+    def keep_alive(self):
+        while not self.stopped.wait(settings.SIMULATION_AGENT_LEASE_SECONDS / 3):
+            try:
+                self.send(('alive',))
+            except OSError:
+                return
@@ -0,0 +1,75 @@
+"""Rendered graph PNGs are kept in the Graph Cache folder of the scenario's Supplemental Output Files, named by a hash of
+what they graph and the results fingerprint of the output they were drawn from, so a graph is only drawn again once the
+output changes.  Viewing a graph touches its file; once the folder holds more than GRAPH_CACHE_MAX_BYTES the least
+recently viewed graphs are deleted.  delete_all_outputs takes the folder with the rest of the supplemental output."""
+import os
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from ADSMSettings.utils import workspace_path, scenario_filename
+from Results.results_cache import results_fingerprint
+from Results.utils import is_simulation_running
+
+
+def graph_cache_folder():
+    return workspace_path(os.path.join(scenario_filename(), "Supplemental Output Files", "Graph Cache"))
+
+
+def graph_cache_path(key, fingerprint, folder=None):
+    digest = hashlib.sha1(repr((tuple(key), fingerprint)).encode('utf-8')).hexdigest()
+    return os.path.join(folder or graph_cache_folder(), digest + '.png')
+
+
+def cached_png(key, render, folder=None, store=None):
+    """An image/png response of the graph identified by key, a tuple of its url arguments.  render() draws it as an
+    HttpResponse when it isn't in the cache.  Unless store says otherwise, nothing is cached while a simulation is
+    writing the output."""
+    fingerprint = results_fingerprint()
+    path = graph_cache_path(key, fingerprint, folder)
+    try:
+        with open(path, 'rb') as png:
+            content = png.read()
+        os.utime(path)  # most recently used
+        return HttpResponse(content, content_type='image/png')
+    except OSError:
+        pass
+    response = render()
+    if store if store is not None else not is_simulation_running():
+        store_png(path, response.content)
+    return response
+
+
+def store_png(path, content):
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    handle, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    with os.fdopen(handle, 'wb') as png:
+        png.write(content)
+    os.replace(temporary_path, path)  # another request reading the same graph never sees half of it
+    evict_graphs(folder)
+
+
+def evict_graphs(folder, max_bytes=None):
+    """Deletes the least recently used graphs until the folder is within max_bytes, GRAPH_CACHE_MAX_BYTES by default"""
+    max_bytes = settings.GRAPH_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    graphs = []
+    for name in os.listdir(folder):
+        if name.endswith('.png'):
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:  # another request evicted it first
+                continue
+            graphs.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for used, size, path in graphs)
+    for used, size, path in sorted(graphs):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:  # another request evicted it first
+            pass
+        total -= size
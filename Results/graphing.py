@@ -5,10 +5,15 @@ from ScenarioCreator.views import filtering_params
 from ScenarioCreator.function_graphs import HttpFigure, rstyle
 
 import random
+import multiprocessing
+import numpy
+from collections import OrderedDict
 from time import time
 from matplotlib import gridspec
-from itertools import chain
 from django.db.models import Max, Min, Q
+from django.conf import settings
+from django.db import connections
+from django.http import JsonResponse, HttpResponseBadRequest
 from matplotlib.colors import LogNorm
 from matplotlib.colorbar import ColorbarBase
 import pandas as pd
@@ -19,6 +24,9 @@ from ScenarioCreator.models import Zone, ProductionType, Unit
 from Results.summary import list_of_iterations
 from Results.models import DailyControls, DailyByProductionType, DailyByZone, DailyByZoneAndProductionType
 from Results.inferno import inferno_r
+from Results.graph_cache import cached_png
+from Results.results_cache import cached, results_fingerprint
+from Results.utils import is_simulation_running
 
 
 # def matplotd3(request):
@@ -177,20 +185,24 @@ def construct_iterating_combination_filter_dictionary(iteration, model, zone='')
 
 
 def create_time_series_lines(field_name, model, iteration=None, zone=''):
+    """Returns an iteration x day matrix of the field, or a line x day matrix for a single iteration, with NaN after the
+    last day of each line, along with the column names."""
     filter_sequence, columns = construct_iterating_combination_filter_dictionary(iteration, model, zone=zone)
-    lines = [] 
     if iteration:  # Manually step through each query for a single iteration
-        for filter_dict in filter_sequence:
-            lines.append(list(model.objects.filter(**filter_dict).order_by('day').values_list(field_name, flat=True)))
+        lines = [numpy.array(list(model.objects.filter(**filter_dict).order_by('day').values_list(field_name, flat=True)), dtype=float)
+                 for filter_dict in filter_sequence]
+        matrix = numpy.full((len(lines), max([len(line) for line in lines] + [1])), numpy.nan)
+        for row, line in enumerate(lines):
+            matrix[row, :len(line)] = line
     else:  # summary of all iterations is a single query for performance reasons
-        max_size = model.objects.all().aggregate(Max('day'))['day__max']
-        for row in range(len(list_of_iterations())):  # iteration = index
-            lines.append([None] * max_size)
-        objs = model.objects.filter(**filter_sequence[0]).values_list('iteration', 'day', field_name)
-        for entry in objs:
-            lines[int(entry[0])-1][entry[1]-1] = entry[2]  # sorting done in python, iteration and day are both 1 indexed
+        entries = numpy.array(list(model.objects.filter(**filter_sequence[0]).values_list('iteration', 'day', field_name)), dtype=float).reshape(-1, 3)
+        iterations = numpy.array(list_of_iterations())
+        max_size = int(entries[:, 1].max()) if len(entries) else 1
+        matrix = numpy.full((len(iterations), max_size), numpy.nan)
+        rows = numpy.searchsorted(iterations, entries[:, 0])  # iterations don't have to be numbered 1 to N
+        matrix[rows, entries[:, 1].astype(int) - 1] = entries[:, 2]  # days are 1 indexed
 
-    return lines, columns
+    return matrix, columns
 
 
 def field_is_cumulative(explanation):
@@ -200,37 +212,32 @@ def field_is_cumulative(explanation):
 def extend_last_day_lines(lines, model, field_name):
     """Turns the ragged edge caused by different iterations ending on different days into
     a series of flat lines at their ending value.  Implemented for Issue #159"""
-    time_series = []
-    max_size = max([len(x) for x in lines])
+    max_size = lines.shape[1]
     cumulative_field = field_is_cumulative(model._meta.get_field_by_name(field_name)[0].verbose_name.lower())
-    ends = [line.index(None) if None in line else max_size for line in lines]
-    
-    for line, end in [(lines[i], ends[i]) for i in range(len(lines))]:
-        if cumulative_field:
-            last_value = line[end-1]
-        else:  # This field is non-cumulative, default to zero
-            last_value = 0
-        time_series.append(line)
-        for x in range(end, max_size):
-            time_series[-1][x] = last_value  # editing the line we just appended
-    return time_series
+    missing = numpy.isnan(lines)
+    ends = numpy.where(missing.any(axis=1), missing.argmax(axis=1), max_size)  # the first missing day of each line
+
+    if cumulative_field:
+        last_values = lines[numpy.arange(len(lines)), ends - 1]
+    else:  # This field is non-cumulative, default to zero
+        last_values = numpy.zeros(len(lines))
+    return numpy.where(numpy.arange(max_size) >= ends[:, numpy.newaxis], last_values[:, numpy.newaxis], lines)
 
 
 def collect_boxplot_data(padded_lines, explanation):
-    """Returns a long tuple with all the data necessary to make a boxplot distribution.  For 'cumulative' fields,
+    """Returns a long array with all the data necessary to make a boxplot distribution.  For 'cumulative' fields,
     this is the last day.  For non-cumulative, it is the range of non-blank values.  Issue #159:
     https://github.com/NAVADMC/ADSM/issues/159#issuecomment-53058264"""
     if not field_is_cumulative(explanation):  # This field is non-cumulative, default to zero
-        boxplot_data = tuple(chain([x for line in padded_lines for x in line if x != 0]))  # pile together all the data, but don't include trailing zeroes
+        boxplot_data = padded_lines[padded_lines != 0]  # pile together all the data, but don't include trailing zeroes
     else:  # this field is cumulative
-        boxplot_data = (line[-1] for line in padded_lines)  # only last day is relevant
+        boxplot_data = padded_lines[:, -1]  # only last day is relevant
     return boxplot_data
 
 
 def single_iteration_line_graph(iteration, field_name, model_name, model, time_series, columns, time_graph, boxplot_graph, fig):
-    days = list(range(1, len(time_series[0]) + 1))  # Start with day index
-    time_data = pd.DataFrame.from_records( list(zip(days, *time_series)), columns=columns)  # keys should be same ordering as the for loop above
-    time_data = time_data.set_index('Day')
+    days = pd.Index(numpy.arange(1, time_series.shape[1] + 1), name='Day')  # Start with day index
+    time_data = pd.DataFrame(time_series.T, index=days, columns=columns[1:])  # keys should be same ordering as the for loop above
 
     time_data.plot(ax=time_graph)
 
@@ -254,21 +261,95 @@ def single_iteration_line_graph(iteration, field_name, model_name, model, time_s
 
 
 def TwoD_histogram(fig, gs, time_graph, time_series):
-    days = list(range(1, len(time_series[0]) + 1))  # Start with day index
-    x = days * len(time_series)  # repeat day series for each set of data (1 per iteration)
-    y = list(chain(*time_series))
+    days = time_series.shape[1]
+    x = numpy.tile(numpy.arange(1, days + 1), len(time_series))  # repeat day series for each set of data (1 per iteration)
+    y = time_series.ravel()
+    present = ~numpy.isnan(y)
+    x, y = x[present], y[present]
+    if not len(y):  # every iteration is blank, histogram2d and the color bar need at least one value
+        return HttpFigure(fig)
+    counts, x_edges, y_edges = numpy.histogram2d(x, y, bins=[days, int(max(5, min(y.max(), 300)))])
+    # 300 should really be the number of pixels in the draw area (I don't know how to fetch that)
     norm = LogNorm()
-    time_graph.hist2d(x, y,
-                      bins=[len(days), max(5, min(max(*y), 300))],
-                      # 300 should really be the number of pixels in the draw area (I don't know how to fetch that)
-                      norm=norm,
-                      cmap=inferno_r)
+    time_graph.pcolormesh(x_edges, y_edges, numpy.ma.masked_equal(counts, 0).T, norm=norm, cmap=inferno_r)  # empty bins are left blank, as hist2d does
     color_bar = fig.add_subplot(gs[0], )
     ColorbarBase(cmap=inferno_r, ax=color_bar, norm=norm)
     return HttpFigure(fig)
 
 
-def graph_field_png(request, model_name, field_name, iteration='', zone=''):
+DEFAULT_GRAPH_WIDTH = 700  # pixels, about the width of the time graph graph_field_png draws
+GRAPH_JSON_WIDTHS = [100, 200, 400, 700, 1000, 1400, 2000]  # the only widths Graph.json downsamples to and caches
+QUANTILE_BANDS = [5, 25, 50, 75, 95]
+
+
+def downsample(time_series, width):
+    """Reduces the days to at most width columns, each one the largest value of the days it covers so that a spike
+    still shows at any zoom.  Returns the first day of each column along with the reduced matrix."""
+    days = time_series.shape[1]
+    starts = numpy.unique(numpy.linspace(0, days, num=min(width, days), endpoint=False).astype(int))
+    return starts + 1, numpy.fmax.reduceat(time_series, starts, axis=1)
+
+
+def json_values(values):
+    """A list for JsonResponse, NaN becomes null"""
+    values = numpy.asarray(values, dtype=float)
+    return numpy.where(numpy.isnan(values), None, values).tolist()
+
+
+def boxplot_statistics(values):
+    """What a boxplot draws, with the whiskers at 1.5 IQR like pandas' boxplot.  The outliers are only counted."""
+    values = numpy.asarray(values, dtype=float)
+    values = values[~numpy.isnan(values)]
+    if not len(values):
+        return None
+    q1, median, q3 = numpy.percentile(values, [25, 50, 75])
+    reach = 1.5 * (q3 - q1)
+    whiskers = values[(values >= q1 - reach) & (values <= q3 + reach)]
+    return OrderedDict([('count', len(values)), ('mean', float(values.mean())), ('min', float(values.min())),
+                        ('whislo', float(whiskers.min())), ('q1', float(q1)), ('median', float(median)), ('q3', float(q3)),
+                        ('whishi', float(whiskers.max())), ('max', float(values.max())), ('outliers', len(values) - len(whiskers))])
+
+
+def field_series(model_name, field_name, iteration='', zone='', width=DEFAULT_GRAPH_WIDTH):
+    """The data graph_field_png draws, for charts drawn in the browser.  'series' has a line per production type, zone
+    or iteration when graph_field_png would draw lines, 'quantiles' and 'mean' summarize every iteration by day."""
+    model = globals()[model_name]
+    iteration = int(iteration) if iteration else None
+    lines, columns = create_time_series_lines(field_name, model, iteration=iteration, zone=zone)
+    time_series = extend_last_day_lines(lines, model, field_name)
+    explanation, title = construct_title(field_name, iteration, model, zone)
+    days, reduced = downsample(time_series, width)
+
+    data = OrderedDict([('title', title), ('explanation', explanation), ('cumulative', field_is_cumulative(explanation)),
+                        ('days', days.tolist()), ('boxplot', boxplot_statistics(collect_boxplot_data(time_series, explanation)))])
+    if iteration or len(time_series) < 50:  # the same lines graph_field_png draws
+        data['series'] = OrderedDict((name, json_values(line)) for name, line in zip(columns[1:], reduced))
+    if not iteration:
+        data['quantiles'] = OrderedDict((str(q), json_values(band)) for q, band in zip(QUANTILE_BANDS, numpy.nanpercentile(reduced, QUANTILE_BANDS, axis=0)))
+        data['mean'] = json_values(numpy.nanmean(reduced, axis=0))
+    return data
+
+
+def graph_field_json(request, model_name, field_name, iteration='', zone=''):
+    """field_series downsampled to the ?width= in pixels of the chart, rounded down to one of GRAPH_JSON_WIDTHS so
+    there are only ever that many cached versions of a graph"""
+    try:
+        requested = int(request.GET.get('width', DEFAULT_GRAPH_WIDTH))
+    except ValueError:
+        return HttpResponseBadRequest("width has to be a number of pixels")
+    if not GRAPH_JSON_WIDTHS[0] <= requested <= GRAPH_JSON_WIDTHS[-1]:
+        return HttpResponseBadRequest("width has to be between %i and %i pixels" % (GRAPH_JSON_WIDTHS[0], GRAPH_JSON_WIDTHS[-1]))
+    width = max(allowed for allowed in GRAPH_JSON_WIDTHS if allowed <= requested)
+    key = 'graph_field_json:%s' % ':'.join([model_name, field_name, iteration or '', zone or '', str(width)])
+    return JsonResponse(cached(key, lambda: field_series(model_name, field_name, iteration, zone, width), store=not is_simulation_running()))
+
+
+def graph_field_png(request, model_name, field_name, iteration='', zone='', store=None):
+    return cached_png(('graph_field_png', model_name, field_name, iteration, zone),
+                      lambda: render_field_png(model_name, field_name, iteration, zone), store=store)
+
+
+def render_field_png(model_name, field_name, iteration='', zone=''):
     model = globals()[model_name]
     iteration = int(iteration) if iteration else None
     lines, columns = create_time_series_lines(field_name, model, iteration=iteration, zone=zone)
@@ -287,7 +368,7 @@ def graph_field_png(request, model_name, field_name, iteration='', zone=''):
 
     if iteration:  # for a single iteration, we don't need all the hist2d prep
         return single_iteration_line_graph(iteration, field_name, model_name, model, time_series, columns, time_graph, boxplot_graph, fig)
-    if len(list_of_iterations()) < 50:
+    if len(time_series) < 50:  # one line per iteration
         # do a stacked line graph instead of a histogram    
         return single_iteration_line_graph(iteration, field_name, model_name, model, time_series, columns, time_graph, boxplot_graph, fig)
 
@@ -312,3 +393,94 @@ def create_figure_with_boxplot(title, use_legend):
     time_graph.grid(False)
     return boxplot_graph, fig, gs, time_graph
 
+
+# Fields that never get a graph link in the Results navigation
+GRAPH_EXCLUDED_FIELDS = ['zone', 'production_type', 'day', 'iteration', 'id', 'pk', 'last_day',
+                         'vacwU', 'vacwUMax', 'vacwUMaxDay', 'vacwUTimeMax', 'vacwUTimeAvg',
+                         'vacwUDaysInQueue', 'vacwA', 'vacwAMax', 'vacwAMaxDay', 'vacATimeMax',
+                         'vacATimeAvg', 'vacwADaysInQueue', 'vacwATimeMax', 'vacwATimeAvg']
+
+
+def standard_graphs():
+    """(model_name, field_name, iteration, zone) graph_field_png arguments of every all iterations graph the Results
+    navigation links to: each field that isn't empty, by zone for the zone models like graph_field_by_zone."""
+    from Results.views import all_empty_fields  # Results.views imports the Simulation, which imports this module
+    zones = list(Zone.objects.values_list('name', flat=True))
+    graphs = []
+    for model in [DailyControls, DailyByProductionType, DailyByZone, DailyByZoneAndProductionType]:
+        empty_fields = all_empty_fields(model, GRAPH_EXCLUDED_FIELDS)
+        for field_name in model._meta.get_all_field_names():
+            if field_name in GRAPH_EXCLUDED_FIELDS or field_name in empty_fields:
+                continue
+            if model in [DailyByZone, DailyByZoneAndProductionType]:
+                graphs += [(model.__name__, field_name, '', zone) for zone in zones]
+            else:
+                graphs.append((model.__name__, field_name, '', ''))
+    return graphs
+
+
+prerender_fingerprint = None
+
+
+def initialize_prerender(fingerprint, testing=False):
+    global prerender_fingerprint
+    prerender_fingerprint = fingerprint
+    import django
+    django.setup()
+    if testing:
+        for database in settings.DATABASES:
+            settings.DATABASES[database]['NAME'] = settings.DATABASES[database]['TEST']['NAME'] if 'TEST' in settings.DATABASES[database] else settings.DATABASES[database]['TEST_NAME']
+    connections.close_all()  # the connections inherited from the parent process can't be shared
+
+
+def prerender_graph(arguments):
+    """Pool task: returns True if the graph was drawn into the graph cache"""
+    if results_fingerprint() != prerender_fingerprint:  # the output changed, a new run or it was deleted
+        return False
+    try:
+        graph_field_png(None, *arguments, store=True)
+    except Exception as error:  # one graph that can't be drawn shouldn't stop the rest
+        print("Couldn't pre-render %s:" % '/'.join(arguments), error)
+        return False
+    return True
+
+
+class GraphPrerenderer(multiprocessing.Process):
+    """Draws every standard_graphs() graph into the graph cache once a run is finished, on a pool of processes, so the
+    first look at any of them is instant.  The graphs in the cache are named by the results fingerprint, so if the
+    output changes underneath it the rest are skipped.  Started by Results.utils.prerender_graphs, stop() ends it
+    after the graphs being drawn."""
+    import django
+    django.setup()
+
+    testing = False
+
+    def __init__(self, processes=None, testing=False, **kwargs):
+        super(GraphPrerenderer, self).__init__(**kwargs)
+        self.processes = processes
+        self.testing = testing
+        self.stopped = multiprocessing.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        if self.testing:
+            for database in settings.DATABASES:
+                settings.DATABASES[database]['NAME'] = settings.DATABASES[database]['TEST']['NAME'] if 'TEST' in settings.DATABASES[database] else settings.DATABASES[database]['TEST_NAME']
+        start = time()
+        fingerprint = results_fingerprint()
+        graphs = standard_graphs()
+        connections.close_all()
+        pool = multiprocessing.Pool(self.processes, initializer=initialize_prerender, initargs=(fingerprint, self.testing))
+        drawn = 0
+        try:
+            for result in pool.imap_unordered(prerender_graph, graphs):
+                drawn += result
+                if self.stopped.is_set():
+                    pool.terminate()
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        print("Pre-rendered %i of %i graphs in %is" % (drawn, len(graphs), time() - start))
@@ -0,0 +1,320 @@
+import os
+import queue
+import time
+from array import array
+import multiprocessing
+from collections import defaultdict
+import psutil
+
+from django.conf import settings
+from django.db import transaction, close_old_connections, connections
+from django.utils import timezone
+
+from Results.models import DailyControls, DailyByZoneAndProductionType, DailyByProductionType, DailyByZone, ResultsVersion, IterationTiming, SimulationRun, insert_fields
+from Results.online_statistics import LastDayStatistics
+
+
+def set_pragma(setting, value, connection='default'):
+    from django.db import connections
+
+    cursor = connections[connection].cursor()
+    raw_sql = "PRAGMA {0} = {1}".format(setting, value)
+
+    cursor.execute(raw_sql)
+
+
+def process_is_alive(pid):
+    """False once the process has exited, even if its parent hasn't reaped it yet"""
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+class ResultsWriterGone(Exception):
+    pass
+
+
+def put_results(results_queue, message, writer_pid=None):
+    """results_queue.put() that raises ResultsWriterGone instead of blocking forever on a full queue once the process
+    at the other end, writer_pid, has died."""
+    while True:
+        try:
+            results_queue.put(message, timeout=settings.RESULTS_QUEUE_PUT_SECONDS)
+            return
+        except queue.Full:
+            if writer_pid is not None and not process_is_alive(writer_pid):
+                raise ResultsWriterGone("The results writer stopped before every iteration was written.")
+
+
+# Composite indexes for the graph, summary and table queries.  They are only built once a run has been ingested.  They
+# stand in for Django's own foreign key indexes too, drop_output_indexes drops those along with them.
+OUTPUT_INDEXES = [
+    (DailyControls, ['iteration', 'day']),
+    (DailyControls, ['last_day', 'iteration']),
+    (DailyByProductionType, ['iteration', 'day']),
+    (DailyByProductionType, ['production_type_id', 'iteration', 'day']),
+    (DailyByProductionType, ['last_day', 'production_type_id']),
+    (DailyByZone, ['iteration', 'day']),
+    (DailyByZone, ['zone_id', 'iteration', 'day']),
+    (DailyByZone, ['last_day', 'zone_id']),
+    (DailyByZoneAndProductionType, ['iteration', 'day']),
+    (DailyByZoneAndProductionType, ['production_type_id', 'zone_id', 'iteration', 'day']),
+    (DailyByZoneAndProductionType, ['zone_id']),
+    (DailyByZoneAndProductionType, ['last_day', 'production_type_id', 'zone_id']),
+]
+OUTPUT_TABLES = [DailyControls, DailyByProductionType, DailyByZone, DailyByZoneAndProductionType]
+
+
+def output_index_sql(using='scenario_db'):
+    """{index name: CREATE INDEX statement} for OUTPUT_INDEXES"""
+    quote_name = connections[using].ops.quote_name
+    statements = {}
+    for model, columns in OUTPUT_INDEXES:
+        name = "%s_%s" % (model._meta.db_table, '_'.join(columns))
+        statements[name] = "CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+            quote_name(name), quote_name(model._meta.db_table), ', '.join(quote_name(column) for column in columns))
+    return statements
+
+
+def existing_indexes(using='scenario_db', tables=None):
+    """Names of the indexes in the database, or only those on the given tables.  SQLite's own automatic indexes for
+    UNIQUE and PRIMARY KEY constraints have no sql and can't be dropped, they are left out."""
+    cursor = connections[using].cursor()
+    cursor.execute("SELECT name, tbl_name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL")
+    return {name for name, table in cursor.fetchall() if tables is None or table in tables}
+
+
+def output_indexes_missing(using='scenario_db'):
+    return connections[using].vendor == 'sqlite' and not set(output_index_sql(using)) <= existing_indexes(using)
+
+
+def drop_output_indexes(using='scenario_db'):
+    """Every row inserted has to update every index on its table, so bulk ingestion runs without them.  Drops every
+    index there is on the daily output tables.  Also speeds up delete_all_outputs."""
+    if connections[using].vendor != 'sqlite':
+        return
+    cursor = connections[using].cursor()
+    for name in existing_indexes(using, tables={model._meta.db_table for model in OUTPUT_TABLES}):
+        cursor.execute("DROP INDEX %s" % connections[using].ops.quote_name(name))
+
+
+def build_output_indexes(using='scenario_db'):
+    """Builds whichever output indexes are missing and refreshes the query planner statistics with ANALYZE.  Does
+    nothing if they are all there already.  This can take minutes on a large run, never call it from a request,
+    start an OutputIndexBuilder instead."""
+    if connections[using].vendor != 'sqlite':
+        return
+    cursor = connections[using].cursor()
+    existing = existing_indexes(using)
+    missing = [statement for name, statement in output_index_sql(using).items() if name not in existing]
+    for statement in missing:
+        cursor.execute(statement)
+    if missing:
+        for model in OUTPUT_TABLES:
+            cursor.execute("ANALYZE %s" % connections[using].ops.quote_name(model._meta.db_table))
+
+
+class OutputIndexBuilder(multiprocessing.Process):
+    """build_output_indexes in the background, for output written by a run that was aborted before it could build them"""
+    import django
+    django.setup()
+
+    testing = False
+
+    def __init__(self, testing=False, **kwargs):
+        super(OutputIndexBuilder, self).__init__(**kwargs)
+        self.testing = testing
+
+    def run(self):
+        if self.testing:
+            for database in settings.DATABASES:
+                settings.DATABASES[database]['NAME'] = settings.DATABASES[database]['TEST']['NAME'] if 'TEST' in settings.DATABASES[database] else settings.DATABASES[database]['TEST_NAME']
+        build_output_indexes()
+        close_old_connections()
+
+
+def insert_rows(model, rows, using='scenario_db'):
+    """Writes row tuples laid out by insert_fields(model).  On SQLite this is a single prepared executemany straight
+    into the table, which skips building a model instance and Django's per-field prep for every row.  Other database
+    engines fall back to bulk_create."""
+    if not rows:
+        return
+    fields = insert_fields(model)
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        quote_name = connection.ops.quote_name
+        raw_sql = "INSERT INTO {0} ({1}) VALUES ({2})".format(quote_name(model._meta.db_table),
+                                                             ', '.join(quote_name(field.column) for field in fields),
+                                                             ', '.join(['%s'] * len(fields)))
+        connection.cursor().executemany(raw_sql, rows)
+    else:
+        attnames = [field.attname for field in fields]
+        model.objects.using(using).bulk_create([model(**dict(zip(attnames, row))) for row in rows])
+
+
+class UnitStatsCounter(object):
+    """Per unit infected/zone focus/vaccinated/destroyed counters kept in compact arrays indexed by unit id.  Workers
+    fill one per iteration from the CEngine unit stats lines and the ResultsWriter sums them over everything in a
+    transaction, then applies them to Results_unitstats with a single executemany."""
+    fields = ['cumulative_infected', 'cumulative_zone_focus', 'cumulative_vaccinated', 'cumulative_destroyed']
+
+    def __init__(self):
+        self.counters = [array('I') for field in self.fields]
+        self.touched = set()
+
+    def add(self, unit, *counts):
+        if unit >= len(self.counters[0]):
+            for counter in self.counters:
+                counter.extend([0] * (unit + 1 - len(counter)))
+        for counter, count in zip(self.counters, counts):
+            counter[unit] += count
+        self.touched.add(unit)
+
+    def rows(self):
+        """(unit, infected, zone_focus, vaccinated, destroyed) for every unit that was counted"""
+        return [(unit,) + tuple(counter[unit] for counter in self.counters) for unit in sorted(self.touched)]
+
+    def apply(self, using='scenario_db'):
+        if not self.touched:
+            return
+        raw_sql = "UPDATE Results_unitstats SET " + ', '.join("{0}={0}+%s".format(field) for field in self.fields) + " WHERE unit_id=%s"
+        connections[using].cursor().executemany(raw_sql, [tuple(counter[unit] for counter in self.counters) + (unit,) for unit in sorted(self.touched)])
+
+
+class ResultsBuffer(object):
+    """Holds the parsed rows of one iteration inside a worker and streams them to the ResultsWriter every
+    SIMULATION_FLUSH_DAYS days, or sooner if SIMULATION_FLUSH_ROWS is reached.  Together with the bounded results queue
+    this keeps the memory of each worker flat no matter how many days an iteration runs."""
+    def __init__(self, results_queue, iteration_number, writer_pid=None):
+        self.results_queue = results_queue
+        self.iteration_number = iteration_number
+        self.writer_pid = writer_pid
+        self.rows = []
+        self.days = 0
+
+    def add_rows(self, rows):
+        self.rows.extend(rows)
+
+    def add_day(self, rows):
+        if rows:
+            self.add_rows(rows)
+            self.days += 1
+        if (settings.SIMULATION_FLUSH_DAYS and self.days >= settings.SIMULATION_FLUSH_DAYS) or len(self.rows) >= settings.SIMULATION_FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            put_results(self.results_queue, (self.iteration_number, self.rows), self.writer_pid)  # blocks while the writer is RESULTS_QUEUE_MAX_BATCHES behind
+        self.rows = []
+        self.days = 0
+
+
+class ResultsWriter(multiprocessing.Process):
+    """The only process that writes simulation results to the scenario_db.  Iteration workers parse the CEngine output
+    and put (iteration_number, [(table_name, row tuple)]) on the queue, one batch per ResultsBuffer flush.  The writer
+    drains everything that is waiting and commits it in one large transaction so that workers never block on the SQLite
+    write lock.  (iteration_number, None) throws away the rows already written for an iteration that was stopped.
+    An ('IterationTiming', row) in the last batch of an iteration is completed with the writer's own timings for it.
+    The LastDayStatistics of the run are updated from the last day rows as they go by.
+    Put None on the queue once every iteration has been queued to shut the writer down.  The writer is not a
+    SimulationProcessRecord, abort_simulation must never kill it in the middle of a transaction.  It shuts itself down
+    instead once the Simulation that started it is gone."""
+    import django
+    django.setup()
+
+    testing = False
+
+    def __init__(self, results_queue, testing=False, **kwargs):
+        super(ResultsWriter, self).__init__(**kwargs)
+        self.results_queue = results_queue
+        self.testing = testing
+        self.parent_pid = None
+
+    def next_message(self):
+        """Blocks until there is something to write.  Returns None, the same as a shut down, if the Simulation was
+        aborted while the writer was waiting."""
+        while True:
+            try:
+                return self.results_queue.get(timeout=settings.RESULTS_QUEUE_PUT_SECONDS)
+            except queue.Empty:
+                if not process_is_alive(self.parent_pid):
+                    print("Results writer stopped, the simulation is gone")
+                    return None
+
+    def run(self):
+        if self.testing:
+            for database in settings.DATABASES:
+                settings.DATABASES[database]['NAME'] = settings.DATABASES[database]['TEST']['NAME'] if 'TEST' in settings.DATABASES[database] else settings.DATABASES[database]['TEST_NAME']
+
+        self.parent_pid = os.getppid()
+        set_pragma("synchronous", "OFF", connection='scenario_db')  # the default rollback journal stays on disk, so a killed writer can't corrupt the scenario
+
+        write_totals = {}
+        statistics = LastDayStatistics.load()  # a resumed run carries on from the iterations that already finished
+        finished = False
+        while not finished:
+            batch = [self.next_message()]
+            rows = len(batch[-1][1] or []) if batch[-1] is not None else 0
+            while rows < settings.RESULTS_WRITER_BATCH_ROWS and None not in batch:
+                try:
+                    batch.append(self.results_queue.get_nowait())
+                except queue.Empty:
+                    break
+                if batch[-1] is not None:
+                    rows += len(batch[-1][1] or [])
+            finished = None in batch
+            self.write_batch([message for message in batch if message is not None], write_totals, statistics)
+        close_old_connections()
+
+    @staticmethod
+    def write_batch(batch, write_totals=None, statistics=None):
+        """write_totals carries the [write_seconds, lock_wait_seconds, rows_written] of each iteration across batches
+        until its IterationTiming row arrives.  Without statistics the stored LastDayStatistics are loaded and updated."""
+        if write_totals is None:
+            write_totals = {}
+        if statistics is None:
+            statistics = LastDayStatistics.load()
+        sorted_results = defaultdict(lambda: [])
+        unit_stats = UnitStatsCounter()
+        discarded = set()
+        timings = []
+        rows_per_iteration = defaultdict(int)
+        for iteration_number, results in batch:
+            if results is None:  # only what came before is thrown away, an iteration can be run again after this
+                discarded.add(iteration_number)
+                write_totals.pop(iteration_number, None)
+                rows_per_iteration.pop(iteration_number, None)
+                for model in [DailyControls, DailyByZoneAndProductionType, DailyByProductionType, DailyByZone]:  # iteration is their first column
+                    sorted_results[model.__name__] = [row for row in sorted_results[model.__name__] if row[0] != iteration_number]
+                continue
+            for table_name, row in results:
+                if table_name == 'IterationTiming':
+                    timings.append(row)
+                    continue
+                if table_name == 'UnitStats':
+                    unit_stats.add(*row)
+                else:
+                    sorted_results[table_name].append(row)
+                rows_per_iteration[iteration_number] += 1
+
+        start = time.perf_counter()
+        with transaction.atomic(using='scenario_db'):
+            for model in [DailyControls, DailyByZoneAndProductionType, DailyByProductionType, DailyByZone]:
+                model.objects.filter(iteration__in=discarded).delete()
+            for model in [DailyControls, DailyByZoneAndProductionType, DailyByProductionType, DailyByZone, ResultsVersion]:
+                insert_rows(model, sorted_results[model.__name__])
+                statistics.add_rows(model, sorted_results[model.__name__])
+            statistics.save()
+            unit_stats.apply()
+            SimulationRun.objects.all().update(last_written=timezone.now())  # changes the results fingerprint
+            written = time.perf_counter()
+        committed = time.perf_counter()
+
+        total_rows = sum(rows_per_iteration.values())
+        for iteration_number, rows in rows_per_iteration.items():
+            totals = write_totals.setdefault(iteration_number, [0.0, 0.0, 0])
+            totals[0] += (written - start) * rows / total_rows
+            totals[1] += (committed - written) * rows / total_rows
+            totals[2] += rows
+        insert_rows(IterationTiming, [tuple(row) + tuple(write_totals.pop(row[0], (0.0, 0.0, 0))) for row in timings])
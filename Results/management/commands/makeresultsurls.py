@@ -35,12 +35,14 @@ class Command(BaseCommand):
         urlpatterns = self.generate_urls_from_models(os.path.join(settings.BASE_DIR, 'Results','models.py'),
                                                      ["url('^$', 'Results.views.results_home')",
                                                       "url('^RunSimulation/$', 'Results.views.run_simulation')",
+                                                      "url('^ResumeSimulation/$', 'Results.views.resume_simulation')",
                                                       "url('^Population\.png$', 'Results.graphing.population_png')",
                                                       "url('^population_d3_map/$', 'Results.interactive_graphing.population_d3_map')",
                                                       "url('^population_thumbnail\.png$', 'Results.interactive_graphing.population_thumbnail_png')",
                                                       "url('^population_zoom\.png$', 'Results.interactive_graphing.population_zoom_png')",
                                                       "url('^(?P<model_name>\w+)/(?P<field_name>\w+)/(?P<iteration>\d*)/?$', 'Results.views.graph_field')",  # optional iteration argument
                                                       "url('^(?P<model_name>\w+)/(?P<field_name>\w+)/(?P<iteration>\d*)/?(?P<zone>[^/]*)/?Graph\.png$', 'Results.graphing.graph_field_png')",
+                                                      "url('^(?P<model_name>\w+)/(?P<field_name>\w+)/(?P<iteration>\d*)/?(?P<zone>[^/]*)/?Graph\.json$', 'Results.graphing.graph_field_json')",  # ?width= in pixels
                                                       "url('^Inputs/$', 'Results.views.back_to_inputs')",
                                                       "url('^simulation_status.json$', 'Results.views.simulation_status')",
                                                       "url('^abort_simulation$', 'Results.utils.abort_simulation')",
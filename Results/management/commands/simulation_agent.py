@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Results.distribution import SimulationAgent
+
+
+class Command(BaseCommand):
+    """Lends this machine's processors to a Simulation running on another ADSM installation that has
+    SIMULATION_AGENT_ADDRESS set.  Both need the same SIMULATION_AGENT_AUTHKEY.  Several agents can be started on one
+    machine, each one takes as many iterations at a time as it has processes."""
+    args = '<host:port>'
+    help = "Run the simulation iterations leased out by the coordinator at host:port"
+    option_list = BaseCommand.option_list + (
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=None,
+                    help="Iterations to run at the same time, defaults to the number of cores less one"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or ':' not in args[0]:
+            raise CommandError("Usage: simulation_agent %s" % self.args)
+        host, port = args[0].rsplit(':', 1)
+        print("Connecting to the simulation coordinator at %s:%s" % (host, port))
+        SimulationAgent((host, int(port)), options['processes']).run()
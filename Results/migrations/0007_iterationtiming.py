@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Results', '0006_simulationrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IterationTiming',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True, auto_created=True, verbose_name='ID')),
+                ('iteration', models.IntegerField(help_text='The iteration these timings were measured for.')),
+                ('engine_cpu_seconds', models.FloatField(blank=True, null=True, help_text='CPU time used by the CEngine process.')),
+                ('stdout_wait_seconds', models.FloatField(help_text='Time the worker spent waiting on the CEngine for its next line of output.')),
+                ('parse_seconds', models.FloatField(help_text='Time the worker spent parsing the CEngine output.')),
+                ('write_seconds', models.FloatField(help_text='Time the ResultsWriter spent inserting the rows of this iteration.')),
+                ('lock_wait_seconds', models.FloatField(help_text='Time the ResultsWriter spent committing, which is mostly waiting on the SQLite lock.')),
+                ('rows_written', models.IntegerField(help_text='Number of output rows written for this iteration, including UnitStats updates.')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ScenarioCreator', '0050_auto_20190821_2256'),
+        ('Results', '0007_iterationtiming'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LastDayStatistic',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True, auto_created=True, verbose_name='ID')),
+                ('table', models.CharField(max_length=255)),
+                ('field_name', models.CharField(max_length=255)),
+                ('count', models.IntegerField(default=0)),
+                ('mean', models.FloatField(default=0)),
+                ('sum_of_squares', models.FloatField(default=0, help_text='Sum of the squared differences from the mean.')),
+                ('low', models.FloatField(blank=True, null=True)),
+                ('high', models.FloatField(blank=True, null=True)),
+                ('centroids', models.TextField(default='[]', help_text='JSON [mean, weight] pairs of the quantile sketch.')),
+                ('zone', models.ForeignKey(help_text='The zone for DailyByZone fields, empty for the Background zone and every other table.', blank=True, null=True, to='ScenarioCreator.Zone')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Results', '0008_lastdaystatistic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simulationrun',
+            name='stopped_after',
+            field=models.PositiveIntegerField(blank=True, null=True, help_text='Set when the stopping rule ended the run early: the highest iteration number that was started.'),
+        ),
+        migrations.AddField(
+            model_name='simulationrun',
+            name='convergence',
+            field=models.TextField(blank=True, default='', help_text='JSON evidence of the stopping rule: each convergence field as of the check that stopped the run, or the end of the run.'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Results', '0009_simulationrun_convergence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simulationrun',
+            name='last_written',
+            field=models.DateTimeField(blank=True, null=True, help_text='When the ResultsWriter last committed output for this run.'),
+        ),
+        migrations.CreateModel(
+            name='ResultsCache',
+            fields=[
+                ('id', models.AutoField(serialize=False, primary_key=True, auto_created=True, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('fingerprint', models.CharField(max_length=255, help_text='Results fingerprint of the output the value was computed from.')),
+                ('value', models.TextField(default='null', help_text='JSON')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
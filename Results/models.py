@@ -389,5 +389,82 @@ class ResultsVersion(OutputBaseModel):
             return 'No simulation version stored in this result set'
 
 
+class SimulationRun(OutputBaseModel):
+    """Manifest for the current set of output so that an aborted or interrupted run can be resumed.  Which iterations
+    finished is journaled by their last_day rows, which the ResultsWriter commits in the same transaction as their
+    UnitStats.  There's a single copy of this model per set of output."""
+    iterations = models.PositiveIntegerField(
+        help_text='The number of iterations requested when the run was started.', )
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True,
+        help_text='Set once every iteration has been written.  Empty while running or after an abort.', )
+    times_resumed = models.PositiveIntegerField(default=0)
+    stopped_after = models.PositiveIntegerField(blank=True, null=True,
+        help_text='Set when the stopping rule ended the run early: the highest iteration number that was started.', )
+    convergence = models.TextField(blank=True, default='',
+        help_text='JSON evidence of the stopping rule: each convergence field as of the check that stopped the run, or the end of the run.', )
+    last_written = models.DateTimeField(blank=True, null=True,
+        help_text='When the ResultsWriter last committed output for this run.', )
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        self.id=1
+        return super(SimulationRun, self).save(force_insert, force_update, using, update_fields)
+
+
+class IterationTiming(OutputBaseModel):
+    """Where the time of each finished iteration went, to tell whether a slow run is bound by the CEngine, the parser or
+    SQLite.  The engine, stdout and parse times are measured in the worker, the write times and row count by the
+    ResultsWriter which splits each transaction between the iterations in it by their share of the rows."""
+    iteration = models.IntegerField(
+        help_text='The iteration these timings were measured for.', )
+    engine_cpu_seconds = models.FloatField(blank=True, null=True,
+        help_text='CPU time used by the CEngine process.', )
+    stdout_wait_seconds = models.FloatField(
+        help_text='Time the worker spent waiting on the CEngine for its next line of output.', )
+    parse_seconds = models.FloatField(
+        help_text='Time the worker spent parsing the CEngine output.', )
+    write_seconds = models.FloatField(
+        help_text='Time the ResultsWriter spent inserting the rows of this iteration.', )
+    lock_wait_seconds = models.FloatField(
+        help_text='Time the ResultsWriter spent committing, which is mostly waiting on the SQLite lock.', )
+    rows_written = models.IntegerField(
+        help_text='Number of output rows written for this iteration, including UnitStats updates.', )
+
+
+class LastDayStatistic(OutputBaseModel):
+    """Running statistics of one field over the last day of every finished iteration.  The ResultsWriter keeps these up
+    to date in the same transaction as the rows so that the summary and Summary.csv don't have to scan the output.
+    See Results.online_statistics."""
+    table = models.CharField(max_length=255)
+    zone = models.ForeignKey(Zone, blank=True, null=True,
+        help_text='The zone for DailyByZone fields, empty for the Background zone and every other table.', )
+    field_name = models.CharField(max_length=255)
+    count = models.IntegerField(default=0)
+    mean = models.FloatField(default=0)
+    sum_of_squares = models.FloatField(default=0,
+        help_text='Sum of the squared differences from the mean.', )
+    low = models.FloatField(blank=True, null=True)
+    high = models.FloatField(blank=True, null=True)
+    centroids = models.TextField(default='[]',
+        help_text='JSON [mean, weight] pairs of the quantile sketch.', )
+
+
+class ResultsCache(OutputBaseModel):
+    """Something computed from the output, such as the results summary, kept until the output changes.  See
+    Results.results_cache."""
+    key = models.CharField(max_length=255, unique=True)
+    fingerprint = models.CharField(max_length=255,
+        help_text='Results fingerprint of the output the value was computed from.', )
+    value = models.TextField(default='null',
+        help_text='JSON', )
+
+
 def outputs_exist():
-    return DailyControls.objects.count() > 0
\ No newline at end of file
+    return DailyControls.objects.count() > 0
+
+
+def insert_fields(model):
+    """The concrete fields of an output table in the order DailyParser lays out its row tuples and the ResultsWriter
+    lists its INSERT columns.  The auto primary key is left to the database, except for the ResultsVersion singleton
+    which is always id=1."""
+    return [field for field in model._meta.concrete_fields if not field.primary_key or model is ResultsVersion]
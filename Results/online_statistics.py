@@ -0,0 +1,209 @@
+"""Summary statistics of the last day of every iteration, accumulated by the ResultsWriter while it ingests the results
+so that results_home and Summary.csv never have to scan the output tables.  Every field keeps an exact count, mean,
+variance (Welford), min and max along with a mergeable quantile sketch for the medians and percentiles."""
+import json
+from math import sqrt
+
+from django.db import models, connections
+
+from Results.models import DailyByProductionType, DailyByZone, DailyControls, LastDayStatistic, insert_fields
+
+
+class QuantileSketch(object):
+    """A mergeable centroid sketch in the manner of Dunning's t-digest.  Values are kept exactly until there are more
+    than exact_limit of them, after which neighbouring centroids are merged, more aggressively toward the median than
+    in the tails.  Quantiles interpolate linearly between centroids the same way numpy.percentile does between sorted
+    values, so the result is identical to numpy.percentile while the sketch is still exact."""
+    compression = 200
+    exact_limit = 1000
+
+    def __init__(self, centroids=()):
+        self.centroids = [list(centroid) for centroid in centroids]  # [mean, weight]
+        self.unsorted = True
+
+    def add(self, value, weight=1):
+        self.centroids.append([value, weight])
+        self.unsorted = True
+        if len(self.centroids) > self.exact_limit:
+            self.compress()
+
+    def merge(self, other):
+        self.centroids.extend(list(centroid) for centroid in other.centroids)
+        self.unsorted = True
+        if len(self.centroids) > self.exact_limit:
+            self.compress()
+
+    def count(self):
+        return sum(weight for mean, weight in self.centroids)
+
+    def sort(self):
+        if self.unsorted:
+            self.centroids.sort()
+            self.unsorted = False
+
+    def compress(self):
+        self.sort()
+        total = self.count()
+        merged = [list(self.centroids[0])]
+        seen = 0
+        for mean, weight in self.centroids[1:]:
+            last = merged[-1]
+            q = (seen + last[1] + weight / 2) / total
+            if last[1] + weight <= max(1, 4 * total * q * (1 - q) / self.compression):
+                last[0] += (mean - last[0]) * weight / (last[1] + weight)
+                last[1] += weight
+            else:
+                seen += last[1]
+                merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q):
+        """q between 0 and 1.  Each centroid stands at the middle of the ranks it covers."""
+        if not self.centroids:
+            return None
+        self.sort()
+        target = q * (self.count() - 1)
+        seen = 0
+        previous = None
+        for mean, weight in self.centroids:
+            rank = seen + (weight - 1) / 2
+            if rank >= target:
+                if previous is None or rank == previous[1]:
+                    return mean
+                fraction = (target - previous[1]) / (rank - previous[1])
+                return previous[0] + (mean - previous[0]) * fraction
+            previous = (mean, rank)
+            seen += weight
+        return self.centroids[-1][0]
+
+    def percentile(self, p):
+        return self.quantile(p / 100)
+
+
+class RunningStatistics(object):
+    """Exact count, mean, population variance, min and max of one field plus a QuantileSketch of its values"""
+    def __init__(self, count=0, mean=0.0, sum_of_squares=0.0, low=None, high=None, sketch=None):
+        self.count = count
+        self.mean = mean
+        self.sum_of_squares = sum_of_squares  # Welford's M2, the sum of squared differences from the mean
+        self.low = low
+        self.high = high
+        self.sketch = sketch or QuantileSketch()
+
+    def add(self, value):
+        if value is None:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.sum_of_squares += delta * (value - self.mean)
+        self.low = value if self.low is None else min(self.low, value)
+        self.high = value if self.high is None else max(self.high, value)
+        self.sketch.add(value)
+
+    def merge(self, other):
+        """Chan's parallel form of Welford, for statistics accumulated separately"""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.sum_of_squares += other.sum_of_squares + delta * delta * self.count * other.count / count
+        self.count = count
+        self.low = other.low if self.low is None else min(self.low, other.low)
+        self.high = other.high if self.high is None else max(self.high, other.high)
+        self.sketch.merge(other.sketch)
+
+    def variance(self):
+        return self.sum_of_squares / self.count if self.count else None
+
+    def std_dev(self):
+        return sqrt(self.variance()) if self.count else None
+
+    def median(self):
+        return self.sketch.quantile(0.5)
+
+    def percentile(self, p):
+        return self.sketch.percentile(p)
+
+
+class LastDayStatistics(object):
+    """RunningStatistics for every numeric field of the last day rows that results are summarized from: the "All"
+    production types rows of DailyByProductionType, DailyControls and DailyByZone for each zone.  Keyed by
+    (table name, zone_id, field name)."""
+    tracked_tables = [DailyByProductionType, DailyControls, DailyByZone]
+
+    def __init__(self):
+        self.fields = {}
+        self.changed = set()  # keys added to since the last save
+        self.stored = set()  # keys that already have a LastDayStatistic row
+
+    @staticmethod
+    def layout(model):
+        """(last_day position, production_type_id position, zone_id position, [(position, field name)]) of a row tuple"""
+        attnames = [field.attname for field in insert_fields(model)]
+        numeric = [(position, field.name) for position, field in enumerate(insert_fields(model))
+                   if isinstance(field, (models.IntegerField, models.FloatField)) and field.name not in ('iteration', 'day')]
+        position = lambda attname: attnames.index(attname) if attname in attnames else None
+        return position('last_day'), position('production_type_id'), position('zone_id'), numeric
+
+    def add_rows(self, model, rows):
+        """Takes the row tuples of a ResultsWriter batch, anything that isn't a tracked last day row is skipped."""
+        if model not in self.tracked_tables or not rows:
+            return
+        last_day, production_type, zone, numeric = self.layout(model)
+        for row in rows:
+            if not row[last_day] or (production_type is not None and row[production_type] is not None):
+                continue
+            zone_id = row[zone] if zone is not None else None
+            for position, field_name in numeric:
+                if row[position] is None:
+                    continue
+                key = (model.__name__, zone_id, field_name)
+                if key not in self.fields:
+                    self.fields[key] = RunningStatistics()
+                self.fields[key].add(row[position])
+                self.changed.add(key)
+
+    def get(self, model, field_name, zone_id=None):
+        """RunningStatistics of the field, or None if nothing was accumulated for it"""
+        return self.fields.get((model.__name__, zone_id, field_name))
+
+    @classmethod
+    def load(cls, using='scenario_db', field_names=None):
+        """field_names limits what is loaded to those fields, in any table"""
+        statistics = cls()
+        tables = {model.__name__: model for model in cls.tracked_tables}
+        entries = LastDayStatistic.objects.using(using).all()
+        if field_names is not None:
+            entries = entries.filter(field_name__in=field_names)
+        for entry in entries:
+            low, high = entry.low, entry.high
+            if entry.count and isinstance(tables[entry.table]._meta.get_field(entry.field_name), models.IntegerField):
+                low, high = int(low), int(high)  # stored as REAL
+            statistics.fields[(entry.table, entry.zone_id, entry.field_name)] = RunningStatistics(
+                entry.count, entry.mean, entry.sum_of_squares, low, high, QuantileSketch(json.loads(entry.centroids)))
+            statistics.stored.add((entry.table, entry.zone_id, entry.field_name))
+        return statistics
+
+    def save(self, using='scenario_db'):
+        """Stores the fields that were added to since the last save, the rest of the stored statistics are left alone.
+        Call inside the transaction that wrote the rows they were accumulated from."""
+        if not self.changed:
+            return
+        values = lambda field: (field.count, field.mean, field.sum_of_squares, field.low, field.high, json.dumps(field.sketch.centroids))
+        updated = [key for key in self.changed if key in self.stored]
+        if updated:
+            connection = connections[using]
+            quote_name = connection.ops.quote_name
+            raw_sql = "UPDATE {0} SET count=%s, mean=%s, sum_of_squares=%s, low=%s, high=%s, centroids=%s WHERE {1}=%s AND zone_id IS %s AND field_name=%s".format(
+                quote_name(LastDayStatistic._meta.db_table), quote_name('table'))
+            connection.cursor().executemany(raw_sql, [values(self.fields[key]) + key for key in updated])
+        created = [key for key in self.changed if key not in self.stored]
+        LastDayStatistic.objects.using(using).bulk_create([
+            LastDayStatistic(table=table, zone_id=zone_id, field_name=field_name, count=field.count, mean=field.mean,
+                             sum_of_squares=field.sum_of_squares, low=field.low, high=field.high,
+                             centroids=json.dumps(field.sketch.centroids))
+            for (table, zone_id, field_name), field in ((key, self.fields[key]) for key in created)])
+        self.stored.update(created)
+        self.changed = set()
@@ -1,7 +1,9 @@
 import re
-from django.db import connections
+from django.db import models
+
 import Results.models
 from ADSMSettings.utils import scenario_filename
+from Results.ingestion import UnitStatsCounter
 
 
 def camel_case_spaces(name_with_spaces):
@@ -12,14 +14,24 @@ def camel_case_spaces(name_with_spaces):
     return r
 
 
-def number(string):
+def whole_number(string):
+    """int() that also takes a whole number written as a float, like 3.0"""
     try:
         return int(string)
-    except:
-        try:
-            return float(string)
-        except:
-            return -1
+    except ValueError:
+        value = float(string)
+        if not value.is_integer():
+            raise ValueError("%s is not a whole number" % string)
+        return int(value)
+
+
+def column_converter(model_field):
+    """The function that converts a CEngine cell for the model field it populates"""
+    if isinstance(model_field, models.IntegerField):
+        return whole_number
+    if isinstance(model_field, models.FloatField):
+        return float
+    return str
 
 
 def build_composite_field_map( table):
@@ -32,6 +44,9 @@ def build_composite_field_map( table):
 
 
 class DailyParser(object):
+    daily_tables = ["DailyByProductionType", "DailyByZone", "DailyByZoneAndProductionType", "DailyControls"]
+    selector_columns = ['Run', 'Day', 'versionMajor', 'versionMinor', 'versionRelease']
+
     def __init__(self, header_line, production_types, zones):
         self.production_types = production_types
         self.zones = zones
@@ -39,137 +54,168 @@ class DailyParser(object):
         self.possible_zones = {x[1] for x in zones}.union({'Background'})
         self.possible_pts = {x[1] for x in production_types}.union({''})
         self.failures = set()
-
-    def populate_tables_with_matching_fields(self, model_class_name, instance_dict, sparse_info):
-        """Populates all combinations of a particular table in one go.  This method must be called once for each
-        model class that you want populated.
-        model_class_name: named of table defined in Results.models
-        instance_dict: a dictionary containing one instance of every combination of parameters.  Keys are the "suffix" e.g. _Bull_HighRisk
-        sparse_info: Dictionary containing all the key, value pairs that the simulation put out
-        field_map: Keys are all column names to match to (prefix only), values are exact field name in that model.  The distinction allows
-            the program to map multiple columns onto the same field.  There are some special cases where column name is not exactly field + suffix.
-        """
-        field_map = build_composite_field_map(getattr(Results.models, model_class_name)() )  # creates a table instance
-        keys_to_delete = []
-        for suffix_key, instance in instance_dict.items():  # For each combination: DailyByZoneAndProductionType with (Bull_HighRisk), (Swine_MediumRisk), etc.
-            instance_needed = False
-            for column_name, model_field in field_map.items():
-                if column_name + suffix_key in sparse_info:
-                    setattr(instance, model_field, sparse_info[column_name + suffix_key])
-                    instance_needed = True
-                    try:
-                        self.failures.remove(column_name + suffix_key)
-                    except KeyError:
-                        print('Error: Column was assigned twice.  Second copy in %s.%s for output column %s.' % (model_class_name, model_field, column_name + suffix_key))
-                else:
-                    pass  # It's okay for the model to specify a field that the C Engine doesn't output.  No harm done
-            if not instance_needed:
-                keys_to_delete.append(suffix_key)
-        for suffix_key in keys_to_delete:
-            del instance_dict[suffix_key] 
-        return [instance for key, instance in instance_dict.items()]
-
-    def construct_combinatorial_instances(self, day, iteration, last_line):
-        """This constructs a mapping between the name of the column 'suffix' for example: 'BackgroundCattle' and maps it
-        to the appropriate Django query settings to grab the matching model instance.  For 'BackgroundCattle' the query
-        should be `DailyByZoneAndProductionType(production_type__name=Cattle, zone=None, ...`.
+        self.reset()
+        self.compile_routing_table()
+
+    def reset(self):
+        """Starts a new iteration with the routing already compiled for this header"""
+        self.malformed = {}  # column name: [count, first value]
+        self.unit_stats = UnitStatsCounter()
+
+    def construct_combinatorial_slots(self):
+        """This constructs a mapping between the name of the column 'suffix' for example: 'BackgroundCattle' and the
+        selector values of the row it belongs to.  For 'BackgroundCattle' the row should be
+        `DailyByZoneAndProductionType(production_type_id=Cattle.id, zone=None, ...`.
         This handles the special blank case for both "All ProductionType" = '' and "Background Zone" = None.
-        
-        It returns a dict which is the collection of all the model instances which will need to be populated each day:
+
+        It returns a dict {table_name: {suffix: selector kwargs}} covering every row that could be populated each day:
         1 DailyControls
         1*pt DailyByProductionType
         zones*pt DailyByZoneAndProductionType
         zones*1 DailyByZone
         """
-        daily_instances = {table_name:{} for table_name in ["DailyByProductionType", "DailyByZone", "DailyByZoneAndProductionType", "DailyControls"]}
-
-        daily_by_pt = daily_instances["DailyByProductionType"]
+        pt_ids = {name: pk for pk, name in self.production_types}
+        zone_ids = {name: pk for pk, name in self.zones}
+        slots = {table_name: {} for table_name in self.daily_tables}
         for pt_name in self.possible_pts:
-            try:
-                pt = [x[0] for x in self.production_types if x[1] == pt_name][0]
-            except IndexError:
-                pt = None
-            daily_by_pt[camel_case_spaces(pt_name)] = \
-                Results.models.DailyByProductionType(production_type_id=pt, iteration=iteration, day=day, last_day=last_line)
-
-        daily_instances["DailyByZone"] = {}
+            slots["DailyByProductionType"][camel_case_spaces(pt_name)] = {'production_type_id': pt_ids.get(pt_name)}
         for zone_name in self.possible_zones:
-            try:
-                zone = [x[0] for x in self.zones if x[1] == zone_name][0]
-            except IndexError:
-                zone = None
-            instance = Results.models.DailyByZone(zone_id=zone, iteration=iteration, day=day, last_day=last_line)
-            daily_instances["DailyByZone"][camel_case_spaces(zone_name)] = instance
-
-        daily_by_pt_zone = daily_instances["DailyByZoneAndProductionType"]
+            slots["DailyByZone"][camel_case_spaces(zone_name)] = {'zone_id': zone_ids.get(zone_name)}
         for pt_name in self.possible_pts:
-            try:
-                pt = [x[0] for x in self.production_types if x[1] == pt_name][0]
-            except IndexError:
-                pt = None
             for zone_name in self.possible_zones:
-                try:
-                    zone = [x[0] for x in self.zones if x[1] == zone_name][0]
-                except IndexError:
-                    zone = None
-                daily_by_pt_zone[camel_case_spaces(zone_name) + camel_case_spaces(pt_name)] = \
-                    Results.models.DailyByZoneAndProductionType(production_type_id=pt, zone_id=zone, iteration=iteration, day=day, last_day=last_line)
-
-        daily_instances["DailyControls"] = {'': Results.models.DailyControls(iteration=iteration, day=day, last_day=last_line)}  # there's only one of these
-        return daily_instances
-
-    def populate_db_from_daily_report(self, sparse_info, last_line):
-        """Parses the C Engine stdout and populates the appropriate models with the information.  Takes one line
-        at a time, representing one DailyReport."""
-        assert isinstance(sparse_info, dict)
-        # sparse_info = literal_eval(report.sparse_dict)
-        # print(sparse_info)
-        try:
-            iteration = sparse_info['Run']
-            del sparse_info['Run']
-            day = sparse_info['Day']
-            del sparse_info['Day']
-            del sparse_info['versionMajor']
-            del sparse_info['versionMinor']
-            del sparse_info['versionRelease']
-            scenario_name = scenario_filename()
-            if last_line:
-                print("%s - Finished Iteration %i:  %i Days" % (scenario_name, iteration, day))
-        except:
-            return []
-        self.failures = set(sparse_info.keys())  # whatever is left is a failure
-
-        #construct the set of tables we're going to use for this day
-        daily_instances = self.construct_combinatorial_instances(day, iteration, last_line)
-
-        results = []
-        for class_name in daily_instances:
-            result = self.populate_tables_with_matching_fields(class_name, daily_instances[class_name], sparse_info)  # there was a lot of preamble to get this line to work
-            results.extend(result)
-
-        if len(self.failures) and day == 1:
+                slots["DailyByZoneAndProductionType"][camel_case_spaces(zone_name) + camel_case_spaces(pt_name)] = \
+                    {'production_type_id': pt_ids.get(pt_name), 'zone_id': zone_ids.get(zone_name)}
+        slots["DailyControls"] = {'': {}}  # there's only one of these
+        return slots
+
+    def compile_routing_table(self):
+        """Matches every CEngine header column to the (table, row slot, field) it populates.  This is done once per
+        header so that each day line can be parsed by walking self.routing instead of probing every field + suffix
+        combination of every table.
+        self.slots: list of (table_name, template row, (iteration, day, last_day) positions), one per output row that
+            will be created each day.  Rows follow Results.models.insert_fields(table) with the selectors filled in.
+        self.routing: list of (column_index, slot_index, position of the field in the row)
+        The distinction between column name and field name allows the program to map multiple columns onto the same
+        field.  It's okay for the model to specify a field that the C Engine doesn't output.  No harm done."""
+        self.layouts = {table_name: [field.attname for field in Results.models.insert_fields(getattr(Results.models, table_name))]
+                        for table_name in self.daily_tables + ['ResultsVersion']}
+        column_routes = {}  # column name: [(table_name, suffix, field)]
+        slots_by_table = self.construct_combinatorial_slots()
+        for table_name in self.daily_tables:
+            field_map = build_composite_field_map(getattr(Results.models, table_name)())  # creates a table instance
+            for suffix_key in slots_by_table[table_name]:
+                for column_name, model_field in field_map.items():
+                    if model_field in self.layouts[table_name]:  # the primary key is never an output column
+                        column_routes.setdefault(column_name + suffix_key, []).append((table_name, suffix_key, model_field))
+
+        self.header_index = {column: index for index, column in enumerate(self.headers)}
+        matched_columns = []
+        for index, column in enumerate(self.headers):
+            if column in self.selector_columns:
+                continue
+            routes = column_routes.get(column)
+            if not routes:
+                self.failures.add(column)
+                continue
+            if len(routes) > 1:
+                print('Error: Column was assigned twice.  Output column %s matches %s.' % (column, ', '.join('%s.%s' % (t, f) for t, s, f in routes)))
+            matched_columns.append((index, routes))
+
+        used_slots = {(table_name, suffix_key) for index, routes in matched_columns for table_name, suffix_key, field in routes}
+        slot_keys = [(table_name, suffix_key) for table_name in self.daily_tables for suffix_key in slots_by_table[table_name]
+                     if (table_name, suffix_key) in used_slots]  # only rows that have at least one column get created
+        slot_indices = {key: slot_index for slot_index, key in enumerate(slot_keys)}
+        self.slots = []
+        for table_name, suffix_key in slot_keys:
+            layout = self.layouts[table_name]
+            template = [None] * len(layout)
+            for attname, value in slots_by_table[table_name][suffix_key].items():
+                template[layout.index(attname)] = value
+            self.slots.append((table_name, template, (layout.index('iteration'), layout.index('day'), layout.index('last_day'))))
+        self.routing = [(index, slot_indices[(table_name, suffix_key)], self.layouts[table_name].index(model_field))
+                        for index, routes in matched_columns for table_name, suffix_key, model_field in routes]
+        self.compile_converters(matched_columns)
+        if self.failures:
             print('Unable to match columns: ', len(self.failures), sorted(self.failures))
-        return results
 
-    def parse_daily_strings(self, cmd_string, last_line=False, create_version_entry=False):
+    def compile_converters(self, matched_columns):
+        """self.converters: one function per header column that converts its cells to the type of the model field it
+        populates.  Run and Day are whole numbers, the version and any unmatched column are left as strings."""
+        self.converters = [str] * len(self.headers)
+        for column in ['Run', 'Day']:
+            if column in self.header_index:
+                self.converters[self.header_index[column]] = whole_number
+        for index, routes in matched_columns:
+            table_name, suffix_key, model_field = routes[0]
+            self.converters[index] = column_converter(getattr(Results.models, table_name)._meta.get_field(model_field))
+
+    def convert_line(self, cells):
+        """Converts a whole day line at once.  Only a line that fails goes through cell by cell: blank cells become None
+        and so does any cell that isn't the type of its column, which is counted in self.malformed and printed the first
+        time it happens in each column."""
+        try:
+            return [convert(cell) for convert, cell in zip(self.converters, cells)]
+        except ValueError:
+            pass
+        values = []
+        for column, convert, cell in zip(self.headers, self.converters, cells):
+            try:
+                values.append(convert(cell))
+            except ValueError:
+                values.append(None)
+                if cell.strip():
+                    if column not in self.malformed:
+                        self.malformed[column] = [0, cell]
+                        print("Malformed value %r in column %s, it was stored as blank" % (cell, column))
+                    self.malformed[column][0] += 1
+        return values
+
+    def build_daily_rows(self, values, last_line):
+        """Parses the C Engine stdout into row tuples for the ResultsWriter.  Takes one line at a time, representing one
+        DailyReport, already split into values in header order.  Returns [(table_name, row)] where each row follows
+        Results.models.insert_fields(table)."""
+        try:
+            iteration = values[self.header_index['Run']]
+            day = values[self.header_index['Day']]
+        except (KeyError, IndexError):
+            return []
+        if iteration is None or day is None:
+            return []
+        if not all(column in self.header_index for column in self.selector_columns):
+            return []
+        if last_line:
+            print("%s - Finished Iteration %i:  %i Days" % (scenario_filename(), iteration, day))
+
+        rows = []
+        for table_name, template, (iteration_position, day_position, last_day_position) in self.slots:
+            row = list(template)
+            row[iteration_position], row[day_position], row[last_day_position] = iteration, day, last_line
+            rows.append(row)
+        for column_index, slot_index, position in self.routing:
+            rows[slot_index][position] = values[column_index]
+        return [(slot[0], tuple(row)) for slot, row in zip(self.slots, rows)]
+
+    def parse_daily_rows(self, cmd_string, last_line=False, create_version_entry=False):
         results = []
         if cmd_string:
-            values = cmd_string.split(',')
+            values = self.convert_line(cmd_string.split(','))
             if len(values):
-                pairs = zip(self.headers, values)
-                sparse_values = {a: number(b) for a, b in pairs}
+                values.extend([None] * (len(self.headers) - len(values)))  # short lines leave the remaining fields blank
                 if create_version_entry:
-                    version = Results.models.ResultsVersion()
-                    version.versionMajor = sparse_values['versionMajor']
-                    version.versionMinor = sparse_values['versionMinor']
-                    version.versionRelease = sparse_values['versionRelease']
-                    version.id = 1
-                    results.extend([version])
-                results.extend(self.populate_db_from_daily_report(sparse_values, last_line))
+                    results.append(('ResultsVersion', (1, values[self.header_index['versionMajor']],
+                                                       values[self.header_index['versionMinor']],
+                                                       values[self.header_index['versionRelease']])))
+                results.extend(self.build_daily_rows(values, last_line))
         return results
 
-    @staticmethod
-    def parse_unit_stats_string(cmd_string):
+    def parse_daily_strings(self, cmd_string, last_line=False, create_version_entry=False):
+        """Same as parse_daily_rows, but returns unsaved model instances instead of row tuples."""
+        return [getattr(Results.models, table_name)(**dict(zip(self.layouts[table_name], row)))
+                for table_name, row in self.parse_daily_rows(cmd_string, last_line, create_version_entry)]
+
+    def parse_unit_stats_string(self, cmd_string):
+        """Counts one CEngine unit stats line into self.unit_stats.  Nothing is written to the database here, the
+        counters are sent to the ResultsWriter with the rest of the iteration."""
         values = []
         for substring in cmd_string.split(','):
             try:
@@ -179,17 +225,6 @@ class DailyParser(object):
         if len(values) == 5 and (values[1] or values[2] or values[3] or values[4]):
             unit = values[0]
             was_infected, was_zone_focus, was_vaccinated, was_destroyed = values[1], values[2], values[3], values[4]
-            command = 'UPDATE Results_unitstats ' \
-                      ' SET cumulative_infected=cumulative_infected+%i,' \
-                      ' cumulative_zone_focus=cumulative_zone_focus+%i,' \
-                      ' cumulative_vaccinated=cumulative_vaccinated+%i,' \
-                      ' cumulative_destroyed=cumulative_destroyed+%i' \
-                      ' WHERE unit_id=%i' % (1 if was_infected else 0, 1 if was_zone_focus else 0, 1 if was_vaccinated else 0, 1 if was_destroyed else 0, unit)
-            try:
-                cursor = connections['scenario_db'].cursor()
-                cursor.execute(command)
-
-                return True
-            except BaseException as e:
-                print("Command Failure", e, command)
+            self.unit_stats.add(unit, 1 if was_infected else 0, 1 if was_zone_focus else 0, 1 if was_vaccinated else 0, 1 if was_destroyed else 0)
+            return True
         return False
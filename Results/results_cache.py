@@ -0,0 +1,41 @@
+"""Things computed from the simulation output are kept in ResultsCache under the results fingerprint of the output they
+were computed from, so they are only computed again once the output changes.  The fingerprint is the run, the number of
+finished iterations and when the ResultsWriter last wrote.  delete_all_outputs empties the cache with the output."""
+import json
+from collections import OrderedDict
+
+from django.db.models import Count, Max
+
+from Results.models import DailyControls, SimulationRun, ResultsCache
+
+
+def results_fingerprint():
+    """Changes whenever the output does.  Output written before SimulationRun existed is identified by its rows."""
+    finished = DailyControls.objects.filter(last_day=True).aggregate(count=Count('id'), last=Max('id'))
+    run = SimulationRun.objects.first()
+    if run is None:
+        return "%i-%s" % (finished['count'], finished['last'])
+    return "%s-%i-%s" % (run.started.isoformat(), finished['count'], run.last_written.isoformat() if run.last_written else '')
+
+
+def cached_value(key, fingerprint=None):
+    """The value stored under key for the current output, or None"""
+    fingerprint = fingerprint or results_fingerprint()
+    entry = ResultsCache.objects.filter(key=key, fingerprint=fingerprint).first()
+    return json.loads(entry.value, object_pairs_hook=OrderedDict) if entry is not None else None
+
+
+def store_value(key, value, fingerprint=None):
+    ResultsCache.objects.update_or_create(key=key, defaults={'fingerprint': fingerprint or results_fingerprint(), 'value': json.dumps(value)})
+
+
+def cached(key, compute, store=True):
+    """compute() from the cache if the output hasn't changed since it was stored.  Pass store=False while the output
+    is still being written: it would only be stale on the next request."""
+    fingerprint = results_fingerprint()
+    value = cached_value(key, fingerprint)
+    if value is None:
+        value = compute()
+        if store:
+            store_value(key, value, fingerprint)
+    return value
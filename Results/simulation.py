@@ -1,20 +1,34 @@
 import os
-from collections import defaultdict
+import io
+import gzip
+import queue
+import shutil
+import tempfile
 import multiprocessing
+import threading
 import time
 import platform
 import subprocess
-from django.db import transaction, close_old_connections
+from collections import deque
+from itertools import chain
+import psutil
+from django.db import close_old_connections, connections
+from django.db.models import F
 from django.conf import settings
+from django.utils import timezone
 
 
 from Results.interactive_graphing import population_zoom_png
 from ADSMSettings.views import save_scenario
-from ADSMSettings.utils import adsm_executable_command
+from ADSMSettings.utils import adsm_executable_command, workspace_path, scenario_filename
 from ADSMSettings.models import SimulationProcessRecord, SmSession
-from Results.models import DailyControls, DailyByZoneAndProductionType, DailyByProductionType, DailyByZone, ResultsVersion
+from Results.ingestion import ResultsWriter, ResultsBuffer, ResultsWriterGone, put_results, process_is_alive, drop_output_indexes, build_output_indexes
+from Results.models import SimulationRun
+from Results.convergence import ConvergenceMonitor
+from Results.combine_outputs import CombinedOutputsAppender, COLUMNAR_FOLDER
+from Results.supplemental_tables import load_supplemental_tables
 from Results.utils import zip_map_directory_if_it_exists, abort_simulation
-from ScenarioCreator.models import ProductionType, Zone
+from ScenarioCreator.models import ProductionType, Zone, OutputSettings
 
 
 def non_empty_lines(line):
@@ -25,98 +39,291 @@ def non_empty_lines(line):
     return output_lines
 
 
-def set_pragma(setting, value, connection='default'):
-    from django.db import connections
+class EngineHung(Exception):
+    pass
 
-    cursor = connections[connection].cursor()
-    raw_sql = "PRAGMA {0} = {1}".format(setting, value)
 
-    cursor.execute(raw_sql)
+class EngineProcess(object):
+    """Runs one CEngine iteration and drains its stdout and stderr at the same time on two reader threads, so a chatty
+    stderr can never fill its pipe and deadlock the engine.  readline() hands out stdout lines as they arrive and
+    raises EngineHung, after killing the engine, if nothing arrives for SIMULATION_WATCHDOG_SECONDS.  At most
+    SIMULATION_STDOUT_MAX_LINES lines are read ahead, after that the engine waits on its pipe until they are parsed.
+    stdout_wait and cpu_seconds are kept for the IterationTiming of the iteration."""
+    def __init__(self, adsm_cmd):
+        self.process = subprocess.Popen(adsm_cmd,
+                                        shell=(platform.system() == 'Windows'),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        self.watchdog = settings.SIMULATION_WATCHDOG_SECONDS or None
+        self.stdout_lines = queue.Queue(settings.SIMULATION_STDOUT_MAX_LINES)
+        self.stderr_lines = []
+        self.killed = threading.Event()
+        self.finished = False
+        self.stdout_wait = 0.0
+        self.cpu_seconds = None
+        self.readers = [threading.Thread(target=self.drain_stdout, daemon=True),
+                        threading.Thread(target=self.drain_stderr, daemon=True)]
+        for reader in self.readers:
+            reader.start()
 
+    def drain_stdout(self):
+        for line in chain(iter(self.process.stdout.readline, b''), [None]):  # None is the end of output
+            while not self.killed.is_set():  # nobody will read what's left once the engine is killed
+                try:
+                    self.stdout_lines.put(line, timeout=1)
+                    break
+                except queue.Full:
+                    continue
 
-def simulation_process(iteration_number, adsm_cmd, production_types, zones, log_path, testing=False):
-    start = time.time()
+    def drain_stderr(self):
+        for line in iter(self.process.stderr.readline, b''):
+            self.stderr_lines.append(line)
+
+    def readline(self):
+        """Same as Popen.stdout.readline(): returns b'' once the engine has closed stdout."""
+        if self.finished:
+            return b''
+        waiting = time.perf_counter()
+        try:
+            line = self.stdout_lines.get(timeout=self.watchdog)
+        except queue.Empty:
+            self.kill()
+            raise EngineHung("No output from the simulation for %i seconds." % self.watchdog)
+        finally:
+            self.stdout_wait += time.perf_counter() - waiting
+        if line is None:
+            self.finished = True
+            return b''
+        return line
+
+    def readlines(self):
+        return list(iter(self.readline, b''))
+
+    def communicate(self):
+        """Waits for the engine to exit and returns (remaining stdout, stderr) like Popen.communicate()"""
+        outs = b''.join(self.readlines())
+        self.cpu_seconds = self.cpu_time()
+        try:
+            self.process.wait(timeout=self.watchdog)
+        except subprocess.TimeoutExpired:
+            self.kill()
+            raise EngineHung("The simulation did not exit %i seconds after closing its output." % self.watchdog)
+        for reader in self.readers:
+            reader.join()
+        return outs, b''.join(self.stderr_lines)
+
+    def cpu_time(self):
+        """CPU seconds used so far by the engine and anything it started.  Read once the engine has closed its output
+        but before it is waited on, while the operating system still has its accounts."""
+        try:
+            parent = psutil.Process(self.process.pid)
+            return sum(sum(process.cpu_times()[:2]) for process in parent.children(recursive=True) + [parent])
+        except psutil.Error:
+            return None
+
+    def kill(self):
+        """Kills the engine along with anything it was started through (cmd.exe on Windows)."""
+        self.killed.set()
+        try:
+            parent = psutil.Process(self.process.pid)
+            for process in parent.children(recursive=True) + [parent]:
+                process.kill()
+        except psutil.NoSuchProcess:
+            pass
+        self.process.wait()
+
+
+class IterationLog(object):
+    """The log of one iteration, kept the way SIMULATION_LOG_MODE says: 'full' is every line of CEngine output in
+    iterationN.log, 'full-gzip' is the same compressed into iterationN.log.gz, 'errors' only writes iterationN.log for
+    an iteration that had problems and leaves out the engine output, 'off' writes nothing.  Writes go through a
+    SIMULATION_LOG_BUFFER_BYTES buffer instead of hitting the disk line by line."""
+    def __init__(self, log_path, iteration_number, mode=None):
+        self.mode = mode or settings.SIMULATION_LOG_MODE
+        self.path = os.path.join(log_path, 'iteration%s.log' % iteration_number)
+        self.file = None
+        if self.mode == 'full':
+            self.file = self.open()
+        elif self.mode == 'full-gzip':
+            self.path += '.gz'
+            self.file = io.TextIOWrapper(io.BufferedWriter(gzip.GzipFile(self.path, 'wb', compresslevel=1), settings.SIMULATION_LOG_BUFFER_BYTES))
+
+    def open(self):
+        return open(self.path, 'w', buffering=settings.SIMULATION_LOG_BUFFER_BYTES)
+
+    def output(self, text):
+        """CEngine output, only kept by the full logs"""
+        if self.mode in ('full', 'full-gzip'):
+            self.file.write(text)
+
+    def problem(self, text):
+        if self.mode == 'off':
+            return
+        if self.file is None:
+            self.file = self.open()
+        self.file.write(text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.file is not None:
+            self.file.close()
+
+
+def discard_logs(log_path, file_names):
+    """Moves the logs out of the way so the run can start writing new ones right away, then deletes them on a
+    background thread along with anything a previous run didn't get to delete before it ended."""
+    trash = tempfile.mkdtemp(prefix='deleting', dir=log_path)
+    for file_name in file_names:
+        os.replace(os.path.join(log_path, file_name), os.path.join(trash, file_name))
+    trash_folders = [os.path.join(log_path, f) for f in os.listdir(log_path) if f.startswith('deleting')]
+    threading.Thread(target=lambda: [shutil.rmtree(folder, ignore_errors=True) for folder in trash_folders], daemon=True).start()
+
+
+class Worker(object):
+    """What every iteration run in a pool worker shares, set up once per worker process by initialize_worker so that
+    a task only has to carry its iteration number.  The parser compiled for a header line is kept for the next
+    iteration with the same header, which is every one of them.  writer_pid is the process draining results_queue."""
+    def __init__(self, results_queue, executable_cmd, production_types, zones, log_path, report_crash=True, writer_pid=None):
+        self.results_queue = results_queue
+        self.writer_pid = writer_pid
+        self.engine = None  # the EngineProcess of the iteration being run
+        self.executable_cmd = executable_cmd
+        self.production_types = production_types
+        self.zones = zones
+        self.log_path = log_path
+        self.report_crash = report_crash
+        self.parsers = {}
+
+    def parser(self, headers):
+        from Results.output_parser import DailyParser
+        if headers not in self.parsers:
+            self.parsers[headers] = DailyParser(headers, self.production_types, self.zones)
+        parser = self.parsers[headers]
+        parser.reset()
+        return parser
 
+
+worker = None  # set in each pool worker by initialize_worker
+
+
+def watch_parent(parent_pid):
+    """Pool workers outlive a Simulation killed by abort_simulation.  Once it is gone the engine of the running
+    iteration is killed and the worker exits."""
+    while process_is_alive(parent_pid):
+        time.sleep(settings.RESULTS_QUEUE_PUT_SECONDS)
+    if worker.engine is not None:
+        worker.engine.kill()
+    os._exit(1)
+
+
+def initialize_worker(results_queue, executable_cmd, production_types, zones, log_path, testing=False, report_crash=True, writer_pid=None):
+    """Pool initializer.  multiprocessing Queues can only be shared through inheritance, so the ResultsWriter queue
+    is handed to each worker when it starts along with everything else that is the same for every iteration.
+    Simulation agents pass report_crash=False and leave it to the coordinator to report the error text."""
+    global worker
+    import django
+    django.setup()  # already done if the worker was forked, not if it was spawned
     if testing:
         for database in settings.DATABASES:
             settings.DATABASES[database]['NAME'] = settings.DATABASES[database]['TEST']['NAME'] if 'TEST' in settings.DATABASES[database] else settings.DATABASES[database]['TEST_NAME']
+    connections.close_all()  # a SQLite connection inherited through fork can't be shared with the parent
+    worker = Worker(results_queue, executable_cmd, production_types, zones, log_path, report_crash, writer_pid)
+    threading.Thread(target=watch_parent, args=(os.getppid(),), daemon=True).start()
+
+
+def report_engine_crash(error_text):
+    """Shows the first CEngine crash to the user and stops the run"""
+    if not SmSession.objects.get().simulation_crashed:
+        if "MEMORY-ERROR" in error_text:
+            error_text += "This scenario has exceeded the limits of ADSM. It will be necessary to modify your parameters to reduce disease spread to execute this scenario."
+        SmSession.objects.all().update(simulation_crashed=True, crash_text=error_text)
+    abort_simulation()
+
+
+def simulation_process(iteration_number):
+    """Runs one iteration in a pool worker set up by initialize_worker and returns (iteration_number, seconds,
+    failure, engine error text)."""
+    start = time.time()
+    results_queue = worker.results_queue
 
     # import cProfile, pstats
     # profiler = cProfile.Profile()
     # profiler.enable()
 
     # Start logging
-    with open(os.path.join(log_path, 'iteration%s.log' % iteration_number), 'w') as log_file:
-        simulation = subprocess.Popen(adsm_cmd,
-                                      shell=(platform.system() != 'Darwin'),
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE,
-                                      bufsize=1)
-        # Popen is non-blocking, and all the readlines below read the process output in real time as it buffers
-        # Calling communicate IS blocking, so we don't want to do that until this process is done
-        # Ideally we would run communicate first so we can get any errors, but this would prevent us from updating progress of this simulation in real time.
-        headers = simulation.stdout.readline().decode()
-        log_file.write("LOG: HEADERS:\n")
-        log_file.write("%s\n" % headers)
-        from Results.output_parser import DailyParser
-        p = DailyParser(headers, production_types, zones)
-        adsm_result = []
-        prev_line = ''
-        while True:
-            line = simulation.stdout.readline()  # TODO: Has the potential to lock up if CEngine crashes (blocking io)
-            line = line.decode().strip()
-            if not line:
-                break
-            log_file.write("%s\n" % line)
-            parse_result = p.parse_daily_strings(prev_line, False)
-            adsm_result.extend(parse_result)
-            prev_line = line
-        adsm_result.extend(p.parse_daily_strings(prev_line, last_line=True, create_version_entry=iteration_number==1))
-
-        with transaction.atomic(using='scenario_db'):
+    failure = None
+    error_text = None
+    with IterationLog(worker.log_path, iteration_number) as log_file:
+        simulation = EngineProcess(worker.executable_cmd + ['-i', str(iteration_number)])
+        worker.engine = simulation
+        # The engine output is read in real time as it buffers so we can update progress of this simulation while it runs
+        # Errors are collected on the side and only acted on once the simulation has halted
+        try:
+            headers = simulation.readline().decode()
+            log_file.output("LOG: HEADERS:\n%s\n" % headers)
+            parsing = time.perf_counter()
+            p = worker.parser(headers)
+            parse_time = time.perf_counter() - parsing
+            results_buffer = ResultsBuffer(results_queue, iteration_number, worker.writer_pid)  # the ResultsWriter does all the database writing
+            prev_line = ''
+            while True:
+                line = simulation.readline()
+                line = line.decode().strip()
+                if not line:
+                    break
+                log_file.output("%s\n" % line)
+                parsing = time.perf_counter()
+                rows = p.parse_daily_rows(prev_line, False)
+                parse_time += time.perf_counter() - parsing
+                results_buffer.add_day(rows)
+                prev_line = line
+            parsing = time.perf_counter()
+            results_buffer.add_rows(p.parse_daily_rows(prev_line, last_line=True, create_version_entry=iteration_number==1))
+            parse_time += time.perf_counter() - parsing
+
             prev_line = ''
-            unit_stats_headers = simulation.stdout.readline().decode()  # TODO: Currently we don't use the headers to find which row to insert into.
-            log_file.write("LOG: UNIT STAT HEADERS:\n")
-            log_file.write("%s\n" % unit_stats_headers)
-            for line in simulation.stdout.readlines():
+            unit_stats_headers = simulation.readline().decode()  # TODO: Currently we don't use the headers to find which row to insert into.
+            log_file.output("LOG: UNIT STAT HEADERS:\n%s\n" % unit_stats_headers)
+            for line in simulation.readlines():
                 line = line.decode().strip()
-                log_file.write(line)
+                log_file.output(line)
+                parsing = time.perf_counter()
                 p.parse_unit_stats_string(prev_line)
+                parse_time += time.perf_counter() - parsing
                 prev_line = line
+            parsing = time.perf_counter()
             p.parse_unit_stats_string(prev_line)
+            results_buffer.add_rows([('UnitStats', row) for row in p.unit_stats.rows()])
+            parse_time += time.perf_counter() - parsing
 
-        outs, errors = simulation.communicate()  # close p.stdout, wait for the subprocess to exit
-        log_file.write("LOG: FINAL OUTS:\n")
-        log_file.write("%s\n" % outs)
+            if p.malformed:
+                log_file.problem("LOG: MALFORMED CELLS STORED AS BLANK:\n" + ''.join(
+                    "%s: %i, first %r\n" % (column, count, first_value) for column, (count, first_value) in sorted(p.malformed.items())))
+            outs, errors = simulation.communicate()  # wait for the subprocess to exit
+            results_buffer.add_rows([('IterationTiming', (iteration_number, simulation.cpu_seconds, simulation.stdout_wait, parse_time))])
+            results_buffer.flush()  # last day, unit stats and timings are committed together
+        except EngineHung as hang:
+            failure = str(hang) + " Iteration %i was stopped." % iteration_number
+            print(failure)
+            log_file.problem("LOG: WATCHDOG:\n%s\n" % failure)
+            put_results(results_queue, (iteration_number, None), worker.writer_pid)  # throw away the days that were already streamed
+            outs, errors = b'', b''.join(simulation.stderr_lines)
+        except BaseException:  # the results writer is gone, nothing else will stop the engine
+            simulation.kill()
+            raise
+        finally:
+            worker.engine = None
+        log_file.output("LOG: FINAL OUTS:\n%s\n" % outs)
         if errors:  # this will only print out error messages after the simulation has halted
-            log_file.write("LOG: FINAL ERRORS:\n")
-            log_file.write("%s\n" % errors)
+            log_file.problem("LOG: FINAL ERRORS:\n%s\n" % errors)
             print(errors)
-            if not SmSession.objects.get().simulation_crashed:
-                error_text = errors.decode()
-                if "MEMORY-ERROR" in error_text:
-                    error_text += "This scenario has exceeded the limits of ADSM. It will be necessary to modify your parameters to reduce disease spread to execute this scenario."
-                SmSession.objects.all().update(simulation_crashed=True, crash_text=error_text)
-            abort_simulation()
+            error_text = errors.decode()
+            if worker.report_crash:
+                report_engine_crash(error_text)
     # End logging
     
-    sorted_results = defaultdict(lambda: [] )
-    for result in adsm_result:
-        result_type = type(result).__name__
-        sorted_results[result_type].append(result)
-
-    set_pragma("synchronous", "OFF", connection='scenario_db')
-    set_pragma("journal_mode", "MEMORY", connection='scenario_db')
-
-    DailyControls.objects.bulk_create(sorted_results['DailyControls'])
-    DailyByZoneAndProductionType.objects.bulk_create(sorted_results['DailyByZoneAndProductionType'])
-    DailyByProductionType.objects.bulk_create(sorted_results['DailyByProductionType'])
-    DailyByZone.objects.bulk_create(sorted_results['DailyByZone'])
-    try:
-        ResultsVersion.objects.bulk_create(sorted_results['ResultsVersion'])
-    except KeyError:
-        pass
-
     end = time.time()
     
     # profiler.disable()
@@ -125,7 +332,27 @@ def simulation_process(iteration_number, adsm_cmd, production_types, zones, log_
     # stats.sort_stats('time')
     # stats.print_stats(10)
     
-    return iteration_number, end-start
+    return iteration_number, end-start, failure, error_text
+
+
+def pool_results(pool, pending, task, window, stopped):
+    """Yields what the pool returns for each iteration in the pending deque as they finish.  At most window iterations
+    are handed to the pool at a time, so once stopped is set the ones left in pending are never started.
+    task(iteration) gives the (func, args) to run."""
+    finished = queue.Queue()
+    running = 0
+    while True:
+        while pending and running < window and not stopped.is_set():
+            func, args = task(pending.popleft())
+            pool.apply_async(func=func, args=args, callback=finished.put, error_callback=finished.put)
+            running += 1
+        if not running:
+            return
+        result = finished.get()
+        running -= 1
+        if isinstance(result, BaseException):
+            raise result
+        yield result
 
 
 class Simulation(multiprocessing.Process):
@@ -135,10 +362,13 @@ class Simulation(multiprocessing.Process):
     testing = False
 
     """Execute system commands in a separate thread so as not to interrupt the webpage.
-    Saturate the computer's processors with parallel simulation iterations"""
-    def __init__(self, max_iteration, testing=False, **kwargs):
+    Saturate the computer's processors with parallel simulation iterations.
+    Pass iterations to resume a run: only those iteration numbers are run, with the same -i they would have had."""
+    def __init__(self, max_iteration, testing=False, iterations=None, **kwargs):
         super(Simulation, self).__init__(**kwargs)
         self.max_iteration = max_iteration
+        self.resuming = iterations is not None
+        self.iterations = list(iterations) if self.resuming else list(range(1, max_iteration + 1))
         self.production_types = ProductionType.objects.values_list('id', 'name')
         self.zones = Zone.objects.values_list('id', 'name')
         self.testing = testing
@@ -151,38 +381,96 @@ class Simulation(multiprocessing.Process):
                 settings.DATABASES[database]['NAME'] = settings.DATABASES[database]['TEST']['NAME'] if 'TEST' in settings.DATABASES[database] else settings.DATABASES[database]['TEST_NAME']
 
         simRecord = SimulationProcessRecord(is_parser=False, pid=pid)
+        results_queue = multiprocessing.Queue(settings.RESULTS_QUEUE_MAX_BATCHES)
+        writer = ResultsWriter(results_queue, testing=self.testing)
+        pool = None
+        finished = False
         try:
             print("Starting run")
 
             simRecord.save()
+            if self.resuming:
+                SimulationRun.objects.all().update(times_resumed=F('times_resumed') + 1)
+            else:
+                SimulationRun(iterations=self.max_iteration).save()
 
-            # Clean out previous iteration logs
+            # Clean out previous iteration logs, a resumed run keeps the logs of the iterations that finished
             log_path = os.path.join(settings.WORKSPACE_PATH, 'settings', 'logs')
             os.makedirs(log_path, exist_ok=True)
             logs_to_delete = [f for f in os.listdir(log_path) if f.startswith('iteration') and os.path.isfile(os.path.join(log_path, f))]
-            for f in logs_to_delete:
-                os.remove(os.path.join(log_path, f))
+            if self.resuming:
+                rerun = {name % iteration for iteration in self.iterations for name in ['iteration%s.log', 'iteration%s.log.gz']}
+                logs_to_delete = [f for f in logs_to_delete if f in rerun]
+            discard_logs(log_path, logs_to_delete)
 
             num_cores = multiprocessing.cpu_count()
             if num_cores > 2:
                 num_cores -= 1
             executable_cmd = adsm_executable_command()  # only want to do this once
-            statuses = []
-            pool = multiprocessing.Pool(num_cores)
-            for iteration in range(1, self.max_iteration + 1):
-                adsm_cmd = executable_cmd + ['-i', str(iteration)]
-                res = pool.apply_async(func=simulation_process, args=(iteration, adsm_cmd, self.production_types, self.zones, log_path, self.testing))
-                statuses.append(res)
-
-            pool.close()
+            output_settings = OutputSettings.objects.get()
+            monitor = ConvergenceMonitor(output_settings) if output_settings.stop_on_convergence else None
+            supplemental_path = workspace_path(os.path.join(scenario_filename(), "Supplemental Output Files"))
+            appender = None
+            if self.resuming:  # the combined outputs would be missing the iterations that finished before
+                shutil.rmtree(os.path.join(supplemental_path, "Combined Outputs"), ignore_errors=True)
+                shutil.rmtree(os.path.join(supplemental_path, COLUMNAR_FOLDER), ignore_errors=True)
+            elif output_settings.combine_outputs_during_run and not settings.SIMULATION_AGENT_ADDRESS:  # agents keep their files
+                appender = CombinedOutputsAppender(supplemental_path, scenario_filename(), output_settings.save_columnar_outputs)
+                appender.start()
+            drop_output_indexes()  # rebuilt once every iteration is in
+            coordinator = None
+            if settings.SIMULATION_AGENT_ADDRESS:  # simulation agents run the iterations instead of this machine
+                from Results.distribution import AgentCoordinator
+                coordinator = AgentCoordinator(self.iterations, results_queue, self.production_types, self.zones)
+            writer.start()
+            if coordinator:
+                coordinator.writer = writer
+            pending = deque(self.iterations)
+            stopped = threading.Event()
+            if coordinator:
+                results = coordinator.results()
+            else:
+                pool = multiprocessing.Pool(num_cores, initializer=initialize_worker,
+                                            initargs=(results_queue, executable_cmd, list(self.production_types), list(self.zones), log_path, self.testing, True, writer.pid))
+                task = lambda iteration: (simulation_process, (iteration,))
+                results = pool_results(pool, pending, task, num_cores * 2, stopped)  # a few at a time so a convergence stop leaves nothing queued
 
             simulation_times = []
-            for status in statuses:
-                iteration_number, s_time = status.get()
+            for iteration_number, s_time, failure, error_text in results:
+                if error_text and coordinator:  # agents leave reporting a crash to us
+                    report_engine_crash(error_text)
                 stream = SmSession.objects.get()
-                stream.iteration_text += "<li>Iteration %i:  %is </li>" % (iteration_number, s_time)
+                if failure:
+                    stream.iteration_text += "<li>Iteration %i:  %s </li>" % (iteration_number, failure)
+                else:
+                    stream.iteration_text += "<li>Iteration %i:  %is </li>" % (iteration_number, s_time)
                 stream.save()
+                if appender and not failure:
+                    appender.add(iteration_number)
                 simulation_times.append(round(s_time))
+                if monitor and monitor.due(len(simulation_times)) and monitor.check():
+                    stopped.set()
+                    dropped = set(coordinator.stop_leasing() if coordinator else pending)
+                    started = [iteration for iteration in self.iterations if iteration not in dropped]
+                    print("Converged after %i iterations, %i will not be run" % (len(simulation_times), len(dropped)))
+                    SimulationRun.objects.all().update(stopped_after=max(started), convergence=monitor.json())
+            if not coordinator:
+                pool.close()
+                pool.join()
+            if appender:
+                appender.close()
+            put_results(results_queue, None, writer.pid)  # every iteration is queued, let the writer finish its last transaction
+            writer.join()
+            if writer.exitcode:
+                raise ResultsWriterGone("The results writer stopped with exit code %i." % writer.exitcode)
+            finished = True
+            build_output_indexes()
+            if output_settings.load_supplemental_tables and not coordinator:
+                load_supplemental_tables(supplemental_path, num_cores)
+            if monitor and not monitor.converged:
+                monitor.check()  # how close it came
+                SimulationRun.objects.all().update(convergence=monitor.json())
+            SimulationRun.objects.all().update(finished=timezone.now())
 
             print(''.join(str(s) + 's, ' for s in simulation_times))
             print("Average Time:", round(sum(simulation_times)/len(simulation_times), 2), 'seconds')
@@ -190,8 +478,17 @@ class Simulation(multiprocessing.Process):
             # zip_map_directory_if_it_exists()  # see ticket 1006 for why this is commented out
             save_scenario()
             close_old_connections()
-        except:
+        except ResultsWriterGone as error:
+            SmSession.objects.all().update(simulation_crashed=True, crash_text=str(error))
             raise
         finally:
+            if pool is not None and not finished:
+                pool.terminate()  # their engines stop at their next write to the closed pipe
+            if writer.is_alive():
+                try:
+                    put_results(results_queue, None, writer.pid)
+                except ResultsWriterGone:
+                    pass
+                writer.join()
             if simRecord.id:
                 simRecord.delete()
\ No newline at end of file
@@ -1,10 +1,11 @@
 from collections import OrderedDict
 from statistics import median
 
-from Results.models import DailyControls, DailyByProductionType, DailyByZone
+from Results.models import DailyControls, DailyByProductionType, DailyByZone, IterationTiming, SimulationRun
+from Results.online_statistics import LastDayStatistics
 from ScenarioCreator.models import Zone
 from ScenarioCreator.models import Zone, OutputSettings
-from django.db.models import Q
+from django.db.models import Q, Sum
 
 
 def list_of_iterations():
@@ -23,8 +24,19 @@ def last_day_query(model=DailyControls):
     return Q(last_day=True)
 
 
-def field_summary(field_name, model=DailyByProductionType):
+def last_day_median(queryset, field_name, statistics=None, zone=None):
+    """Median from the LastDayStatistics the ResultsWriter accumulated, falls back on scanning the queryset for output
+    that was written without them."""
+    field = statistics.get(queryset.model, field_name, zone.id if zone else None) if statistics is not None else None
+    if field is None:
+        return median_value(queryset, field_name)
+    med = field.median()
+    return med if med is not None and med != -1 else "N/A"
+
+
+def field_summary(field_name, model=DailyByProductionType, statistics=None):
     # switch on model
+    zone = None
     if model == DailyByProductionType:  # query only the "All" production type on the last day of each iteration
         queryset = DailyByProductionType.objects.filter(last_day_query(), production_type=None)
     elif model == DailyControls:
@@ -33,7 +45,7 @@ def field_summary(field_name, model=DailyByProductionType):
         zone = Zone.objects.all().order_by('radius').last()
         queryset = DailyByZone.objects.filter(last_day_query(), zone=zone)
 
-    return median_value(queryset, field_name)  # value list, last day, median, aggregate
+    return last_day_median(queryset, field_name, statistics, zone)  # value list, last day, median, aggregate
 
 
 def name(field_name, model=DailyByProductionType):
@@ -49,26 +61,27 @@ def pair(unit_number, animal_number):
 
 
 def summarize_results():
+    statistics = LastDayStatistics.load()
     summary = OrderedDict()
     summary["Unit (Animal) Summary"] = [
-        ("Median Infected Units (Animals)", pair(field_summary("infcU"), field_summary("infcA"))),
-        ("Median Units (Animals) Infected at First Detection", pair(field_summary("firstDetUInf", DailyControls), field_summary("firstDetAInf", DailyControls))),
-        ("Median Depopulated Units (Animals)", pair(field_summary("descU"), field_summary("descA"))),
-        ("Median Vaccinated Units (Animals)", pair(field_summary("vaccU"), field_summary("vaccA")))]
+        ("Median Infected Units (Animals)", pair(field_summary("infcU", statistics=statistics), field_summary("infcA", statistics=statistics))),
+        ("Median Units (Animals) Infected at First Detection", pair(field_summary("firstDetUInf", DailyControls, statistics=statistics), field_summary("firstDetAInf", DailyControls, statistics=statistics))),
+        ("Median Depopulated Units (Animals)", pair(field_summary("descU", statistics=statistics), field_summary("descA", statistics=statistics))),
+        ("Median Vaccinated Units (Animals)", pair(field_summary("vaccU", statistics=statistics), field_summary("vaccA", statistics=statistics)))]
     summary["Event Summary"] = [
         ("Median Outbreak Duration in Days (end of control activities)", 
-            field_summary("outbreakDuration", DailyControls)),
-        ("Median Duration of Disease Spread in Days",field_summary("diseaseDuration", DailyControls)),
-        ("Median Day of First Detection", field_summary("firstDetection")),
-        ("Median Day of First Vaccination", field_summary("firstVaccination")),
-        ("Median Day of First Destruction", field_summary("firstDestruction"))]
+            field_summary("outbreakDuration", DailyControls, statistics=statistics)),
+        ("Median Duration of Disease Spread in Days",field_summary("diseaseDuration", DailyControls, statistics=statistics)),
+        ("Median Day of First Detection", field_summary("firstDetection", statistics=statistics)),
+        ("Median Day of First Vaccination", field_summary("firstVaccination", statistics=statistics)),
+        ("Median Day of First Destruction", field_summary("firstDestruction", statistics=statistics))]
     zones_summary = []
     for zone in Zone.objects.all():
         queryset = DailyByZone.objects.filter(last_day_query(), zone=zone)
         zones_summary.append(
-            ("Median Total Area of %s in km^2" % zone.name, round(median_value(queryset, "zoneArea"), 3)))
+            ("Median Total Area of %s in km^2" % zone.name, round(last_day_median(queryset, "zoneArea", statistics, zone), 3)))
         zones_summary.append(
-            ("Median Number of Distinct %s Zones" % zone.name, median_value(queryset, "numSeparateAreas")))
+            ("Median Number of Distinct %s Zones" % zone.name, last_day_median(queryset, "numSeparateAreas", statistics, zone)))
     summary["Zone Summary"] = zones_summary
     
     return summary
@@ -78,7 +91,21 @@ def iterations_complete():
     return DailyControls.objects.filter(last_day_query()).count()
 
 
+def iteration_timing_totals():
+    """Sum of each IterationTiming over the finished iterations"""
+    timing_fields = ['engine_cpu_seconds', 'stdout_wait_seconds', 'parse_seconds', 'write_seconds', 'lock_wait_seconds', 'rows_written']
+    return IterationTiming.objects.aggregate(**{field: Sum(field) for field in timing_fields})
+
+
+def iterations_total():
+    """The iterations the run will finish, from its SimulationRun: all of them unless the stopping rule ended it early.
+    The OutputSettings can have been changed since the run started, they are only used before there is a run."""
+    run = SimulationRun.objects.first()
+    if run is not None:
+        return run.stopped_after or run.iterations
+    return OutputSettings.objects.get().iterations
+
+
 def iteration_progress():
-    output_settings = OutputSettings.objects.get()
-    iterations_started = output_settings.iterations
-    return iterations_complete() / iterations_started if iterations_started else 0
\ No newline at end of file
+    iterations_started = iterations_total()
+    return min(iterations_complete() / iterations_started, 1.0) if iterations_started else 0
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""Loads the daily_events, daily_exposures and states supplemental files of every iteration into tables of the
+scenario_db, so exposure chains and unit histories can be queried from the Query Tool instead of searched for in the
+CSVs.  The tables are laid out from the CSV headers with an iteration column added in front and each column typed by
+the widest of its values in the first batch of rows of its family.  A pool of processes parses the files, streaming SIMULATION_FLUSH_ROWS rows at a time through a
+bounded queue to the only writer, the process that called load_supplemental_tables, the same way iteration workers feed
+the ResultsWriter.  Indexes go on (iteration, Day) and on every ID column once all the rows are in.  A family with a
+file that could not be read is dropped rather than left half loaded."""
+import os
+import csv
+import queue
+import multiprocessing
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from Results.combine_outputs import COMBINED_FAMILIES, iteration_files
+
+
+TABLE_PREFIX = 'Supplemental_'
+SQL_TYPES = {int: 'INTEGER', float: 'REAL', str: 'TEXT'}
+
+
+def table_name(family):
+    return TABLE_PREFIX + family
+
+
+def supplemental_tables(using='scenario_db'):
+    cursor = connections[using].cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE %s", [TABLE_PREFIX + '%'])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def drop_supplemental_tables(using='scenario_db'):
+    if connections[using].vendor != 'sqlite':
+        return
+    cursor = connections[using].cursor()
+    for table in supplemental_tables(using):
+        cursor.execute("DROP TABLE %s" % connections[using].ops.quote_name(table))
+
+
+def typed(cell):
+    """The cell as an int or float if it is one, None if it is empty"""
+    for kind in (int, float):
+        try:
+            return kind(cell)
+        except ValueError:
+            pass
+    return cell if cell != '' else None
+
+
+reader_queue = None
+
+
+def initialize_reader(results_queue):
+    global reader_queue
+    reader_queue = results_queue
+
+
+class SupplementalReaderGone(Exception):
+    pass
+
+
+def read_supplemental_file(family, iteration_number, path):
+    """Pool task: puts (family, iteration_number, header, rows) on the queue every SIMULATION_FLUSH_ROWS rows, at least
+    once so the writer sees every header, and then (family, iteration_number, None, None) when the file is done."""
+    try:
+        with open(path, newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader, None)
+            if header is not None:
+                rows = []
+                for line in reader:
+                    if line:
+                        rows.append((iteration_number,) + tuple(typed(cell) for cell in line))
+                    if len(rows) >= settings.SIMULATION_FLUSH_ROWS:
+                        reader_queue.put((family, iteration_number, header, rows))
+                        rows = []
+                reader_queue.put((family, iteration_number, header, rows))
+    finally:
+        reader_queue.put((family, iteration_number, None, None))
+
+
+class SupplementalTable(object):
+    """Created from the header of the first file of its family to arrive and every row of the family in the same batch"""
+    def __init__(self, family, header, rows, using='scenario_db'):
+        self.connection = connections[using]
+        self.name = table_name(family)
+        self.columns = ['iteration'] + [name.strip() for name in header]
+        quote_name = self.connection.ops.quote_name
+        definitions = ["%s %s" % (quote_name(column), self.column_type(position, rows)) for position, column in enumerate(self.columns)]
+        self.connection.cursor().execute("CREATE TABLE %s (%s)" % (quote_name(self.name), ', '.join(definitions)))
+        self.insert_sql = "INSERT INTO %s VALUES (%s)" % (quote_name(self.name), ', '.join(['%s'] * len(self.columns)))
+        self.rows = 0
+
+    @staticmethod
+    def column_type(position, rows):
+        """TEXT if any of the values is text, otherwise REAL if any has a decimal, otherwise INTEGER.  SQLite still keeps a
+        value that doesn't fit the type as it is."""
+        kinds = {type(row[position]) for row in rows if position < len(row) and row[position] is not None}
+        for kind in (str, float, int):
+            if kind in kinds:
+                return SQL_TYPES[kind]
+        return ''  # no affinity, SQLite keeps whatever is stored
+
+    def insert(self, rows):
+        width = len(self.columns)
+        rows = [row[:width] + (None,) * (width - len(row)) for row in rows]  # ragged lines don't stop the load
+        self.connection.cursor().executemany(self.insert_sql, rows)
+
+    def build_indexes(self):
+        quote_name = self.connection.ops.quote_name
+        cursor = self.connection.cursor()
+        indexes = [['iteration'] + [column for column in self.columns if column.lower() == 'day']]
+        indexes += [[column, 'iteration'] for column in self.columns if column.lower().endswith('id')]
+        for columns in indexes:
+            name = "%s_%s" % (self.name, '_'.join(columns))
+            cursor.execute("CREATE INDEX %s ON %s (%s)" % (quote_name(name), quote_name(self.name), ', '.join(quote_name(column) for column in columns)))
+        cursor.execute("ANALYZE %s" % quote_name(self.name))
+
+
+def load_supplemental_tables(supplemental_output_folder, processes=None, using='scenario_db'):
+    """Replaces the supplemental tables with the files in supplemental_output_folder.  Returns the rows loaded into
+    each table."""
+    if connections[using].vendor != 'sqlite':
+        return {}
+    drop_supplemental_tables(using)
+    files = sorted(iteration_files(supplemental_output_folder).items(), key=lambda item: (item[0][1], item[0][0]))
+    if not files:
+        return {}
+    if processes is None:
+        processes = max(1, multiprocessing.cpu_count() - 1)
+    results_queue = multiprocessing.Queue(settings.RESULTS_QUEUE_MAX_BATCHES)
+    children = multiprocessing.active_children()
+    pool = multiprocessing.Pool(min(processes, len(files)), initializer=initialize_reader, initargs=(results_queue,))
+    readers = [child for child in multiprocessing.active_children() if child not in children]
+    try:
+        reads = []
+        for (family_index, iteration_number), file in files:
+            path = os.path.join(supplemental_output_folder, file)
+            reads.append((COMBINED_FAMILIES[family_index][0], path,
+                          pool.apply_async(read_supplemental_file, (COMBINED_FAMILIES[family_index][0], iteration_number, path))))
+        pool.close()
+        try:
+            tables = write_supplemental_rows(results_queue, len(files), using, readers)
+        except SupplementalReaderGone as error:
+            drop_supplemental_tables(using)
+            print("Could not load the supplemental tables:", error)
+            return {}
+        except:
+            drop_supplemental_tables(using)
+            raise
+        pool.join()
+    finally:
+        pool.terminate()
+    for family, path, read in reads:
+        try:
+            read.get()
+        except Exception as error:
+            print("Could not load %s into %s: %s" % (path, table_name(family), error))
+            if family in tables:
+                connections[using].cursor().execute("DROP TABLE %s" % connections[using].ops.quote_name(table_name(family)))
+                del tables[family]
+    for table in tables.values():
+        table.build_indexes()
+    return {table.name: table.rows for table in tables.values()}
+
+
+def next_rows(results_queue, readers):
+    """results_queue.get() that raises SupplementalReaderGone instead of waiting forever on the files of a reader
+    process that was killed.  The pool starts a new worker in its place but the file it was reading never finishes."""
+    while True:
+        try:
+            return results_queue.get(timeout=settings.RESULTS_QUEUE_PUT_SECONDS)
+        except queue.Empty:
+            if any(reader.exitcode not in (None, 0) for reader in readers):  # 0 is a worker leaving the closed pool
+                raise SupplementalReaderGone("A reader process stopped before every file was read.")
+
+
+def write_supplemental_rows(results_queue, file_count, using='scenario_db', readers=()):
+    """The single writer: commits everything waiting on the queue in one transaction until every file is done"""
+    tables = {}
+    unfinished = file_count
+    while unfinished:
+        batch = [next_rows(results_queue, readers)]  # block until there is something to write
+        rows = len(batch[-1][3] or [])
+        while rows < settings.RESULTS_WRITER_BATCH_ROWS:
+            try:
+                batch.append(results_queue.get_nowait())
+            except queue.Empty:
+                break
+            rows += len(batch[-1][3] or [])
+        with transaction.atomic(using=using):
+            for family, iteration_number, header, chunk in batch:
+                if header is None:
+                    unfinished -= 1
+                    continue
+                if family not in tables:  # typed from everything of the family in this batch
+                    sample = [row for message in batch if message[0] == family and message[3] for row in message[3]]
+                    tables[family] = SupplementalTable(family, header, sample, using)
+                tables[family].insert(chunk)
+                tables[family].rows += len(chunk)
+    return tables
@@ -1,18 +1,51 @@
-from django.test import TestCase, TransactionTestCase
-from django.db import close_old_connections
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.db import close_old_connections, connections
 from django.conf import settings
+from django.http import HttpResponse
+from django.utils import timezone
 import os, shutil
+import gzip
+import json
+import tempfile
+import queue
+import random
+import statistics
+import threading
+import time
+import subprocess
+import multiprocessing
+import sys
+from multiprocessing.connection import Client
 import zipfile
+import numpy
 from ADSMSettings.utils import workspace_path
 
 from Results.views import Simulation
-from ScenarioCreator.models import OutputSettings, ProductionType
-from Results.models import DailyControls, DailyByProductionType, DailyByZone, DailyByZoneAndProductionType, ResultsVersion
-from Results.summary import iterations_complete
+from ScenarioCreator.models import OutputSettings, ProductionType, Unit, Zone
+from Results.models import DailyControls, DailyByProductionType, DailyByZone, DailyByZoneAndProductionType, ResultsVersion, UnitStats, SimulationRun, IterationTiming, ResultsCache, LastDayStatistic, insert_fields
+from Results.summary import iterations_complete, iterations_total, iteration_progress
 from Results.output_parser import DailyParser
+from Results.ingestion import ResultsBuffer, ResultsWriter, ResultsWriterGone, output_index_sql, existing_indexes, output_indexes_missing, drop_output_indexes, build_output_indexes
+from Results.utils import unfinished_iterations, discard_unfinished_iterations, delete_all_outputs, prerender_graphs
+import Results.utils
+from Results.online_statistics import QuantileSketch, RunningStatistics, LastDayStatistics
+from Results.distribution import AgentCoordinator, SimulationAgent
+from Results.convergence import ConvergenceMonitor
+from Results.simulation import pool_results, Worker, IterationLog, discard_logs, EngineProcess, EngineHung
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from Results.summary import field_summary
+from Results.csv_generator import SummaryCSVGenerator
+from Results.results_cache import cached
+from Results.graph_cache import cached_png, evict_graphs
+from Results.graphing import create_time_series_lines, extend_last_day_lines, collect_boxplot_data, downsample, graph_field_json, standard_graphs, prerender_graph, TwoD_histogram, create_figure_with_boxplot
+import Results.graphing
+from Results.supplemental_tables import load_supplemental_tables, drop_supplemental_tables, supplemental_tables, write_supplemental_rows, SupplementalReaderGone
+from Results.combine_outputs import combine_outputs, CombinedOutputsAppender, COLUMNAR_FOLDER, read_columnar_iteration
 from ADSMSettings.models import SingletonManager
 
 from unittest import skip
+from unittest.mock import patch
 
 # @skip("Skipping Simulation Tests") # uncomment this line to skip these test cases, this will drastically increase the speed of testing
 class SimulationTest(TransactionTestCase):
@@ -113,6 +146,30 @@ class SimulationTest(TransactionTestCase):
 
         self.assertFalse(os.access(file_name, os.F_OK))
 
+    @override_settings(SIMULATION_AGENT_AUTHKEY=b'test agents')
+    def test_multiple_local_agents(self):
+        settings = OutputSettings.objects.first()
+        settings.save_daily_unit_states = True
+        settings.save()
+        close_old_connections()
+        results_queue = queue.Queue()
+        coordinator = AgentCoordinator([1, 2, 3], results_queue, ProductionType.objects.values_list('id', 'name'),
+                                       Zone.objects.values_list('id', 'name'), address=('localhost', 0))
+        agents = [threading.Thread(target=SimulationAgent(coordinator.address, 1).run) for i in range(2)]
+        for agent in agents:
+            agent.start()
+        finished = list(coordinator.results())
+        for agent in agents:
+            agent.join(30)
+
+        self.assertEqual(sorted(iteration for iteration, seconds, failure, error_text in finished), [1, 2, 3])
+        self.assertTrue(all(failure is None for iteration, seconds, failure, error_text in finished))
+        messages = [results_queue.get_nowait() for i in range(results_queue.qsize())]
+        timed = [iteration for iteration, rows in messages if rows and any(table == 'IterationTiming' for table, row in rows)]
+        self.assertEqual(sorted(timed), [1, 2, 3])
+        for iteration in [1, 2, 3]:  # in the agents' workspace, not the temporary directory they delete
+            self.assertTrue(os.access(os.path.join(self.scenario_directory, 'Supplemental Output Files', 'states_%i.csv' % iteration), os.F_OK))
+
 
 class IterationProgressTestClass(TestCase):
     multi_db = True
@@ -185,6 +242,17 @@ class IterationProgressTestClass(TestCase):
                 DailyControls.objects.create(iteration=i, day=8, last_day=True)
         self.assertEqual(iterations_complete(), 2)
 
+    def test_progress_of_the_run_not_the_settings(self):
+        SimulationRun(iterations=4).save()
+        self.assertEqual(iterations_total(), 4)  # OutputSettings say 10, they were changed after the run started
+        for i in range(1, 4):
+            DailyControls.objects.create(iteration=i, day=1, last_day=True)
+        self.assertEqual(iteration_progress(), 0.75)
+
+        SimulationRun.objects.update(stopped_after=2)  # converged, iteration 3 was already running
+        self.assertEqual(iterations_total(), 2)
+        self.assertEqual(iteration_progress(), 1.0)
+
 
 class ParserTests(TestCase):
     multi_db = True
@@ -304,6 +372,68 @@ class ParserTests(TestCase):
         self.assertIsInstance(results[1], DailyControls)
 
 
+    def test_routing_table_compiled_from_header(self):
+        """
+            every column is routed once to its (table, row, field) when the
+            parser is created, then each line is parsed by walking that table
+        """
+        production_types = [(1, "Cattle"), (2, "Swine")]
+        header_line = self.common_headers + ",infcUCattle,infcUSwine,infcU,unitsInZoneMediumRiskSwine,outbreakDuration\r\n"
+        p = DailyParser(header_line, production_types, self.zones)
+
+        self.assertEqual(len(p.slots), 5)
+        self.assertEqual(len(p.routing), 5)
+        self.assertEqual(p.failures, set())
+
+        for day, line in enumerate(["1,1,3,2,1,4,5,9,1,1", "1,2,3,2,1,6,7,13,2,2"], start=1):
+            results = p.parse_daily_strings(line, last_line=day == 2)
+            by_pt = {result.production_type_id: result for result in results if type(result) == DailyByProductionType}
+            self.assertEqual(by_pt[1].infcU, 2 * day + 2)
+            self.assertEqual(by_pt[2].infcU, 2 * day + 3)
+            self.assertEqual(by_pt[None].infcU, 4 * day + 5)
+            zone_pt = [result for result in results if type(result) == DailyByZoneAndProductionType][0]
+            self.assertEqual((zone_pt.zone_id, zone_pt.production_type_id, zone_pt.unitsInZone), (1, 2, day))
+            self.assertTrue(all(result.day == day and result.last_day == (day == 2) for result in results))
+
+
+    def test_parse_daily_rows_writes_through_results_writer(self):
+        header_line = self.common_headers + ",firstDetectionCattle,animalDaysInZoneMediumRiskCattle,zoneAreaBackground,outbreakDuration\r\n"
+        p = DailyParser(header_line, self.production_types, self.zones)
+        rows = p.parse_daily_rows("1,1,3,2,1,4,5,1.5,6", create_version_entry=True)
+        rows += p.parse_daily_rows("1,2,3,2,1,7,8,2.5,9", last_line=True)
+
+        ResultsWriter.write_batch([(1, rows)])
+
+        self.assertEqual(DailyByProductionType.objects.get(day=2, production_type_id=1).firstDetection, 7)
+        self.assertEqual(DailyByZoneAndProductionType.objects.get(day=1, zone_id=1, production_type_id=1).animalDaysInZone, 5)
+        self.assertEqual(DailyByZone.objects.get(day=2, zone=None).zoneArea, 2.5)
+        self.assertEqual(DailyControls.objects.get(last_day=True).outbreakDuration, 9)
+        self.assertEqual(str(ResultsVersion.objects.get()), '3.2.1')
+
+
+    def test_columns_converted_by_field_type(self):
+        header_line = self.common_headers + ",firstDetectionCattle,zoneAreaMediumRisk,outbreakDuration,bogus\r\n"
+        p = DailyParser(header_line, self.production_types, self.zones)
+        self.assertEqual(p.convert_line("1,2,3,2,1,4,5,6.0,x".split(',')), [1, 2, '3', '2', '1', 4, 5.0, 6, 'x'])
+        self.assertEqual(p.malformed, {})
+
+        values = p.convert_line("1,3,3,2,1,four,,6.5,x".split(','))
+        self.assertEqual(values, [1, 3, '3', '2', '1', None, None, None, 'x'])  # a blank cell is not malformed
+        values = p.convert_line("1,4,3,2,1,five,1,2,x".split(','))
+        self.assertEqual(p.malformed, {'firstDetectionCattle': [2, 'four'], 'outbreakDuration': [1, '6.5']})
+
+
+    def test_worker_reuses_compiled_parser(self):
+        worker = Worker(queue.Queue(), ['adsm'], self.production_types, self.zones, '.')
+        header_line = self.common_headers + ",outbreakDuration\r\n"
+        p = worker.parser(header_line)
+        p.parse_unit_stats_string("1,1,0,0,0")
+        p.convert_line("1,1,3,2,1,x".split(','))
+
+        self.assertIs(worker.parser(header_line), p)
+        self.assertEqual((p.unit_stats.rows(), p.malformed), ([], {}))  # nothing carried over from the last iteration
+
+
 class ResultsVersionTestCase(TestCase):
     multi_db = True
 
@@ -315,3 +445,721 @@ class ResultsVersionTestCase(TestCase):
         result = ResultsVersion.objects.get()
         self.assertEqual(ResultsVersion.objects.count(), 1)
         self.assertEqual(result.pk, 1)
+
+
+class ResultsBufferTestCase(TestCase):
+    multi_db = True
+
+    @override_settings(SIMULATION_FLUSH_DAYS=2, SIMULATION_FLUSH_ROWS=100)
+    def test_flushes_every_n_days(self):
+        results_queue = queue.Queue()
+        results_buffer = ResultsBuffer(results_queue, 7)
+        for day in range(1, 6):
+            results_buffer.add_day([('DailyControls', (7, day, False))])
+        results_buffer.flush()
+
+        batches = [results_queue.get_nowait() for i in range(results_queue.qsize())]
+        self.assertEqual([len(rows) for iteration, rows in batches], [2, 2, 1])
+        self.assertTrue(all(iteration == 7 for iteration, rows in batches))
+
+    @override_settings(SIMULATION_FLUSH_DAYS=0, SIMULATION_FLUSH_ROWS=3)
+    def test_row_ceiling(self):
+        results_queue = queue.Queue()
+        results_buffer = ResultsBuffer(results_queue, 1)
+        results_buffer.add_day([('DailyControls', (1, 1, False))] * 2)
+        self.assertEqual(results_queue.qsize(), 0)
+        results_buffer.add_day([('DailyControls', (1, 2, False))] * 2)
+        self.assertEqual(results_queue.qsize(), 1)
+        self.assertEqual(results_buffer.rows, [])
+
+    @override_settings(SIMULATION_FLUSH_DAYS=1, RESULTS_QUEUE_PUT_SECONDS=0.01)
+    def test_full_queue_without_a_writer(self):
+        writer = subprocess.Popen([sys.executable, '-c', 'pass'])
+        writer.wait()
+        results_queue = queue.Queue(1)
+        results_buffer = ResultsBuffer(results_queue, 1, writer.pid)
+        results_buffer.add_day([('DailyControls', (1, 1, False))])
+        with self.assertRaises(ResultsWriterGone):  # instead of waiting forever on the full queue
+            results_buffer.add_day([('DailyControls', (1, 2, False))])
+
+
+class ResultsWriterTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.production_types = [(1, "Cattle")]
+        self.zones = [(1, "Medium Risk")]
+        self.common_headers = "Run,Day,versionMajor,versionMinor,versionRelease"
+
+    @override_settings(RESULTS_QUEUE_PUT_SECONDS=0.01)
+    def test_shuts_down_once_the_simulation_is_gone(self):
+        results_queue = queue.Queue()
+        writer = ResultsWriter(results_queue)
+        writer.parent_pid = os.getpid()
+        results_queue.put((1, []))
+        self.assertEqual(writer.next_message(), (1, []))
+
+        simulation = subprocess.Popen([sys.executable, '-c', 'pass'])
+        simulation.wait()
+        writer.parent_pid = simulation.pid
+        self.assertIsNone(writer.next_message())
+
+    def test_unit_stats_applied_once_per_batch(self):
+        cattle = ProductionType.objects.create(name="Cattle")
+        units = [Unit.objects.create(production_type=cattle, latitude=45, longitude=-100, initial_size=10) for i in range(3)]
+        UnitStats.objects.bulk_create([UnitStats(unit=unit) for unit in units])
+        batch = []
+        for iteration in range(1, 3):
+            p = DailyParser(self.common_headers, self.production_types, self.zones)
+            self.assertTrue(p.parse_unit_stats_string("%i,1,0,1,0" % units[0].id))
+            self.assertFalse(p.parse_unit_stats_string("%i,0,0,0,0" % units[1].id))
+            self.assertTrue(p.parse_unit_stats_string("%i,0,1,0,%i" % (units[2].id, iteration - 1)))
+            batch.append((iteration, [('UnitStats', row) for row in p.unit_stats.rows()]))
+
+        ResultsWriter.write_batch(batch)
+
+        stats = {s.unit_id: (s.cumulative_infected, s.cumulative_zone_focus, s.cumulative_vaccinated, s.cumulative_destroyed)
+                 for s in UnitStats.objects.all()}
+        self.assertEqual(stats[units[0].id], (2, 0, 2, 0))
+        self.assertEqual(stats[units[1].id], (0, 0, 0, 0))
+        self.assertEqual(stats[units[2].id], (0, 2, 0, 1))
+
+    def test_iteration_timing_completed_by_writer(self):
+        header_line = self.common_headers + ",firstDetectionCattle,outbreakDuration\r\n"
+        p = DailyParser(header_line, self.production_types, self.zones)
+        write_totals = {}
+        first_day = p.parse_daily_rows("1,1,3,2,1,4,6")
+        ResultsWriter.write_batch([(1, first_day)], write_totals)
+        self.assertEqual(IterationTiming.objects.count(), 0)
+
+        last_day = p.parse_daily_rows("1,2,3,2,1,7,9", last_line=True)
+        ResultsWriter.write_batch([(1, last_day + [('IterationTiming', (1, 2.5, 1.0, 0.5))])], write_totals)
+
+        timing = IterationTiming.objects.get()
+        self.assertEqual((timing.iteration, timing.engine_cpu_seconds, timing.stdout_wait_seconds, timing.parse_seconds), (1, 2.5, 1.0, 0.5))
+        self.assertEqual(timing.rows_written, len(first_day) + len(last_day))
+        self.assertTrue(timing.write_seconds > 0)
+        self.assertEqual(write_totals, {})
+
+    def test_discard_keeps_rows_queued_after_it(self):
+        header_line = self.common_headers + ",outbreakDuration\r\n"
+        p = DailyParser(header_line, self.production_types, self.zones)
+        ResultsWriter.write_batch([(1, p.parse_daily_rows("1,1,3,2,1,4"))])
+
+        p = DailyParser(header_line, self.production_types, self.zones)
+        rerun = p.parse_daily_rows("1,1,3,2,1,5") + p.parse_daily_rows("1,2,3,2,1,6", last_line=True)
+        ResultsWriter.write_batch([(1, p.parse_daily_rows("1,1,3,2,1,4")), (1, None), (1, rerun)])
+
+        self.assertEqual(list(DailyControls.objects.order_by('day').values_list('outbreakDuration', flat=True)), [5, 6])
+
+
+class ResumeSimulationTestCase(TestCase):
+    multi_db = True
+
+    def test_no_run_to_resume(self):
+        self.assertEqual(unfinished_iterations(), [])
+
+    def test_discard_unfinished_iterations(self):
+        SimulationRun(iterations=3).save()
+        DailyControls.objects.create(iteration=1, day=1, last_day=False)
+        DailyControls.objects.create(iteration=1, day=2, last_day=True)
+        DailyControls.objects.create(iteration=2, day=1, last_day=False)
+        DailyByProductionType.objects.create(iteration=2, day=1, last_day=False)
+
+        self.assertEqual(discard_unfinished_iterations(), [2, 3])
+        self.assertEqual(list(DailyControls.objects.values_list('iteration', 'day').order_by('day')), [(1, 1), (1, 2)])
+        self.assertEqual(DailyByProductionType.objects.count(), 0)
+
+
+class OnlineStatisticsTestCase(TestCase):
+    multi_db = True
+
+    def test_sketch_is_exact_for_small_runs(self):
+        values = [random.randint(-1, 500) for i in range(999)]
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        for p in [0, 5, 25, 50, 75, 95, 100]:
+            self.assertAlmostEqual(sketch.percentile(p), numpy.percentile(values, p))
+
+    def test_compressed_sketch_merges(self):
+        values = [random.gauss(100, 15) for i in range(20000)]
+        left, right = QuantileSketch(), QuantileSketch()
+        for value in values[:12000]:
+            left.add(value)
+        for value in values[12000:]:
+            right.add(value)
+        left.merge(right)
+        self.assertLessEqual(len(left.centroids), QuantileSketch.exact_limit)
+        self.assertEqual(left.count(), 20000)
+        for p in [5, 50, 95]:
+            self.assertAlmostEqual(left.percentile(p), numpy.percentile(values, p), delta=1.0)
+
+    def test_welford_merge(self):
+        values = [random.uniform(0, 1000) for i in range(500)]
+        left, right = RunningStatistics(), RunningStatistics()
+        for value in values[:200]:
+            left.add(value)
+        for value in values[200:]:
+            right.add(value)
+        left.merge(right)
+        self.assertEqual(left.count, 500)
+        self.assertAlmostEqual(left.mean, statistics.mean(values))
+        self.assertAlmostEqual(left.std_dev(), statistics.pstdev(values))
+        self.assertEqual((left.low, left.high), (min(values), max(values)))
+
+    def test_accumulated_by_results_writer(self):
+        header_line = "Run,Day,versionMajor,versionMinor,versionRelease,infcU,outbreakDuration\r\n"
+        batch = []
+        for iteration, (infected, duration) in enumerate([(4, 10), (9, 30), (5, 20)], start=1):
+            p = DailyParser(header_line, [], [])
+            rows = p.parse_daily_rows("%i,1,3,2,1,1,1" % iteration)
+            rows += p.parse_daily_rows("%i,2,3,2,1,%i,%i" % (iteration, infected, duration), last_line=True)
+            batch.append((iteration, rows))
+        ResultsWriter.write_batch(batch[:2])
+        ResultsWriter.write_batch(batch[2:])  # picks up where the stored statistics left off
+
+        stored = LastDayStatistics.load()
+        infected = stored.get(DailyByProductionType, 'infcU')
+        self.assertEqual((infected.count, infected.mean, infected.low, infected.high, infected.median()), (3, 6, 4, 9, 5))
+        self.assertEqual(stored.get(DailyControls, 'outbreakDuration').median(), 20)
+        self.assertEqual(field_summary('infcU', statistics=stored), 5)
+        self.assertEqual(field_summary('outbreakDuration', DailyControls), 20)  # the scan agrees
+
+    def test_only_changed_fields_saved(self):
+        header_line = "Run,Day,versionMajor,versionMinor,versionRelease,infcU,outbreakDuration\r\n"
+        p = DailyParser(header_line, [], [])
+        statistics = LastDayStatistics()
+        statistics.add_rows(DailyControls, [row for table_name, row in p.parse_daily_rows("1,1,3,2,1,4,10", last_line=True) if table_name == 'DailyControls'])
+        statistics.save()
+        self.assertEqual(LastDayStatistic.objects.count(), 1)
+        LastDayStatistic.objects.update(centroids='[[10, 1]]', mean=99)  # would be overwritten if saved again
+
+        statistics.add_rows(DailyByProductionType, [row for table_name, row in p.parse_daily_rows("2,1,3,2,1,9,30", last_line=True) if table_name == 'DailyByProductionType'])
+        self.assertEqual(statistics.changed, {('DailyByProductionType', None, 'infcU')})
+        statistics.save()
+        self.assertEqual(LastDayStatistic.objects.get(table='DailyControls').mean, 99)
+
+        statistics.add_rows(DailyByProductionType, [row for table_name, row in p.parse_daily_rows("3,1,3,2,1,5,20", last_line=True) if table_name == 'DailyByProductionType'])
+        statistics.save()
+        self.assertEqual(LastDayStatistic.objects.count(), 2)
+        self.assertEqual(LastDayStatistics.load().get(DailyByProductionType, 'infcU').count, 2)
+
+
+class SummaryCSVTestCase(TestCase):
+    multi_db = True
+
+    def test_every_statistic_in_one_pass(self):
+        infected = [random.randint(0, 500) for i in range(50)]
+        for iteration, value in enumerate(infected, start=1):
+            DailyByProductionType.objects.create(iteration=iteration, day=3, last_day=True, infcUIni=value, firstDetection=None)
+            DailyByProductionType.objects.create(iteration=iteration, day=2, last_day=False, infcUIni=1000)
+        query_set = DailyByProductionType.objects.filter(last_day=True, production_type__isnull=True)
+        headers = ['Field Name', 'Explanation', 'Mean', 'StdDev', 'Low', 'High', 'p5', 'p25', 'p50', 'p75', 'p95']
+
+        infected_row, detection_row = SummaryCSVGenerator().summary_rows(['infcUIni', 'firstDetection'], query_set, headers)
+
+        self.assertAlmostEqual(infected_row['Mean'], statistics.mean(infected))
+        self.assertEqual(infected_row['StdDev'], round(statistics.pstdev(infected), 2))
+        self.assertEqual((infected_row['Low'], infected_row['High']), (min(infected), max(infected)))
+        self.assertIsInstance(infected_row['Low'], int)
+        for p in [5, 25, 50, 75, 95]:
+            self.assertAlmostEqual(infected_row['p%i' % p], numpy.percentile(infected, p))
+        self.assertEqual((detection_row['Mean'], detection_row['StdDev'], detection_row['Low'], detection_row['p50']), (None, "N/A", None, "N/A"))
+
+    def test_accumulated_statistics_before_a_scan(self):
+        for iteration in range(1, 4):
+            DailyByProductionType.objects.create(iteration=iteration, day=3, last_day=True, infcUIni=1000, firstDetection=iteration)
+        query_set = DailyByProductionType.objects.filter(last_day=True, production_type__isnull=True)
+        headers = ['Field Name', 'Explanation', 'Mean', 'StdDev', 'Low', 'High', 'p5', 'p25', 'p50', 'p75', 'p95']
+        accumulated = LastDayStatistics()
+        accumulated.fields[('DailyByProductionType', None, 'infcUIni')] = RunningStatistics()
+        for value in [1, 2, 6]:
+            accumulated.fields[('DailyByProductionType', None, 'infcUIni')].add(value)
+
+        infected_row, detection_row = SummaryCSVGenerator().summary_rows(['infcUIni', 'firstDetection'], query_set, headers, accumulated)
+
+        self.assertEqual((infected_row['Mean'], infected_row['Low'], infected_row['High']), (3, 1, 6))  # not scanned
+        self.assertEqual((detection_row['Mean'], detection_row['Low'], detection_row['High']), (2, 1, 3))
+
+    def test_summary_without_output(self):
+        headers, data = SummaryCSVGenerator().get_summary_data_table()
+        self.assertTrue(all(row['p95'] == "N/A" for row in data))
+
+
+class CombineOutputsTestCase(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, text):
+        with open(os.path.join(self.folder, name), 'w', newline='') as file:
+            file.write(text)
+
+    def read(self, name):
+        with open(os.path.join(self.folder, "Combined Outputs", name), newline='') as file:
+            return file.read()
+
+    def test_combined_in_iteration_order_with_one_header(self):
+        for iteration in [1, 2, 10]:
+            self.write('states_%i.csv' % iteration, "Run,Day,ID,State\n%i,1,1,I\n%i,2,1,R\n" % (iteration, iteration))
+        self.write('daily_events_1.csv', "Run,Day,Event\n1,1,x")  # no line ending on the last line
+        self.write('daily_events_2.csv', "Run,Day,Event\n2,1,y\n")
+
+        combine_outputs(self.folder, None, "Test Scenario")
+
+        self.assertEqual(self.read('combined_states.csv'), "Run,Day,ID,State\n1,1,1,I\n1,2,1,R\n2,1,1,I\n2,2,1,R\n10,1,1,I\n10,2,1,R\n")
+        self.assertEqual(self.read('combined_daily_events.csv'), "Run,Day,Event\n1,1,x\n2,1,y\n")
+        self.assertEqual(self.read('combined_daily_exposures.csv'), "")
+        metadata = self.read('combined_metadata.txt')
+        self.assertIn("Number of Iterations Run: 3\n", metadata)
+        self.assertIn("Total Number of Lines in States Combined Output: 7\n", metadata)
+        self.assertIn("Total Number of Lines in Events Combined Output: 3\n", metadata)
+
+    def test_appender_combines_iterations_as_they_finish(self):
+        appender = CombinedOutputsAppender(self.folder, "Test Scenario")
+        appender.start()
+        for iteration in [2, 1]:  # the order they finished in
+            self.write('states_%i.csv' % iteration, "Run,Day,ID,State\n%i,1,1,I\n" % iteration)
+            self.write('daily_events_%i.csv' % iteration, "Run,Day,Event\n%i,1,x" % iteration)
+            appender.add(iteration)
+        appender.close()
+
+        self.assertEqual(self.read('combined_states.csv'), "Run,Day,ID,State\n2,1,1,I\n1,1,1,I\n")
+        self.assertEqual(self.read('combined_daily_events.csv'), "Run,Day,Event\n2,1,x\n1,1,x\n")
+        self.assertEqual(self.read('combined_daily_exposures.csv'), "")
+        metadata = self.read('combined_metadata.txt')
+        self.assertIn("Number of Iterations Run: 2\n", metadata)
+        self.assertIn("Total Number of Lines in States Combined Output: 3\n", metadata)
+
+    def test_columnar_outputs_one_typed_file_per_iteration(self):
+        for iteration in [1, 2]:
+            self.write('states_%i.csv' % iteration, "Run,Day,ID,State\n%i,1,1,I\n%i,2,1,R\n" % (iteration, iteration))
+        self.write('daily_events_2.csv', "Run,Day,Event\n")
+
+        combine_outputs(self.folder, None, "Test Scenario", columnar=True)
+
+        columnar_folder = os.path.join(self.folder, COLUMNAR_FOLDER)
+        with open(os.path.join(columnar_folder, "index.json")) as index:
+            index = json.load(index)
+        self.assertEqual(sorted(index['states']), ['1', '2'])
+        self.assertEqual(index['states']['2']['rows'], 2)
+        self.assertEqual(index['daily_events']['2']['rows'], 0)
+        self.assertEqual(index['daily_exposures'], {})
+        states = read_columnar_iteration(columnar_folder, 'states', 2)
+        self.assertEqual(list(states['iteration']), [2, 2])
+        self.assertEqual(list(states['Day']), [1, 2])
+        self.assertEqual(states['Day'].dtype.kind, 'i')
+        self.assertEqual(list(states['State']), ['I', 'R'])
+        self.assertEqual(list(read_columnar_iteration(columnar_folder, 'states', 1, ['State'])), ['State'])
+
+    def test_columnar_outputs_read_in_chunks(self):
+        self.write('states_1.csv', "Run,Day,ID,State\n1,1,1,I\n1,2,1,R\n1,3,,Recovered\n1,4,1.5,S\n1,5,7,\n")
+        with patch('Results.combine_outputs.COLUMNAR_CHUNK_ROWS', 2):
+            combine_outputs(self.folder, None, "Test Scenario", columnar=True)
+
+        states = read_columnar_iteration(os.path.join(self.folder, COLUMNAR_FOLDER), 'states', 1)
+        self.assertEqual(list(states['Day']), [1, 2, 3, 4, 5])
+        self.assertEqual(states['ID'].dtype.kind, 'f')  # whole numbers until the third chunk
+        self.assertEqual(list(states['ID'][[0, 3, 4]]), [1, 1.5, 7])
+        self.assertEqual(list(states['State']), ['I', 'R', 'Recovered', 'S', ''])
+
+
+class SupplementalTablesTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, text):
+        with open(os.path.join(self.folder, name), 'w', newline='') as file:
+            file.write(text)
+
+    def query(self, sql):
+        cursor = connections['scenario_db'].cursor()
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    def test_files_loaded_into_typed_indexed_tables(self):
+        self.write('daily_exposures_1.csv', "Run,Day,SourceID,RecipientID\n1,1,4,7\n1,2,7,9\n")
+        self.write('daily_exposures_2.csv', "Run,Day,SourceID,RecipientID\n2,1,4,5\n")
+        self.write('states_2.csv', "Run,Day,ID,State\n2,1,4,I\n2,2,4,\n")
+
+        with override_settings(SIMULATION_FLUSH_ROWS=1):
+            loaded = load_supplemental_tables(self.folder, processes=2)
+
+        self.assertEqual(loaded, {'Supplemental_daily_exposures': 3, 'Supplemental_states': 2})
+        self.assertEqual(self.query('SELECT iteration, Day, RecipientID FROM Supplemental_daily_exposures WHERE SourceID = 7'), [(1, 2, 9)])
+        self.assertEqual(self.query('SELECT iteration, Day, State FROM Supplemental_states ORDER BY Day'), [(2, 1, 'I'), (2, 2, None)])
+        indexes = {row[0] for row in self.query("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name LIKE 'Supplemental_%'")}
+        self.assertIn('Supplemental_daily_exposures_iteration_Day', indexes)
+        self.assertIn('Supplemental_daily_exposures_SourceID_iteration', indexes)
+        self.assertIn('Supplemental_states_ID_iteration', indexes)
+
+        load_supplemental_tables(self.folder, processes=1)  # replaces what was loaded before
+        self.assertEqual(self.query('SELECT COUNT(*) FROM Supplemental_daily_exposures'), [(3,)])
+        drop_supplemental_tables()
+        self.assertEqual(supplemental_tables(), [])
+
+    def test_column_typed_by_every_value(self):
+        self.write('daily_events_1.csv', "Run,Day,Reason\n1,1,\n1,2,3\n1,3,2.5\n1,4,Ring\n")
+        load_supplemental_tables(self.folder, processes=1)
+        self.assertEqual(self.query('SELECT typeof(Reason) FROM Supplemental_daily_events ORDER BY Day'), [('null',), ('text',), ('text',), ('text',)])
+
+    def test_family_that_failed_is_dropped(self):
+        self.write('daily_exposures_1.csv', "Run,Day,SourceID,RecipientID\n1,1,4,7\n")
+        self.write('states_1.csv', "Run,Day,ID,State\n1,1,4,I\n")
+        os.mkdir(os.path.join(self.folder, 'states_2.csv'))  # can't be opened
+        loaded = load_supplemental_tables(self.folder, processes=2)
+        self.assertEqual(loaded, {'Supplemental_daily_exposures': 1})
+        self.assertEqual(supplemental_tables(), ['Supplemental_daily_exposures'])
+
+    @override_settings(RESULTS_QUEUE_PUT_SECONDS=0.01)
+    def test_reader_killed_mid_file(self):
+        reader = multiprocessing.Process(target=os._exit, args=(1,))
+        reader.start()
+        reader.join()
+        results_queue = queue.Queue()
+        results_queue.put(('states', 1, ['Run', 'Day'], [(1, 1, 1)]))  # the rest of the file never comes
+        with self.assertRaises(SupplementalReaderGone):  # instead of waiting forever for the end of the file
+            write_supplemental_rows(results_queue, 1, readers=[reader])
+
+
+class TimeSeriesMatrixTestCase(TestCase):
+    multi_db = True
+
+    def test_ragged_iterations_padded_with_their_last_value(self):
+        for iteration, costs in [(2, [1.0, 2.0, 3.0]), (5, [4.0])]:  # iterations don't have to be numbered from 1
+            for day, cost in enumerate(costs, 1):
+                DailyControls.objects.create(iteration=iteration, day=day, costSurveillance=cost, last_day=day == len(costs))
+
+        lines, columns = create_time_series_lines('costSurveillance', DailyControls)
+        self.assertEqual(columns, ['Day', 'Iteration 2', 'Iteration 5'])
+        numpy.testing.assert_array_equal(lines, [[1, 2, 3], [4, numpy.nan, numpy.nan]])
+
+        time_series = extend_last_day_lines(lines, DailyControls, 'costSurveillance')
+        numpy.testing.assert_array_equal(time_series, [[1, 2, 3], [4, 4, 4]])
+        self.assertEqual(list(collect_boxplot_data(time_series, "Surveillance Cost")), [3, 4])
+        self.assertEqual(list(collect_boxplot_data(numpy.array([[1, 0, 2], [0, 0, 3]]), "New Units")), [1, 2, 3])
+
+        lines, columns = create_time_series_lines('costSurveillance', DailyControls, iteration=5)
+        numpy.testing.assert_array_equal(lines, [[4]])
+
+    def test_graph_data_downsampled_to_width(self):
+        for iteration, costs in [(1, [1.0, 5.0, 2.0, 2.0]), (2, [3.0])]:
+            for day, cost in enumerate(costs, 1):
+                DailyControls.objects.create(iteration=iteration, day=day, costSurveillance=cost, last_day=day == len(costs))
+
+        days, reduced = downsample(numpy.array([[1.0, 5.0, 2.0, 2.0]]), 2)
+        self.assertEqual(list(days), [1, 3])
+        self.assertEqual(reduced.tolist(), [[5.0, 2.0]])  # each column keeps its largest day
+
+        request = RequestFactory().get('/results/DailyControls/costSurveillance/Graph.json', {'width': 3})
+        with patch('Results.graphing.GRAPH_JSON_WIDTHS', [2, 4]):  # 3 is drawn 2 wide
+            data = json.loads(graph_field_json(request, 'DailyControls', 'costSurveillance').content.decode())
+        self.assertEqual(data['days'], [1, 3])
+        self.assertEqual(data['series'], {'Iteration 1': [5.0, 2.0], 'Iteration 2': [3.0, 3.0]})
+        self.assertEqual(data['quantiles']['50'], [4.0, 2.5])
+        self.assertEqual(data['mean'], [4.0, 2.5])
+        self.assertEqual(data['boxplot']['count'], 2)
+        self.assertEqual(data['boxplot']['median'], 2.5)  # the last days, 2 and 3
+
+        request = RequestFactory().get('/results/DailyControls/costSurveillance/1/Graph.json', {'width': 'wide'})
+        self.assertEqual(graph_field_json(request, 'DailyControls', 'costSurveillance', '1').status_code, 400)
+        for width in [0, 99, 2001, 10 ** 9]:
+            request = RequestFactory().get('/results/DailyControls/costSurveillance/Graph.json', {'width': width})
+            self.assertEqual(graph_field_json(request, 'DailyControls', 'costSurveillance').status_code, 400)
+
+    def test_histogram_of_blank_iterations(self):
+        boxplot_graph, fig, gs, time_graph = create_figure_with_boxplot("Blank", False)
+        response = TwoD_histogram(fig, gs, time_graph, numpy.full((60, 3), numpy.nan))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(time_graph.collections, [])  # nothing drawn
+
+    def test_standard_graphs_skip_empty_fields(self):
+        Zone.objects.create(name='Medium Risk', radius=1)
+        DailyControls.objects.create(iteration=1, day=1, costSurveillance=2.0, last_day=True)
+        self.assertEqual(standard_graphs(), [('DailyControls', 'costSurveillance', '', '')])
+
+        self.addCleanup(setattr, Results.graphing, 'prerender_fingerprint', None)
+        Results.graphing.prerender_fingerprint = 'from output that was deleted'
+        self.assertFalse(prerender_graph(('DailyControls', 'costSurveillance', '', '')))
+
+    def test_prerendered_once_the_run_is_finished(self):
+        self.addCleanup(setattr, Results.utils, 'prerenderer', None)
+        SimulationRun(iterations=1).save()
+        DailyControls.objects.create(iteration=1, day=1, costSurveillance=2.0, last_day=True)
+        with patch('Results.graphing.GraphPrerenderer.start') as start, patch('Results.graphing.GraphPrerenderer.is_alive', return_value=False):
+            prerender_graphs()
+            self.assertFalse(start.called)  # the run isn't finished
+
+            SimulationRun.objects.update(finished=timezone.now())
+            prerender_graphs()
+            prerender_graphs()  # once for each run
+            self.assertEqual(start.call_count, 1)
+
+
+class GraphCacheTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.renders = []
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def render(self, content):
+        return lambda: self.renders.append(content) or HttpResponse(content, content_type='image/png')
+
+    def test_graph_drawn_again_only_when_output_changes(self):
+        SimulationRun(iterations=2).save()
+        key = ('graph_field_png', 'DailyControls', 'infcU', '', '')
+        self.assertEqual(cached_png(key, self.render(b'first'), self.folder).content, b'first')
+        self.assertEqual(cached_png(key, self.render(b'second'), self.folder).content, b'first')
+        self.assertEqual(self.renders, [b'first'])
+
+        SimulationRun.objects.update(last_written=timezone.now())
+        self.assertEqual(cached_png(key, self.render(b'third'), self.folder).content, b'third')
+
+    def test_least_recently_used_graphs_evicted(self):
+        for name, used in [('old', 100), ('viewed', 300), ('new', 200)]:
+            path = os.path.join(self.folder, name + '.png')
+            with open(path, 'wb') as png:
+                png.write(b'x' * 10)
+            os.utime(path, (used, used))
+        evict_graphs(self.folder, max_bytes=20)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['new.png', 'viewed.png'])
+        evict_graphs(self.folder, max_bytes=10)
+        self.assertEqual(os.listdir(self.folder), ['viewed.png'])
+
+
+class ResultsCacheTestCase(TestCase):
+    multi_db = True
+
+    def test_cached_until_output_changes(self):
+        SimulationRun(iterations=2).save()
+        calls = []
+        compute = lambda: calls.append(1) or {'Median': [["Infected", 5]]}
+        self.assertEqual(cached('summary', compute), {'Median': [["Infected", 5]]})
+        self.assertEqual(cached('summary', compute), {'Median': [["Infected", 5]]})
+        self.assertEqual(len(calls), 1)
+
+        ResultsWriter.write_batch([(1, [('DailyControls', (1, 1, True) + (None,) * (len(insert_fields(DailyControls)) - 3))])])
+        cached('summary', compute)
+        self.assertEqual(len(calls), 2)
+
+        delete_all_outputs()
+        self.assertEqual(ResultsCache.objects.count(), 0)
+
+
+class ConvergenceTestCase(TestCase):
+    multi_db = True
+
+    def output_settings(self, statistic, tolerance=0.05):
+        return OutputSettings(stop_on_convergence=True, convergence_fields='infcU, outbreakDuration', convergence_statistic=statistic,
+                              convergence_tolerance=tolerance, convergence_min_iterations=10)
+
+    def accumulated(self, infected, durations):
+        accumulated = LastDayStatistics()
+        for key, values in [(('DailyByProductionType', None, 'infcU'), infected), (('DailyControls', None, 'outbreakDuration'), durations)]:
+            accumulated.fields[key] = RunningStatistics()
+            for value in values:
+                accumulated.fields[key].add(value)
+        return accumulated
+
+    def test_confidence_interval_of_the_mean(self):
+        monitor = ConvergenceMonitor(self.output_settings('mean'))
+        self.assertEqual([name for model, name in monitor.fields], ['infcU', 'outbreakDuration'])
+        self.assertFalse(monitor.check(self.accumulated([100] * 9, [50] * 9)))  # not enough iterations yet
+        self.assertFalse(monitor.check(self.accumulated([90, 110] * 10, [10, 90] * 10)))
+        self.assertTrue(monitor.check(self.accumulated([90, 110] * 50, [49, 51] * 50)))
+        infected = monitor.evidence[0]
+        self.assertEqual((infected['field'], infected['iterations'], infected['mean']), ('infcU', 100, 100))
+        self.assertAlmostEqual(infected['half_width'], 1.96 * statistics.stdev([90, 110] * 50) / 10, places=3)
+
+    def test_median_stability(self):
+        monitor = ConvergenceMonitor(self.output_settings('median', tolerance=0.01))
+        self.assertFalse(monitor.check(self.accumulated([100] * 40, [50] * 40)))  # nothing to compare with yet
+        self.assertFalse(monitor.check(self.accumulated([100] * 40 + [150] * 40, [50] * 80)))
+        self.assertAlmostEqual(monitor.evidence[0]['relative_error'], 0.2)  # 125 against 100 at 40 iterations
+        self.assertFalse(monitor.check(self.accumulated([100] * 40 + [150] * 160, [50] * 200)))
+        self.assertTrue(monitor.check(self.accumulated([100] * 40 + [150] * 210, [50] * 250)))
+        self.assertEqual(monitor.evidence[1]['earlier_median'], 50)
+
+    def test_pool_stops_scheduling(self):
+        pending, stopped = deque(range(1, 21)), threading.Event()
+        pool = ThreadPool(2)
+        finished = []
+        for result in pool_results(pool, pending, lambda iteration: (pow, (iteration, 2)), 4, stopped):
+            finished.append(result)
+            if len(finished) == 5:
+                stopped.set()
+        pool.close()
+        pool.join()
+        self.assertEqual(len(finished), 8)  # the ones already handed to the pool still finish
+        self.assertEqual(list(pending), list(range(9, 21)))
+
+    def test_stopped_run_has_nothing_to_resume(self):
+        SimulationRun(iterations=100, stopped_after=2).save()
+        DailyControls.objects.create(iteration=1, day=1, last_day=True)
+        DailyControls.objects.create(iteration=2, day=1, last_day=True)
+        self.assertEqual(unfinished_iterations(), [])
+
+
+class IterationLogTestCase(TestCase):
+    def setUp(self):
+        self.log_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_path)
+
+    def write_log(self, mode, problem=False):
+        with IterationLog(self.log_path, 1, mode) as log:
+            log.output("1,1,3,2,1\n")
+            if problem:
+                log.problem("LOG: FINAL ERRORS:\nsegfault\n")
+        return sorted(os.listdir(self.log_path))
+
+    def test_log_modes(self):
+        self.assertEqual(self.write_log('off', problem=True), [])
+        self.assertEqual(self.write_log('errors'), [])
+        self.assertEqual(self.write_log('errors', problem=True), ['iteration1.log'])
+        with open(os.path.join(self.log_path, 'iteration1.log')) as log:
+            self.assertEqual(log.read(), "LOG: FINAL ERRORS:\nsegfault\n")
+        self.assertEqual(self.write_log('full-gzip', problem=True), ['iteration1.log', 'iteration1.log.gz'])
+        with gzip.open(os.path.join(self.log_path, 'iteration1.log.gz'), 'rt') as log:
+            self.assertEqual(log.read(), "1,1,3,2,1\nLOG: FINAL ERRORS:\nsegfault\n")
+
+    def test_discarded_logs_are_moved_before_deleting(self):
+        for name in ['iteration1.log', 'iteration2.log.gz', 'output.log']:
+            open(os.path.join(self.log_path, name), 'w').close()
+        discard_logs(self.log_path, ['iteration1.log', 'iteration2.log.gz'])
+        self.assertEqual([f for f in os.listdir(self.log_path) if not f.startswith('deleting')], ['output.log'])
+
+
+class EngineProcessTestCase(TestCase):
+    def fake_engine(self, script):
+        return EngineProcess([sys.executable, '-c', 'import sys, time\n' + script])
+
+    @override_settings(SIMULATION_WATCHDOG_SECONDS=1)
+    def test_watchdog_kills_a_stalled_engine(self):
+        engine = self.fake_engine("print('headers', flush=True)\ntime.sleep(60)")
+        self.assertEqual(engine.readline(), b'headers\n')
+        with self.assertRaises(EngineHung):
+            engine.readline()
+        self.assertIsNotNone(engine.process.poll())
+
+    def test_kill(self):
+        engine = self.fake_engine("time.sleep(60)")
+        engine.kill()
+        self.assertIsNotNone(engine.process.poll())
+        for reader in engine.readers:
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+
+    @override_settings(SIMULATION_WATCHDOG_SECONDS=30)
+    def test_stderr_flood_does_not_block_stdout(self):
+        engine = self.fake_engine("for i in range(2000): sys.stderr.write('x' * 999 + '\\n')\n"  # far more than a pipe holds
+                                  "print('1,1,3', flush=True)")
+        self.assertEqual(engine.readline(), b'1,1,3\n')
+        outs, errors = engine.communicate()
+        self.assertEqual(outs, b'')
+        self.assertEqual(len(errors), 2000 * 1000)
+
+    @override_settings(SIMULATION_STDOUT_MAX_LINES=10)
+    def test_engine_waits_on_its_pipe(self):
+        engine = self.fake_engine("for i in range(5000): print(i)")
+        time.sleep(1)
+        self.assertLessEqual(engine.stdout_lines.qsize(), 10)
+        self.assertEqual(len(engine.readlines()), 5000)
+        engine.communicate()
+
+
+class OutputIndexTestCase(TestCase):
+    multi_db = True
+
+    def test_indexes_dropped_for_ingestion_and_rebuilt(self):
+        DailyControls.objects.create(iteration=1, day=1, last_day=True)
+        index_names = set(output_index_sql())
+        self.assertIn('Results_dailybyproductiontype_last_day_production_type_id', index_names)
+
+        drop_output_indexes()
+        self.assertEqual(existing_indexes(tables=[DailyByZone._meta.db_table]), set())  # Django's foreign key index too
+        self.assertEqual(existing_indexes() & index_names, set())
+        self.assertTrue(output_indexes_missing())
+
+        build_output_indexes()
+        self.assertEqual(existing_indexes() & index_names, index_names)
+        self.assertFalse(output_indexes_missing())
+        build_output_indexes()  # nothing left to build
+
+
+@override_settings(SIMULATION_AGENT_AUTHKEY=b'test agents')
+class AgentCoordinatorTestCase(TestCase):
+    multi_db = True
+
+    def connect_agent(self, address, processes):
+        agent = Client(address, authkey=b'test agents')
+        agent.send(('hello', 'test agent', processes))
+        kind, scenario_name, production_types, zones = agent.recv()
+        scenario = b''.join(iter(agent.recv_bytes, b''))
+        self.assertTrue(scenario.startswith(b'SQLite format 3'))
+        return agent
+
+    def run_iterations(self, agent):
+        for kind, *arguments in iter(agent.recv, ('stop',)):
+            iteration = arguments[0]
+            agent.send(('rows', iteration, [('DailyControls', (iteration, 1, False))]))
+            agent.send(('rows', iteration, [('DailyControls', (iteration, 2, True)), ('IterationTiming', (iteration, 1.0, 0.5, 0.1))]))
+            agent.send(('done', iteration, 2.0, None, None))
+        agent.close()
+
+    def test_lost_lease_is_discarded_and_leased_again(self):
+        results_queue = queue.Queue()
+        coordinator = AgentCoordinator([1, 2, 3], results_queue, [], [], address=('localhost', 0))
+        finished = []
+        collecting = threading.Thread(target=lambda: finished.extend(coordinator.results()))
+        collecting.start()
+
+        lost_agent = self.connect_agent(coordinator.address, 1)
+        kind, lost_iteration = lost_agent.recv()
+        lost_agent.send(('rows', lost_iteration, [('DailyControls', (lost_iteration, 1, False))]))
+        lost_agent.close()  # dies before its iteration is done
+
+        threading.Thread(target=self.run_iterations, args=(self.connect_agent(coordinator.address, 2),)).start()
+        collecting.join(30)
+
+        self.assertEqual(sorted(result[0] for result in finished), [1, 2, 3])
+        messages = [results_queue.get_nowait() for i in range(results_queue.qsize())]
+        self.assertEqual(messages[:2], [(lost_iteration, [('DailyControls', (lost_iteration, 1, False))]), (lost_iteration, None)])
+        last_days = [iteration for iteration, rows in messages[2:] if rows and any(row[2] for table, row in rows if table == 'DailyControls')]
+        self.assertEqual(sorted(last_days), [1, 2, 3])
+
+    def test_stop_leasing_keeps_iterations_taken_back_from_a_lost_agent(self):
+        results_queue = queue.Queue()
+        coordinator = AgentCoordinator([1, 2, 3, 4], results_queue, [], [], address=('localhost', 0))
+        finished = []
+        collecting = threading.Thread(target=lambda: finished.extend(coordinator.results()))
+        collecting.start()
+
+        lost_agent = self.connect_agent(coordinator.address, 1)
+        kind, lost_iteration = lost_agent.recv()
+        lost_agent.close()
+        self.assertEqual(results_queue.get(timeout=30), (lost_iteration, None))
+        deadline = time.time() + 30
+        while lost_iteration not in coordinator.pending and time.time() < deadline:
+            time.sleep(0.01)
+
+        dropped = coordinator.stop_leasing()
+        self.assertEqual(dropped, [2, 3, 4])  # a convergence stop after lost_iteration can't leave it unfinished
+        threading.Thread(target=self.run_iterations, args=(self.connect_agent(coordinator.address, 2),)).start()
+        collecting.join(30)
+
+        self.assertEqual([result[0] for result in finished], [lost_iteration])
+        self.assertTrue(min(dropped) > max(result[0] for result in finished))
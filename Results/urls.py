@@ -8,12 +8,14 @@ from django.conf.urls import patterns, url
 
 urlpatterns = patterns('', url('^$', 'Results.views.results_home'),
          url('^RunSimulation/$', 'Results.views.run_simulation'),
+         url('^ResumeSimulation/$', 'Results.views.resume_simulation'),
          url('^Population\.png$', 'Results.graphing.population_png'),
          url('^population_d3_map/$', 'Results.interactive_graphing.population_d3_map'),
          url('^population_thumbnail\.png$', 'Results.interactive_graphing.population_thumbnail_png'),
          url('^population_zoom\.png$', 'Results.interactive_graphing.population_zoom_png'),
          url('^(?P<model_name>\w+)/(?P<field_name>\w+)/(?P<iteration>\d*)/?$', 'Results.views.graph_field'),
          url('^(?P<model_name>\w+)/(?P<field_name>\w+)/(?P<iteration>\d*)/?(?P<zone>[^/]*)/?Graph\.png$', 'Results.graphing.graph_field_png'),
+         url('^(?P<model_name>\w+)/(?P<field_name>\w+)/(?P<iteration>\d*)/?(?P<zone>[^/]*)/?Graph\.json$', 'Results.graphing.graph_field_json'),
          url('^Inputs/$', 'Results.views.back_to_inputs'),
          url('^simulation_status.json$', 'Results.views.simulation_status'),
          url('^abort_simulation$', 'Results.utils.abort_simulation'),
@@ -32,4 +34,12 @@ urlpatterns = patterns('', url('^$', 'Results.views.results_home'),
          url('^UnitStats/$',                          'Results.views.model_list'),
          url('^UnitStats/prefix/(?P<prefix>\w{1,4})/$',  'Results.views.filtered_list'),
          url('^ResultsVersion/$',                          'Results.views.model_list'),
-         url('^ResultsVersion/prefix/(?P<prefix>\w{1,4})/$',  'Results.views.filtered_list'))
\ No newline at end of file
+         url('^ResultsVersion/prefix/(?P<prefix>\w{1,4})/$',  'Results.views.filtered_list'),
+         url('^SimulationRun/$',                          'Results.views.model_list'),
+         url('^SimulationRun/prefix/(?P<prefix>\w{1,4})/$',  'Results.views.filtered_list'),
+         url('^IterationTiming/$',                          'Results.views.model_list'),
+         url('^IterationTiming/prefix/(?P<prefix>\w{1,4})/$',  'Results.views.filtered_list'),
+         url('^LastDayStatistic/$',                          'Results.views.model_list'),
+         url('^LastDayStatistic/prefix/(?P<prefix>\w{1,4})/$',  'Results.views.filtered_list'),
+         url('^ResultsCache/$',                          'Results.views.model_list'),
+         url('^ResultsCache/prefix/(?P<prefix>\w{1,4})/$',  'Results.views.filtered_list'))
\ No newline at end of file
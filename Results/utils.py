@@ -70,6 +70,29 @@ def zip_map_directory_if_it_exists():
         print("Folder is empty: ", dir_to_zip)
 
 
+PRERENDERED = 'graphs prerendered'
+prerenderer = None  # the GraphPrerenderer started by prerender_graphs in this process
+
+
+def prerender_graphs():
+    """Starts a GraphPrerenderer once for each finished run.  It is started by the web server rather than by the
+    Simulation, so the run is over without waiting on it, and abort_simulation can stop it."""
+    global prerenderer
+    from Results.graphing import GraphPrerenderer
+    from Results.models import SimulationRun
+    from Results.results_cache import results_fingerprint, cached_value, store_value
+    if prerenderer is not None and prerenderer.is_alive():
+        return
+    run = SimulationRun.objects.first()
+    if run is None or run.finished is None or is_simulation_running():
+        return
+    fingerprint = results_fingerprint()
+    if cached_value(PRERENDERED, fingerprint) is None:
+        store_value(PRERENDERED, True, fingerprint)
+        prerenderer = GraphPrerenderer()
+        prerenderer.start()  # starts a new thread
+
+
 def abort_simulation(request=None):
     # Import these things locally since several other modules import this utils
     from django.db import close_old_connections
@@ -80,18 +103,46 @@ def abort_simulation(request=None):
     for process in get_simulation_controllers():
         print("Aborting Simulation Thread")
         process.kill()
+    if prerenderer is not None and prerenderer.is_alive():
+        prerenderer.stop()
 
     if request is not None:
         return redirect('/results/')
 
 
 def delete_all_outputs():
-    from Results.models import DailyControls, DailyByZone, DailyByProductionType, DailyByZoneAndProductionType, UnitStats, ResultsVersion
+    from Results.models import DailyControls, DailyByZone, DailyByProductionType, DailyByZoneAndProductionType, UnitStats, ResultsVersion, SimulationRun, IterationTiming, LastDayStatistic, ResultsCache
+    from Results.ingestion import drop_output_indexes
+    from Results.supplemental_tables import drop_supplemental_tables
     abort_simulation()
     if DailyControls.objects.count() > 0:
         print("DELETING ALL OUTPUTS")
-    for model in [DailyControls, DailyByZone, DailyByProductionType, DailyByZoneAndProductionType, UnitStats, ResultsVersion]:
+    drop_output_indexes()  # faster to delete without them, the next run builds them again
+    for model in [DailyControls, DailyByZone, DailyByProductionType, DailyByZoneAndProductionType, UnitStats, ResultsVersion, SimulationRun, IterationTiming, LastDayStatistic, ResultsCache]:
         model.objects.all().delete()
+    drop_supplemental_tables()
     SmSession.objects.all().update(iteration_text = '', simulation_has_started=False)  # This is also reset from open_scenario
     if os.path.isdir(workspace_path(scenario_filename() + "/" + "Supplemental Output Files")):
         shutil.rmtree(workspace_path(scenario_filename() + "/" + "Supplemental Output Files"), ignore_errors=True)
+
+
+def unfinished_iterations():
+    """Iteration numbers of the last run that never wrote their last day.  Empty if there is no run to resume.  Once the
+    stopping rule ended a run, the iterations it never started are not unfinished."""
+    from Results.models import DailyControls, SimulationRun
+    run = SimulationRun.objects.first()
+    if run is None:
+        return []
+    finished = set(DailyControls.objects.filter(last_day=True).values_list('iteration', flat=True))
+    return [iteration for iteration in range(1, (run.stopped_after or run.iterations) + 1) if iteration not in finished]
+
+
+def discard_unfinished_iterations():
+    """Deletes the days already streamed for iterations that never finished so they can be run again from the start.
+    Finished iterations are left alone: their last day and UnitStats were committed together, so none of their output
+    has to be written again."""
+    from Results.models import DailyControls, DailyByZone, DailyByProductionType, DailyByZoneAndProductionType
+    finished = DailyControls.objects.filter(last_day=True).values('iteration')  # a subquery, there can be more iterations than SQLite allows parameters
+    for model in [DailyByZone, DailyByProductionType, DailyByZoneAndProductionType, DailyControls]:
+        model.objects.exclude(iteration__in=finished).delete()
+    return unfinished_iterations()
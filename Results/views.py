@@ -1,6 +1,7 @@
 from collections import defaultdict
 from itertools import chain
 import os
+import json
 from glob import glob
 
 from django.http import HttpResponse, JsonResponse, HttpResponseNotAllowed, HttpResponseBadRequest, HttpResponseNotFound
@@ -13,14 +14,16 @@ from django.utils.html import mark_safe
 from ADSMSettings.models import SmSession
 from ADSMSettings.utils import workspace_path, scenario_filename
 from ScenarioCreator.models import OutputSettings
-from Results.graphing import construct_title
+from Results.graphing import construct_title, GRAPH_EXCLUDED_FIELDS
 from Results.forms import *  # necessary
 from Results.simulation import Simulation
-from Results.utils import delete_supplemental_folder, map_zip_file, delete_all_outputs, is_simulation_stopped, is_simulation_running
+from Results.utils import delete_supplemental_folder, map_zip_file, delete_all_outputs, is_simulation_stopped, is_simulation_running, discard_unfinished_iterations, prerender_graphs
 import Results.output_parser
-from Results.summary import list_of_iterations, iterations_complete
+from Results.summary import list_of_iterations, iterations_complete, iterations_total, iteration_timing_totals
 from Results.csv_generator import SummaryCSVGenerator, SUMMARY_FILE_NAME
 from Results.combine_outputs import CombineOutputsGenerator
+from Results.ingestion import OutputIndexBuilder, output_indexes_missing
+from Results.results_cache import cached, cached_value
 
 
 def back_to_inputs(request):
@@ -29,18 +32,38 @@ def back_to_inputs(request):
 
 
 def simulation_status(request):
-    output_settings = OutputSettings.objects.get()
+    if is_simulation_stopped():
+        prerender_graphs()
     status = {
         'is_simulation_stopped': is_simulation_stopped(),
         'simulation_has_started': SmSession.objects.get().simulation_has_started,
-        'iterations_total': output_settings.iterations,
+        'iterations_total': iterations_total(),
         'iterations_started': len(list_of_iterations()),
         'iterations_completed': iterations_complete(),
         'iteration_text': mark_safe(SmSession.objects.get().iteration_text),
+        'timings': iteration_timing_totals(),
     }
+    run = SimulationRun.objects.first()
+    if run is not None and run.convergence:
+        status['convergence'] = json.loads(run.convergence)
+        status['stopped_after'] = run.stopped_after
+    if 'timings' in request.GET:  # ?timings lists every finished iteration
+        status['iteration_timings'] = list(IterationTiming.objects.order_by('iteration').values(
+            'iteration', 'engine_cpu_seconds', 'stdout_wait_seconds', 'parse_seconds', 'write_seconds', 'lock_wait_seconds', 'rows_written'))
     return JsonResponse(status)
 
 
+index_builder = None  # the OutputIndexBuilder started by results_home
+
+
+def build_missing_output_indexes():
+    """Starts an OutputIndexBuilder unless the indexes are all there or one is already building them"""
+    global index_builder
+    if (index_builder is None or not index_builder.is_alive()) and output_indexes_missing():
+        index_builder = OutputIndexBuilder()
+        index_builder.start()  # starts a new thread
+
+
 def results_home(request):
     from Results.csv_generator import SUMMARY_FILE_NAME
     path_ex = workspace_path(scenario_filename() + "/" + "Supplemental Output Files")
@@ -66,7 +89,10 @@ def results_home(request):
         context['supplemental_files'].append(os.path.relpath(map_zip_file(), start=start))
     # TODO: value dict file sizes
     if DailyControls.objects.all().count() > 0:
-        context['summary'] = Results.summary.summarize_results()
+        if not is_simulation_running():
+            build_missing_output_indexes()  # in case the run that wrote these was aborted before it could
+            prerender_graphs()
+        context['summary'] = cached('summary', Results.summary.summarize_results, store=not is_simulation_running())
         context['iterations'] = len(list_of_iterations())
         context['population_eta'] = Unit.objects.count() / 650  # estimate slow map calc in matplotlib
         try:
@@ -105,6 +131,21 @@ def run_simulation(request):
     return redirect('/results/')
 
 
+def resume_simulation(request):
+    """Picks an aborted or interrupted run back up.  Only the iterations without a last day are run again, everything
+    that was already committed stays where it is."""
+    run = SimulationRun.objects.first()
+    if run is None or is_simulation_running():
+        return redirect('/results/')
+    iterations = discard_unfinished_iterations()
+    if iterations:
+        SmSession.objects.all().update(simulation_crashed=False, crash_text=None)  # the crash that stopped it is history
+        print("Resuming Simulation run at %s, %i of %i iterations left" % (djtimezone.now(), len(iterations), run.iterations))
+        sim = Simulation(run.iterations, iterations=iterations)
+        sim.start()  # starts a new thread
+    return redirect('/results/')
+
+
 def list_entries(model_name, model, iteration=1):
     return model.objects.filter(iteration=iteration)[:200],
 
@@ -206,10 +247,7 @@ def result_table(request, model_name, model_class, model_form, graph_links=False
         context['Zones'] = Zone.objects.all()
         context['iterations'] = iterations[:5]  # It's pointless to display links to more than the first 10 iterations, there can be thousands
         context['model_name'] = model_name
-        context['excluded_fields'] = ['zone', 'production_type', 'day', 'iteration', 'id', 'pk', 'last_day']
-        context['excluded_fields'] += ['vacwU', 'vacwUMax', 'vacwUMaxDay', 'vacwUTimeMax', 'vacwUTimeAvg',
-                                       'vacwUDaysInQueue', 'vacwA', 'vacwAMax', 'vacwAMaxDay', 'vacATimeMax',
-                                       'vacATimeAvg', 'vacwADaysInQueue', 'vacwATimeMax', 'vacwATimeAvg']
+        context['excluded_fields'] = list(GRAPH_EXCLUDED_FIELDS)
         context['excluded_fields'] += [field for field in model_class._meta.get_all_field_names() if not field.startswith(prefix)]
         context['empty_fields'] = all_empty_fields(model_class, context['excluded_fields'])
         context['headers'] = class_specific_headers(model_name, prefix)
@@ -238,6 +276,12 @@ def filtered_list(request, prefix):
     return result_table(request, model_name, model, globals()[model_name + 'Form'], True, prefix)
 
 
+def summary_csv_is_current():
+    """Summary.csv is only current if it was written from the output as it is now, a resumed run adds iterations"""
+    path = workspace_path(scenario_filename() + "/" + "Supplemental Output Files" + '/' + SUMMARY_FILE_NAME)
+    return os.path.isfile(path) and cached_value(SUMMARY_FILE_NAME) is not None
+
+
 def summary_csv(request):
     class HttpResponseAccepted(HttpResponse):
         status_code = 202
@@ -247,11 +291,13 @@ def summary_csv(request):
             return HttpResponseAccepted()
         elif not DailyControls.objects.all().count() or is_simulation_running():
             return HttpResponseBadRequest()
-        elif not os.path.isfile(workspace_path(scenario_filename() + "/" + "Supplemental Output Files" + '/' + SUMMARY_FILE_NAME)):
+        elif not summary_csv_is_current():
             return HttpResponseNotFound()
         else:
             return HttpResponse()
     if request.method == "POST":
+        if summary_csv_is_current():
+            return HttpResponse()
         csv_generator = SummaryCSVGenerator()
         csv_generator.start()  # starts a new thread
         return HttpResponseAccepted()
@@ -478,6 +478,11 @@ class OutputSettingsForm(BaseForm):
             'iterations',
             'stop_criteria',
             'days',
+            'stop_on_convergence',
+            'convergence_fields',
+            'convergence_statistic',
+            'convergence_tolerance',
+            'convergence_min_iterations',
             HTML(r"<h2>Cost Tracking</h2>"),
             'cost_track_destruction',
             'cost_track_vaccination',
@@ -487,6 +492,9 @@ class OutputSettingsForm(BaseForm):
             'save_daily_events',
             'save_daily_exposures',
             'save_map_output',
+            'combine_outputs_during_run',
+            'save_columnar_outputs',
+            'load_supplemental_tables',
         )
         super(OutputSettingsForm, self).__init__(*args, **kwargs)
 
@@ -497,7 +505,13 @@ class OutputSettingsForm(BaseForm):
             'days': NumberInput(
                 attrs={'data-visibility-controller': 'stop_criteria',
                        'data-required-value': 'stop-days',
-                       'step': '1'})
+                       'step': '1'}),
+            'convergence_fields': TextInput(attrs={'data-visibility-controller': 'stop_on_convergence', 'data-disabled-value': 'false'}),
+            'convergence_statistic': Select(attrs={'data-visibility-controller': 'stop_on_convergence', 'data-disabled-value': 'false'}),
+            'convergence_tolerance': NumberInput(attrs={'data-visibility-controller': 'stop_on_convergence', 'data-disabled-value': 'false',
+                                                        'step': 'any'}),
+            'convergence_min_iterations': NumberInput(attrs={'data-visibility-controller': 'stop_on_convergence', 'data-disabled-value': 'false',
+                                                             'step': '1'}),
         }
 
 
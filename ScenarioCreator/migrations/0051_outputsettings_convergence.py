@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.core.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ScenarioCreator', '0050_auto_20190821_2256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outputsettings',
+            name='stop_on_convergence',
+            field=models.BooleanField(help_text='Stop starting new iterations once the chosen outputs have converged.  Iterations is then the maximum.', default=False),
+        ),
+        migrations.AddField(
+            model_name='outputsettings',
+            name='convergence_fields',
+            field=models.CharField(max_length=255, help_text='Comma separated last day outputs that have to converge, from the All production types or the whole outbreak.', default='infcU, descU, outbreakDuration'),
+        ),
+        migrations.AddField(
+            model_name='outputsettings',
+            name='convergence_statistic',
+            field=models.CharField(max_length=255, help_text='What has to stay within the tolerance.', default='mean', choices=[('mean', 'The 95% confidence interval of the mean.'), ('median', 'The change in the median since 20% fewer iterations.')]),
+        ),
+        migrations.AddField(
+            model_name='outputsettings',
+            name='convergence_tolerance',
+            field=models.FloatField(help_text='Relative to the mean or median.  0.05 stops once every output is known to within 5%.', default=0.05, validators=[django.core.validators.MinValueValidator(0.0)]),
+        ),
+        migrations.AddField(
+            model_name='outputsettings',
+            name='convergence_min_iterations',
+            field=models.PositiveIntegerField(help_text='The number of iterations that always run before convergence is checked.', default=100, validators=[django.core.validators.MinValueValidator(10)]),
+        ),
+    ]
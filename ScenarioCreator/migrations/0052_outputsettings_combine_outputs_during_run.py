@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ScenarioCreator', '0051_outputsettings_convergence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outputsettings',
+            name='combine_outputs_during_run',
+            field=models.BooleanField(help_text='Append the daily state, event and exposure files of each iteration to the Combined Outputs as soon as it finishes.', default=False),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ScenarioCreator', '0052_outputsettings_combine_outputs_during_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outputsettings',
+            name='save_columnar_outputs',
+            field=models.BooleanField(help_text='Also save the combined outputs as compressed columnar files, one per iteration, with an index for loading a single iteration or column.', default=False),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ScenarioCreator', '0053_outputsettings_save_columnar_outputs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outputsettings',
+            name='load_supplemental_tables',
+            field=models.BooleanField(help_text='Load the daily state, event and exposure files into indexed tables of the scenario that can be searched with the Query Tool.', default=False),
+        ),
+    ]
@@ -843,6 +843,19 @@ class OutputSettings(InputSingleton):
                  ('stop-days', 'Stop after a specified number of days')))
     days = models.PositiveIntegerField(default=1825, validators=[MinValueValidator(1)],
         help_text='The maximum number of days that iterations of this scenario should run.', )
+    ## Stopping rule
+    stop_on_convergence = models.BooleanField(default=False,
+        help_text='Stop starting new iterations once the chosen outputs have converged.  Iterations is then the maximum.', )
+    convergence_fields = models.CharField(max_length=255, default='infcU, descU, outbreakDuration',
+        help_text='Comma separated last day outputs that have to converge, from the All production types or the whole outbreak.', )
+    convergence_statistic = models.CharField(max_length=255, default='mean',
+        help_text='What has to stay within the tolerance.',
+        choices=(('mean', 'The 95% confidence interval of the mean.'),
+                 ('median', 'The change in the median since 20% fewer iterations.')))
+    convergence_tolerance = models.FloatField(default=0.05, validators=[MinValueValidator(0.0)],
+        help_text='Relative to the mean or median.  0.05 stops once every output is known to within 5%.', )
+    convergence_min_iterations = models.PositiveIntegerField(default=100, validators=[MinValueValidator(10)],
+        help_text='The number of iterations that always run before convergence is checked.', )
     ## Cost Tracking
     cost_track_destruction = models.BooleanField(default=True,
         help_text='Disable this to ignore entered destruction costs.', )
@@ -862,11 +875,23 @@ class OutputSettings(InputSingleton):
         help_text='Required for the Population Map. Save all iteration outputs for units in a supplemental file.', )
     save_map_output = models.BooleanField(default=False,
         help_text='Create map outputs for units in supplemental directory.', )
+    combine_outputs_during_run = models.BooleanField(default=False,
+        help_text='Append the daily state, event and exposure files of each iteration to the Combined Outputs as soon as it finishes.', )
+    save_columnar_outputs = models.BooleanField(default=False,
+        help_text='Also save the combined outputs as compressed columnar files, one per iteration, with an index for loading a single iteration or column.', )
+    load_supplemental_tables = models.BooleanField(default=False,
+        help_text='Load the daily state, event and exposure files into indexed tables of the scenario that can be searched with the Query Tool.', )
 
     def clean_fields(self, exclude=None):
         super().clean_fields(exclude=exclude)
         if self.stop_criteria != 'stop-days':
             self.days = 1825  # 5 year maximum simulation time
+        if self.stop_on_convergence:
+            from Results.convergence import convergence_field_model, parse_convergence_fields
+            field_names = parse_convergence_fields(self.convergence_fields)
+            unknown = [name for name in field_names if convergence_field_model(name) is None]
+            if not field_names or unknown:
+                raise ValidationError("Convergence fields have to be last day outputs, not: " + (', '.join(unknown) or "none given"))
 
     def __str__(self):
         return "Output Settings"